@@ -1,9 +1,8 @@
 from django.contrib import admin
 from django.utils.html import format_html, format_html_join
 from django.utils.safestring import mark_safe
-from whoosh.writing import AsyncWriter
 
-from . import index
+from . import search
 from .models import Correspondent, Document, DocumentType, Log, Tag
 
 
@@ -81,18 +80,16 @@ class DocumentAdmin(admin.ModelAdmin):
     created_.short_description = "Created"
 
     def delete_queryset(self, request, queryset):
-        ix = index.open_index()
-        with AsyncWriter(ix) as writer:
-            for o in queryset:
-                index.remove_document(writer, o)
+        for o in queryset:
+            search.get_backend().queue_removal(o)
         super(DocumentAdmin, self).delete_queryset(request, queryset)
 
     def delete_model(self, request, obj):
-        index.remove_document_from_index(obj)
+        search.get_backend().queue_removal(obj)
         super(DocumentAdmin, self).delete_model(request, obj)
 
     def save_model(self, request, obj, form, change):
-        index.add_or_update_document(obj)
+        search.get_backend().queue_update(obj)
         super(DocumentAdmin, self).save_model(request, obj, form, change)
 
     @mark_safe
@@ -1,7 +1,10 @@
+import hashlib
 import textwrap
 
 from django.conf import settings
-from django.core.checks import Error, register
+from django.core.checks import Error, Warning, register
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
 from django.db.utils import OperationalError, ProgrammingError
 
 from documents.signals import document_consumer_declaration
@@ -53,3 +56,63 @@ def parser_check(app_configs, **kwargs):
                       "able to onsume any documents without parsers.")]
     else:
         return []
+
+
+@register()
+def digest_algorithm_check(app_configs, **kwargs):
+
+    algorithm = settings.DIGEST_ALGORITHM
+
+    if not algorithm:
+        return []
+
+    try:
+        digest_size = hashlib.new(algorithm).digest_size
+    except ValueError:
+        return [Error(
+            f"PAPERLESS_DIGEST_ALGORITHM is set to {algorithm}, which is not "
+            f"a hash algorithm supported by this system."
+        )]
+
+    # The digests of shake_128 and shake_256 have no fixed length.
+    if digest_size == 0:
+        return [Error(
+            f"PAPERLESS_DIGEST_ALGORITHM is set to {algorithm}, which does "
+            f"not produce digests of a fixed length."
+        )]
+
+    return []
+
+
+@register()
+def search_backend_check(app_configs, **kwargs):
+
+    from documents import search
+
+    try:
+        backend = search.get_backend()
+    except ImproperlyConfigured as e:
+        return [Error(str(e))]
+
+    if not isinstance(backend, search.DatabaseBackend):
+        return []
+
+    try:
+        if not backend.is_available():
+            return [Error(
+                "PAPERLESS_SEARCH_BACKEND is set to database, but SQLite was "
+                "built without full text search (FTS5)."
+            )]
+        tables = connection.introspection.table_names()
+    except (OperationalError, ProgrammingError):
+        return []
+
+    # Migrations create the tables if the backend is configured beforehand.
+    if "documents_document" in tables and \
+            "documents_searchindex" not in tables:
+        return [Warning(
+            "The database search backend has no index yet. Documents can't "
+            "be searched until you run \"document_index backfill\"."
+        )]
+
+    return []
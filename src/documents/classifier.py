@@ -1,16 +1,22 @@
 import hashlib
+import itertools
 import logging
 import os
-import pickle
 import re
+import threading
+import time
+from collections import namedtuple, defaultdict
 
+import joblib
 from django.conf import settings
-from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, \
+    HashingVectorizer
 from sklearn.neural_network import MLPClassifier
 from sklearn.preprocessing import MultiLabelBinarizer, LabelBinarizer
-from sklearn.utils.multiclass import type_of_target
 
-from documents.models import Document, MatchingModel
+from documents.file_handling import locked_json_file
+from documents.models import Document, MatchingModel, Correspondent, \
+    DocumentType, Tag
 
 
 class IncompatibleClassifierVersionError(Exception):
@@ -19,6 +25,20 @@ class IncompatibleClassifierVersionError(Exception):
 
 logger = logging.getLogger(__name__)
 
+# Number of documents that are fetched from the database at once while
+# gathering training data.
+TRAINING_DATA_CHUNK_SIZE = 1000
+
+# Size of the fixed feature space of incrementally trained classifiers.
+HASHING_FEATURES = 2 ** 14
+
+# Maximum number of changed documents that are remembered for incremental
+# training. Beyond that, the classifier is trained from scratch anyway.
+MAX_CHANGED_DOCUMENTS = 10000
+
+Prediction = namedtuple(
+    "Prediction", ["correspondent", "document_type", "tags"])
+
 
 def preprocess_content(content):
     content = content.lower().strip()
@@ -28,7 +48,7 @@ def preprocess_content(content):
 
 class DocumentClassifier(object):
 
-    FORMAT_VERSION = 6
+    FORMAT_VERSION = 8
 
     def __init__(self):
         # mtime of the model file on disk. used to prevent reloading when
@@ -39,6 +59,10 @@ class DocumentClassifier(object):
         # training data has not changed.
         self.data_hash = None
 
+        # number of incremental updates since the classifier was last trained
+        # on all documents.
+        self.updates_since_refit = 0
+
         self.data_vectorizer = None
         self.tags_binarizer = None
         self.tags_classifier = None
@@ -47,38 +71,131 @@ class DocumentClassifier(object):
 
     def reload(self):
         if os.path.getmtime(settings.MODEL_FILE) > self.classifier_version:
-            with open(settings.MODEL_FILE, "rb") as f:
-                schema_version = pickle.load(f)
-
-                if schema_version != self.FORMAT_VERSION:
-                    raise IncompatibleClassifierVersionError(
-                        "Cannor load classifier, incompatible versions.")
-                else:
-                    if self.classifier_version > 0:
-                        # Don't be confused by this check. It's simply here
-                        # so that we wont log anything on initial reload.
-                        logger.info("Classifier updated on disk, "
-                                    "reloading classifier models")
-                    self.data_hash = pickle.load(f)
-                    self.data_vectorizer = pickle.load(f)
-                    self.tags_binarizer = pickle.load(f)
-
-                    self.tags_classifier = pickle.load(f)
-                    self.correspondent_classifier = pickle.load(f)
-                    self.document_type_classifier = pickle.load(f)
+            # Weight matrices are mapped into memory instead of being read,
+            # so that all processes using the classifier share the same
+            # pages. Copy on write keeps the model file intact when the
+            # classifiers are updated.
+            model = joblib.load(settings.MODEL_FILE, mmap_mode="c")
+
+            if (not isinstance(model, dict) or
+                    model.get("format_version") != self.FORMAT_VERSION):
+                raise IncompatibleClassifierVersionError(
+                    "Cannor load classifier, incompatible versions.")
+            else:
+                if self.classifier_version > 0:
+                    # Don't be confused by this check. It's simply here
+                    # so that we wont log anything on initial reload.
+                    logger.info("Classifier updated on disk, "
+                                "reloading classifier models")
+                self.data_hash = model["data_hash"]
+                self.updates_since_refit = model["updates_since_refit"]
+                self.data_vectorizer = model["data_vectorizer"]
+                self.tags_binarizer = model["tags_binarizer"]
+
+                self.tags_classifier = model["tags_classifier"]
+                self.correspondent_classifier = \
+                    model["correspondent_classifier"]
+                self.document_type_classifier = \
+                    model["document_type_classifier"]
             self.classifier_version = os.path.getmtime(settings.MODEL_FILE)
 
     def save_classifier(self):
-        with open(settings.MODEL_FILE, "wb") as f:
-            pickle.dump(self.FORMAT_VERSION, f)
-            pickle.dump(self.data_hash, f)
-            pickle.dump(self.data_vectorizer, f)
-
-            pickle.dump(self.tags_binarizer, f)
+        # The terms ignored by the vectorizer are only kept for
+        # introspection and make up most of its size.
+        if hasattr(self.data_vectorizer, "stop_words_"):
+            del self.data_vectorizer.stop_words_
+
+        # Write to a temporary file first and replace the model file
+        # afterwards, so that other processes never see a partially written
+        # model. The file must not be compressed, otherwise it cannot be
+        # memory mapped.
+        target_file_temp = settings.MODEL_FILE + ".part"
+        joblib.dump({
+            "format_version": self.FORMAT_VERSION,
+            "data_hash": self.data_hash,
+            "updates_since_refit": self.updates_since_refit,
+            "data_vectorizer": self.data_vectorizer,
+            "tags_binarizer": self.tags_binarizer,
+            "tags_classifier": self.tags_classifier,
+            "correspondent_classifier": self.correspondent_classifier,
+            "document_type_classifier": self.document_type_classifier
+        }, target_file_temp)
+
+        os.replace(target_file_temp, settings.MODEL_FILE)
+
+    @staticmethod
+    def _auto_ids(model):
+        return set(model.objects.filter(
+            matching_algorithm=MatchingModel.MATCH_AUTO
+        ).values_list("id", flat=True))
+
+    @staticmethod
+    def _make_vectorizer():
+        if settings.CLASSIFIER_INCREMENTAL:
+            # A fixed feature space does not depend on the documents it was
+            # fitted on, so that the classifiers can learn from new
+            # documents later on.
+            return HashingVectorizer(
+                analyzer="word",
+                ngram_range=(1, 2),
+                n_features=HASHING_FEATURES,
+                alternate_sign=False,
+                norm=None
+            )
+        else:
+            return CountVectorizer(
+                analyzer="word",
+                ngram_range=(1, 2),
+                min_df=0.01
+            )
 
-            pickle.dump(self.tags_classifier, f)
-            pickle.dump(self.correspondent_classifier, f)
-            pickle.dump(self.document_type_classifier, f)
+    def is_incremental(self):
+        return isinstance(self.data_vectorizer, HashingVectorizer)
+
+    def _training_data(self, chunk_size=TRAINING_DATA_CHUNK_SIZE,
+                       document_ids=None):
+        """
+        Yields content and labels of all documents that are used for
+        training, using only a few queries per chunk of documents. Labels of
+        correspondents, document types and tags that are not set to automatic
+        matching are omitted.
+        """
+        auto_correspondents = self._auto_ids(Correspondent)
+        auto_document_types = self._auto_ids(DocumentType)
+        auto_tags = self._auto_ids(Tag)
+
+        documents = Document.objects.exclude(
+            tags__is_inbox_tag=True
+        )
+        if document_ids is not None:
+            documents = documents.filter(id__in=document_ids)
+        documents = documents.order_by("pk").values_list(
+            "pk", "content", "correspondent_id", "document_type_id"
+        ).iterator(chunk_size=chunk_size)
+
+        while True:
+            chunk = list(itertools.islice(documents, chunk_size))
+            if not chunk:
+                break
+
+            document_tags = defaultdict(list)
+            if auto_tags:
+                assignments = Document.tags.through.objects.filter(
+                    document_id__in=[d[0] for d in chunk],
+                    tag_id__in=auto_tags
+                ).order_by("tag_id").values_list("document_id", "tag_id")
+                for document_id, tag_id in assignments:
+                    document_tags[document_id].append(tag_id)
+
+            for pk, content, correspondent_id, document_type_id in chunk:
+                if document_type_id not in auto_document_types:
+                    document_type_id = -1
+                if correspondent_id not in auto_correspondents:
+                    correspondent_id = -1
+                yield (content,
+                       document_type_id,
+                       correspondent_id,
+                       document_tags[pk])
 
     def train(self):
         data = list()
@@ -89,29 +206,21 @@ class DocumentClassifier(object):
         # Step 1: Extract and preprocess training data from the database.
         logging.getLogger(__name__).debug("Gathering data from database...")
         m = hashlib.sha1()
-        for doc in Document.objects.order_by('pk').exclude(tags__is_inbox_tag=True):  # NOQA: E501
-            preprocessed_content = preprocess_content(doc.content)
+        training_data = self._training_data()
+        for content, document_type, correspondent, tags in training_data:
+            preprocessed_content = preprocess_content(content)
             m.update(preprocessed_content.encode('utf-8'))
             data.append(preprocessed_content)
 
-            y = -1
-            dt = doc.document_type
-            if dt and dt.matching_algorithm == MatchingModel.MATCH_AUTO:
-                y = dt.pk
-            m.update(y.to_bytes(4, 'little', signed=True))
-            labels_document_type.append(y)
-
-            y = -1
-            cor = doc.correspondent
-            if cor and cor.matching_algorithm == MatchingModel.MATCH_AUTO:
-                y = cor.pk
-            m.update(y.to_bytes(4, 'little', signed=True))
-            labels_correspondent.append(y)
-
-            tags = [tag.pk for tag in doc.tags.filter(
-                matching_algorithm=MatchingModel.MATCH_AUTO
-            )]
-            m.update(bytearray(tags))
+            m.update(document_type.to_bytes(4, 'little', signed=True))
+            labels_document_type.append(document_type)
+
+            m.update(correspondent.to_bytes(4, 'little', signed=True))
+            labels_correspondent.append(correspondent)
+
+            for tag in tags:
+                m.update(tag.to_bytes(4, 'little', signed=True))
+            m.update(b"\0")
             labels_tags.append(tags)
 
         if not data:
@@ -119,7 +228,8 @@ class DocumentClassifier(object):
 
         new_data_hash = m.digest()
 
-        if self.data_hash and new_data_hash == self.data_hash:
+        if (self.data_hash and new_data_hash == self.data_hash and
+                self.is_incremental() == settings.CLASSIFIER_INCREMENTAL):
             return False
 
         labels_tags_unique = set([tag for tags in labels_tags for tag in tags])
@@ -146,11 +256,7 @@ class DocumentClassifier(object):
 
         # Step 2: vectorize data
         logging.getLogger(__name__).debug("Vectorizing data...")
-        self.data_vectorizer = CountVectorizer(
-            analyzer="word",
-            ngram_range=(1, 2),
-            min_df=0.01
-        )
+        self.data_vectorizer = self._make_vectorizer()
         data_vectorized = self.data_vectorizer.fit_transform(data)
 
         # Step 3: train the classifiers
@@ -211,46 +317,333 @@ class DocumentClassifier(object):
             )
 
         self.data_hash = new_data_hash
+        self.updates_since_refit = 0
 
         return True
 
-    def predict_correspondent(self, content):
+    def _can_learn(self, labels_correspondent, labels_document_type,
+                   labels_tags):
+        # Classifiers cannot learn new classes incrementally.
+        if not set(labels_correspondent) <= (
+                set(self.correspondent_classifier.classes_)
+                if self.correspondent_classifier else {-1}):
+            return False
+        if not set(labels_document_type) <= (
+                set(self.document_type_classifier.classes_)
+                if self.document_type_classifier else {-1}):
+            return False
+
+        tags = set([tag for tags in labels_tags for tag in tags])
+        if not self.tags_classifier:
+            return not tags
+        if not tags <= set(self.tags_binarizer.classes_):
+            return False
+        if isinstance(self.tags_binarizer, LabelBinarizer):
+            return all(len(tags) <= 1 for tags in labels_tags)
+        return True
+
+    def train_incremental(self, document_ids):
+        """
+        Updates the existing classifiers with the current data of the given
+        documents only. Returns False if that is not possible, in which case
+        the classifier needs to be trained on all documents with train().
+        """
+        if not self.is_incremental() or not settings.CLASSIFIER_INCREMENTAL:
+            return False
+
+        data = list()
+        labels_tags = list()
+        labels_correspondent = list()
+        labels_document_type = list()
+
+        training_data = self._training_data(document_ids=document_ids)
+        for content, document_type, correspondent, tags in training_data:
+            data.append(preprocess_content(content))
+            labels_document_type.append(document_type)
+            labels_correspondent.append(correspondent)
+            labels_tags.append(tags)
+
+        if not self._can_learn(labels_correspondent, labels_document_type,
+                               labels_tags):
+            logging.getLogger(__name__).debug(
+                "New labels in training data, cannot update incrementally."
+            )
+            return False
+
+        logging.getLogger(__name__).debug(
+            f"Updating classifier with {len(data)} document(s)...")
+
+        if data:
+            data_vectorized = self.data_vectorizer.transform(data)
+
+            if self.tags_classifier:
+                if isinstance(self.tags_binarizer, LabelBinarizer):
+                    labels_tags = [label[0] if len(label) == 1 else -1
+                                   for label in labels_tags]
+                    labels_tags_vectorized = self.tags_binarizer.transform(
+                        labels_tags).ravel()
+                else:
+                    labels_tags_vectorized = self.tags_binarizer.transform(
+                        labels_tags)
+                self.tags_classifier.partial_fit(
+                    data_vectorized, labels_tags_vectorized)
+
+            if self.correspondent_classifier:
+                self.correspondent_classifier.partial_fit(
+                    data_vectorized, labels_correspondent)
+
+            if self.document_type_classifier:
+                self.document_type_classifier.partial_fit(
+                    data_vectorized, labels_document_type)
+
+        # The model no longer corresponds to any complete set of training
+        # data, so that the next check trains it from scratch.
+        self.data_hash = None
+        self.updates_since_refit += 1
+
+        return True
+
+    def _predict_correspondents(self, X):
         if self.correspondent_classifier:
-            X = self.data_vectorizer.transform([preprocess_content(content)])
-            correspondent_id = self.correspondent_classifier.predict(X)
-            if correspondent_id != -1:
-                return correspondent_id
-            else:
-                return None
+            return [int(y) if y != -1 else None
+                    for y in self.correspondent_classifier.predict(X)]
         else:
-            return None
+            return [None] * X.shape[0]
 
-    def predict_document_type(self, content):
+    def _predict_document_types(self, X):
         if self.document_type_classifier:
-            X = self.data_vectorizer.transform([preprocess_content(content)])
-            document_type_id = self.document_type_classifier.predict(X)
-            if document_type_id != -1:
-                return document_type_id
-            else:
-                return None
+            return [int(y) if y != -1 else None
+                    for y in self.document_type_classifier.predict(X)]
         else:
-            return None
+            return [None] * X.shape[0]
 
-    def predict_tags(self, content):
+    def _predict_tags(self, X):
         if self.tags_classifier:
-            X = self.data_vectorizer.transform([preprocess_content(content)])
             y = self.tags_classifier.predict(X)
-            tags_ids = self.tags_binarizer.inverse_transform(y)[0]
-            if type_of_target(y).startswith('multilabel'):
+            tags_ids = self.tags_binarizer.inverse_transform(y)
+            if isinstance(self.tags_binarizer, MultiLabelBinarizer):
                 # the usual case when there are multiple tags.
-                return list(tags_ids)
-            elif type_of_target(y) == 'binary' and tags_ids != -1:
-                # This is for when we have binary classification with only one
-                # tag and the result is to assign this tag.
-                return [tags_ids]
+                return [[int(t) for t in tags] for tags in tags_ids]
             else:
-                # Usually binary as well with -1 as the result, but we're
-                # going to catch everything else here as well.
-                return []
+                # This is for when we have binary classification with only
+                # one tag and the result is either this tag or -1.
+                return [[int(t)] if t != -1 else [] for t in tags_ids]
         else:
+            return [[] for _ in range(X.shape[0])]
+
+    def predict_many(self, contents):
+        """
+        Predicts correspondent, document type and tags of many documents at
+        once. The contents are vectorized into a single sparse matrix, so
+        that each classifier runs only once for the entire batch.
+        """
+        contents = list(contents)
+
+        if not contents:
             return []
+
+        if not self.data_vectorizer:
+            return [Prediction(None, None, []) for _ in contents]
+
+        X = self.data_vectorizer.transform(
+            [preprocess_content(content) for content in contents])
+
+        predictions = [Prediction(*p) for p in zip(
+            self._predict_correspondents(X),
+            self._predict_document_types(X),
+            self._predict_tags(X)
+        )]
+
+        return predictions
+
+    def predict_all(self, content):
+        """
+        Predicts correspondent, document type and tags of a document, but
+        vectorizes the content only once.
+        """
+        return self.predict_many([content])[0]
+
+    def predict_correspondent(self, content):
+        return self.predict_all(content).correspondent
+
+    def predict_document_type(self, content):
+        return self.predict_all(content).document_type
+
+    def predict_tags(self, content):
+        return list(self.predict_all(content).tags)
+
+
+ClassifierCacheInfo = namedtuple(
+    "ClassifierCacheInfo", ["hits", "misses", "load_time"])
+
+
+class _ClassifierCache(object):
+    """
+    Keeps one loaded classifier per process and reuses it until the model
+    file on disk changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key = None
+        self.classifier = None
+        self.hits = 0
+        self.misses = 0
+        self.load_time = None
+
+    @staticmethod
+    def _model_file_key():
+        stat = os.stat(settings.MODEL_FILE)
+        return settings.MODEL_FILE, stat.st_mtime_ns, stat.st_size
+
+    def get(self):
+        key = self._model_file_key()
+
+        with self.lock:
+            if key == self.key:
+                self.hits += 1
+                return self.classifier
+
+            self.misses += 1
+
+            # Load into a new instance, so that anyone still holding on to
+            # the previous classifier is not affected.
+            start = time.perf_counter()
+            classifier = DocumentClassifier()
+            classifier.reload()
+            self.load_time = time.perf_counter() - start
+
+            logger.debug(
+                f"Loaded classifier model in {self.load_time:.3f} seconds.")
+
+            self.key = key
+            self.classifier = classifier
+            return classifier
+
+    def info(self):
+        return ClassifierCacheInfo(self.hits, self.misses, self.load_time)
+
+
+_classifier_cache = _ClassifierCache()
+
+
+def load_classifier():
+    """
+    Returns the classifier of this process, or None if no usable model
+    exists. The model is only loaded from disk if it changed since it was
+    loaded the last time.
+    """
+    try:
+        return _classifier_cache.get()
+    except (FileNotFoundError, IncompatibleClassifierVersionError) as e:
+        logger.warning(f"Cannot classify documents: {e}.")
+        return None
+
+
+def classifier_cache_info():
+    return _classifier_cache.info()
+
+
+# The training data generation is a counter that is increased whenever
+# anything changes that might affect the training data of the classifier.
+# Along with it, we remember which generation the classifier was last trained
+# on, so that we know whether training is necessary without having to look at
+# any documents. For incremental training, the state also records which
+# documents changed in which generation, and the last generation that
+# requires training the classifier from scratch.
+
+
+def _training_state_file():
+    return os.path.join(settings.DATA_DIR, "classifier_state.json")
+
+
+def _training_state(write=False):
+    return locked_json_file(_training_state_file(), write)
+
+
+def bump_training_data_generation(document_ids=None):
+    """
+    Records a change of the training data. If the change is limited to the
+    given documents, the classifier may learn from these documents
+    incrementally. Otherwise, it has to be trained from scratch.
+    """
+    if not os.path.isdir(settings.DATA_DIR):
+        # Nothing was ever trained here.
+        return
+    try:
+        with _training_state(write=True) as state:
+            generation = state.get('generation', 0) + 1
+            state['generation'] = generation
+
+            changed = state.setdefault('changed_documents', {})
+            if document_ids is not None and settings.CLASSIFIER_INCREMENTAL:
+                for document_id in document_ids:
+                    changed[str(document_id)] = generation
+
+            if (document_ids is None or not settings.CLASSIFIER_INCREMENTAL or
+                    len(changed) > MAX_CHANGED_DOCUMENTS):
+                state['refit_generation'] = generation
+                changed.clear()
+    except OSError as e:
+        logger.warning(f"Cannot update classifier state: {e}")
+
+
+def get_training_data_generation():
+    try:
+        with _training_state() as state:
+            return state.get('generation', 0)
+    except FileNotFoundError:
+        return 0
+
+
+def get_training_data_changes():
+    """
+    Returns the current training data generation and the ids of all
+    documents that changed since the classifier was last trained. The ids are
+    None if the classifier has to be trained from scratch.
+    """
+    try:
+        with _training_state() as state:
+            generation = state.get('generation', 0)
+            trained_generation = state.get('trained_generation')
+            if (trained_generation is None or
+                    state.get('refit_generation', 0) > trained_generation):
+                return generation, None
+            return generation, sorted(
+                int(document_id) for document_id, changed_generation
+                in state.get('changed_documents', {}).items()
+                if changed_generation > trained_generation
+            )
+    except FileNotFoundError:
+        return 0, None
+
+
+def set_trained_generation(generation):
+    os.makedirs(settings.DATA_DIR, exist_ok=True)
+    with _training_state(write=True) as state:
+        state['trained_generation'] = generation
+        state['format_version'] = DocumentClassifier.FORMAT_VERSION
+        state['changed_documents'] = {
+            document_id: changed_generation
+            for document_id, changed_generation
+            in state.get('changed_documents', {}).items()
+            if changed_generation > generation
+        }
+
+
+def training_data_changed():
+    """
+    Returns False if nothing relevant to the classifier changed since it was
+    last trained. This does not look at any documents.
+    """
+    if not os.path.isfile(settings.MODEL_FILE):
+        return True
+    try:
+        with _training_state() as state:
+            return (
+                state.get('format_version') !=
+                DocumentClassifier.FORMAT_VERSION or
+                state.get('trained_generation') != state.get('generation', 0)
+            )
+    except FileNotFoundError:
+        return True
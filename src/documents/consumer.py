@@ -1,6 +1,4 @@
 import datetime
-import hashlib
-import logging
 import os
 
 import magic
@@ -9,8 +7,9 @@ from django.db import transaction
 from django.db.models import Q
 from django.utils import timezone
 
-from .classifier import DocumentClassifier, IncompatibleClassifierVersionError
-from .file_handling import create_source_path_directory
+from .classifier import load_classifier
+from .file_handling import create_source_path_directory, \
+    calculate_digest, place_file
 from .loggers import LoggingMixin
 from .models import Document, FileInfo, Correspondent, DocumentType, Tag
 from .parsers import ParseError, get_parser_class_for_mime_type, \
@@ -35,6 +34,8 @@ class Consumer(LoggingMixin):
         self.override_correspondent_id = None
         self.override_tag_ids = None
         self.override_document_type_id = None
+        self.checksum = None
+        self.digest = None
 
     def pre_check_file_exists(self):
         if not os.path.isfile(self.path):
@@ -42,9 +43,20 @@ class Consumer(LoggingMixin):
                 self.path))
 
     def pre_check_duplicate(self):
-        with open(self.path, "rb") as f:
-            checksum = hashlib.md5(f.read()).hexdigest()
-        if Document.objects.filter(Q(checksum=checksum) | Q(archive_checksum=checksum)).exists():  # NOQA: E501
+        # The file is hashed exactly once. Checksums are kept on the consumer
+        # so that they don't have to be calculated again when storing the
+        # document.
+        file_digest = calculate_digest(self.path)
+        self.checksum = file_digest.checksum
+        self.digest = file_digest.digest
+
+        duplicates = Q(checksum=self.checksum) | \
+            Q(archive_checksum=self.checksum)
+        if self.digest:
+            duplicates |= Q(digest=self.digest) | \
+                Q(archive_digest=self.digest)
+
+        if Document.objects.filter(duplicates).exists():
             if settings.CONSUMER_DELETE_DUPLICATES:
                 os.unlink(self.path)
             raise ConsumerError(
@@ -144,13 +156,7 @@ class Consumer(LoggingMixin):
         #   reloading the classifier multiple times, since there are multiple
         #   post-consume hooks that all require the classifier.
 
-        try:
-            classifier = DocumentClassifier()
-            classifier.reload()
-        except (FileNotFoundError, IncompatibleClassifierVersionError) as e:
-            logging.getLogger(__name__).warning(
-                "Cannot classify documents: {}.".format(e))
-            classifier = None
+        classifier = load_classifier()
 
         # now that everything is done, we can start to store the document
         # in the system. This will be a transaction and reasonably fast.
@@ -167,11 +173,18 @@ class Consumer(LoggingMixin):
                 # If we get here, it was successful. Proceed with post-consume
                 # hooks. If they fail, nothing will get changed.
 
+                # Classify the document once for all post-consume hooks.
+                if classifier:
+                    prediction = classifier.predict_all(document.content)
+                else:
+                    prediction = None
+
                 document_consumption_finished.send(
                     sender=self.__class__,
                     document=document,
                     logging_group=self.logging_group,
-                    classifier=classifier
+                    classifier=classifier,
+                    prediction=prediction
                 )
 
                 # After everything is in the database, copy the files into
@@ -181,20 +194,27 @@ class Consumer(LoggingMixin):
                 #  logic
                 create_source_path_directory(document.source_path)
 
+                # The original stays where it is until the document was
+                # consumed successfully. Thumbnail and archived version are
+                # temporary files of the parser and may be moved, unless the
+                # parser handed us the original itself.
                 self._write(document.storage_type,
                             self.path, document.source_path)
 
                 self._write(document.storage_type,
-                            thumbnail, document.thumbnail_path)
+                            thumbnail, document.thumbnail_path,
+                            move=thumbnail != self.path)
 
                 if archive_path and os.path.isfile(archive_path):
+                    archive_digest = calculate_digest(archive_path)
+
                     self._write(document.storage_type,
-                                archive_path, document.archive_path)
+                                archive_path, document.archive_path,
+                                move=archive_path != self.path)
 
-                    with open(archive_path, 'rb') as f:
-                        document.archive_checksum = hashlib.md5(
-                            f.read()).hexdigest()
-                        document.save()
+                    document.archive_checksum = archive_digest.checksum
+                    document.archive_digest = archive_digest.digest
+                    document.save()
 
                 # Afte performing all database operations and moving files
                 # into place, tell paperless where the file is.
@@ -238,17 +258,17 @@ class Consumer(LoggingMixin):
 
         storage_type = Document.STORAGE_TYPE_UNENCRYPTED
 
-        with open(self.path, "rb") as f:
-            document = Document.objects.create(
-                correspondent=file_info.correspondent,
-                title=file_info.title,
-                content=text,
-                mime_type=mime_type,
-                checksum=hashlib.md5(f.read()).hexdigest(),
-                created=created,
-                modified=created,
-                storage_type=storage_type
-            )
+        document = Document.objects.create(
+            correspondent=file_info.correspondent,
+            title=file_info.title,
+            content=text,
+            mime_type=mime_type,
+            checksum=self.checksum,
+            digest=self.digest,
+            created=created,
+            modified=created,
+            storage_type=storage_type
+        )
 
         relevant_tags = set(file_info.tags)
         if relevant_tags:
@@ -276,7 +296,6 @@ class Consumer(LoggingMixin):
             for tag_id in self.override_tag_ids:
                 document.tags.add(Tag.objects.get(pk=tag_id))
 
-    def _write(self, storage_type, source, target):
-        with open(source, "rb") as read_file:
-            with open(target, "wb") as write_file:
-                write_file.write(read_file.read())
+    def _write(self, storage_type, source, target, move=False):
+        strategy = place_file(source, target, move=move)
+        self.log("debug", f"Placed {target} using {strategy}")
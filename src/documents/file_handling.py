@@ -1,10 +1,41 @@
+import errno
+import fcntl
+import hashlib
+import json
 import logging
 import os
+import shutil
 from collections import defaultdict
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.template.defaultfilters import slugify
 
+# Files are hashed in chunks of this size so that memory usage does not grow
+# with the size of the document.
+CHUNK_SIZE = 1024 * 1024
+
+
+@contextmanager
+def locked_json_file(path, write=False):
+    """
+    Yields the contents of a JSON file, which is locked against concurrent
+    modifications by other processes. If write is set, the file is created if
+    necessary and changes to the contents are written back.
+    """
+    with open(path, "a+" if write else "r") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        f.seek(0)
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = {}
+        yield state
+        if write:
+            f.seek(0)
+            f.truncate()
+            json.dump(state, f)
+
 
 def create_source_path_directory(source_path):
     os.makedirs(os.path.dirname(source_path), exist_ok=True)
@@ -109,3 +140,155 @@ def generate_filename(doc):
 def archive_name_from_filename(filename):
 
     return os.path.splitext(filename)[0] + ".pdf"
+
+
+def digest_algorithms():
+    # MD5 is always calculated, since the checksum and archive_checksum
+    # fields (and thus duplicate detection) rely on it.
+    algorithms = ["md5"]
+    if settings.DIGEST_ALGORITHM:
+        algorithms.append(settings.DIGEST_ALGORITHM)
+    return algorithms
+
+
+def format_digest(algorithm, hexdigest):
+    return f"{algorithm}:{hexdigest}"
+
+
+class FileDigest:
+    """
+    Accumulates the md5 checksum and the optional digest configured with
+    PAPERLESS_DIGEST_ALGORITHM while a file is read chunk by chunk.
+    """
+
+    def __init__(self):
+        self.algorithm = settings.DIGEST_ALGORITHM
+        self.hashes = [hashlib.new(a) for a in digest_algorithms()]
+
+    def update(self, chunk):
+        for h in self.hashes:
+            h.update(chunk)
+
+    @property
+    def checksum(self):
+        return self.hashes[0].hexdigest()
+
+    @property
+    def digest(self):
+        if self.algorithm:
+            return format_digest(self.algorithm, self.hashes[1].hexdigest())
+        else:
+            return None
+
+
+def calculate_digest(path):
+    """
+    Reads the file at path exactly once and returns a FileDigest.
+    """
+    file_digest = FileDigest()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            file_digest.update(chunk)
+    return file_digest
+
+
+# Strategies used by place_file, in the order in which they are attempted.
+PLACEMENT_RENAME = "rename"
+PLACEMENT_REFLINK = "reflink"
+PLACEMENT_COPY_FILE_RANGE = "copy_file_range"
+PLACEMENT_SENDFILE = "sendfile"
+PLACEMENT_CHUNKED = "chunked"
+
+# ioctl request number of FICLONE on Linux.
+FICLONE = 0x40049409
+
+
+def _copy_reflink(src_fd, dst_fd, size):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if n == 0:
+            # Some file systems don't support this at all and copy nothing.
+            raise OSError(errno.EIO, f"Copied only {copied} of {size} bytes")
+        copied += n
+
+
+def _copy_sendfile(src_fd, dst_fd, size):
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    copied = 0
+    while copied < size:
+        n = os.sendfile(dst_fd, src_fd, copied, size - copied)
+        if n == 0:
+            # Some file systems don't support this at all and copy nothing.
+            raise OSError(errno.EIO, f"Copied only {copied} of {size} bytes")
+        copied += n
+
+
+_COPY_STRATEGIES = [
+    (PLACEMENT_REFLINK, _copy_reflink),
+    (PLACEMENT_COPY_FILE_RANGE, _copy_file_range),
+    (PLACEMENT_SENDFILE, _copy_sendfile),
+]
+
+
+def _copy(source, target):
+    with open(source, "rb") as read_file, open(target, "wb") as write_file:
+        src_fd = read_file.fileno()
+        dst_fd = write_file.fileno()
+        size = os.fstat(src_fd).st_size
+
+        for strategy, copy_func in _COPY_STRATEGIES:
+            try:
+                copy_func(src_fd, dst_fd, size)
+                return strategy
+            except OSError as e:
+                logging.getLogger(__name__).debug(
+                    f"Cannot copy {source} using {strategy}: {e}")
+                # start over with an empty target.
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+
+        shutil.copyfileobj(read_file, write_file, CHUNK_SIZE)
+        return PLACEMENT_CHUNKED
+
+
+def place_file(source, target, move=False, copy_mode=False):
+    """
+    Puts the file at source to target without routing its contents through
+    a python buffer the size of the file, and returns the strategy that was
+    used.
+
+    If move is set, the file is renamed if source and target are on the same
+    file system. Otherwise (or if renaming is not possible), the file is
+    copied using a reflink, copy_file_range or sendfile, whichever is
+    supported first, and copied in chunks if none of these work. When moving,
+    the source is removed after it was copied.
+
+    If copy_mode is set, the target gets the permission bits of the source,
+    as with shutil.copy and shutil.move. A renamed file keeps them anyway.
+    """
+    if move:
+        try:
+            os.rename(source, target)
+            return PLACEMENT_RENAME
+        except OSError as e:
+            logging.getLogger(__name__).debug(
+                f"Cannot rename {source} to {target}: {e}")
+
+    strategy = _copy(source, target)
+
+    if copy_mode:
+        shutil.copymode(source, target)
+
+    if move:
+        os.unlink(source)
+
+    return strategy
@@ -1,3 +1,4 @@
+from django.db.models import Exists, OuterRef
 from django_filters.rest_framework import BooleanFilter, FilterSet, Filter
 
 from .models import Correspondent, Document, Tag, DocumentType, Log
@@ -35,6 +36,30 @@ class DocumentTypeFilterSet(FilterSet):
         }
 
 
+def _tagged(tag_ids):
+    return Exists(Document.tags.through.objects.filter(
+        document_id=OuterRef("pk"), tag_id__in=tag_ids))
+
+
+def filter_all_tags(qs, tag_ids):
+    """
+    Restricts the documents to those that have all of the tags. Joining the
+    tags once per tag multiplies the rows the database has to go through with
+    every tag, while each of these conditions only checks whether a single
+    row exists.
+    """
+    for tag_id in set(tag_ids):
+        qs = qs.filter(_tagged([tag_id]))
+    return qs
+
+
+def exclude_tags(qs, tag_ids):
+    """
+    Restricts the documents to those that have none of the tags.
+    """
+    return qs.filter(~_tagged(tag_ids))
+
+
 class TagsFilter(Filter):
 
     def filter(self, qs, value):
@@ -46,10 +71,10 @@ class TagsFilter(Filter):
         except ValueError:
             return qs
 
-        for tag_id in tag_ids:
-            qs = qs.filter(tags__id=tag_id)
-
-        return qs
+        if self.exclude:
+            return exclude_tags(qs, tag_ids)
+        else:
+            return filter_all_tags(qs, tag_ids)
 
 
 class InboxFilter(Filter):
@@ -74,6 +99,8 @@ class DocumentFilterSet(FilterSet):
 
     tags__id__all = TagsFilter()
 
+    tags__id__none = TagsFilter(exclude=True)
+
     is_in_inbox = InboxFilter()
 
     class Meta:
@@ -1,16 +1,31 @@
+import atexit
+import datetime
 import logging
 import os
-from contextlib import contextmanager
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple, OrderedDict
+from heapq import nlargest
 
+import numpy
+from django import db
 from django.conf import settings
-from whoosh import highlight
-from whoosh.fields import Schema, TEXT, NUMERIC, KEYWORD, DATETIME
+from django.db import transaction
+from django.db.models.functions import Substr
+from django.utils import timezone
+from whoosh import highlight, query
+from whoosh.analysis import STOP_WORDS
+from whoosh.fields import Schema, TEXT, NUMERIC, KEYWORD, DATETIME, ID
 from whoosh.highlight import Formatter, get_text
 from whoosh.index import create_in, exists_in, open_dir
 from whoosh.qparser import MultifieldParser
 from whoosh.qparser.dateparse import DateParserPlugin
-from whoosh.writing import AsyncWriter
+from whoosh.writing import AsyncWriter, CLEAR
 
+from documents import matching
+from documents.file_handling import locked_json_file
+from documents.models import Document, MatchingModel, Tag
 
 logger = logging.getLogger(__name__)
 
@@ -66,13 +81,28 @@ def get_schema():
         created=DATETIME(stored=True, sortable=True),
         modified=DATETIME(stored=True, sortable=True),
         added=DATETIME(stored=True, sortable=True),
+        tag_id=KEYWORD(commas=True),
+        correspondent_id=ID(),
+        type_id=ID(),
     )
 
 
+# Seconds to wait for other processes to finish writing to the index before
+# clearing or rebuilding it.
+INDEX_LOCK_TIMEOUT = 60
+
+
 def open_index(recreate=False):
     try:
-        if exists_in(settings.INDEX_DIR) and not recreate:
-            return open_dir(settings.INDEX_DIR, schema=get_schema())
+        if exists_in(settings.INDEX_DIR):
+            ix = open_dir(settings.INDEX_DIR, schema=get_schema())
+            if recreate:
+                # Instead of creating a new index, remove all segments from
+                # the existing one. Its generation keeps increasing, which
+                # is how open searchers notice that the index changed.
+                writer = ix.writer(timeout=INDEX_LOCK_TIMEOUT)
+                writer.commit(mergetype=CLEAR)
+            return ix
     except Exception as e:
         logger.error(f"Error while opening the index: {e}, recreating.")
 
@@ -81,26 +111,46 @@ def open_index(recreate=False):
     return create_in(settings.INDEX_DIR, get_schema())
 
 
-def update_document(writer, doc):
-    # TODO: this line caused many issues all around, since:
-    #  We need to make sure that this method does not get called with
-    #  deserialized documents (i.e, document objects that don't come from
-    #  Django's ORM interfaces directly.
-    logger.debug("Indexing {}...".format(doc))
+def _document_fields(doc):
     tags = ",".join([t.name for t in doc.tags.all()])
-    writer.update_document(
+    tag_ids = ",".join([str(t.pk) for t in doc.tags.all()])
+    created = doc.created
+    if timezone.is_aware(created):
+        # The index doesn't know about time zones. Date filters expect UTC.
+        created = created.astimezone(timezone.utc)
+    return dict(
         id=doc.pk,
         title=doc.title,
         content=doc.content,
         correspondent=doc.correspondent.name if doc.correspondent else None,
         tag=tags if tags else None,
         type=doc.document_type.name if doc.document_type else None,
-        created=doc.created,
+        tag_id=tag_ids if tag_ids else None,
+        correspondent_id=str(doc.correspondent_id)
+        if doc.correspondent_id else None,
+        type_id=str(doc.document_type_id) if doc.document_type_id else None,
+        created=created,
         added=doc.added,
         modified=doc.modified,
     )
 
 
+def update_document(writer, doc):
+    # TODO: this line caused many issues all around, since:
+    #  We need to make sure that this method does not get called with
+    #  deserialized documents (i.e, document objects that don't come from
+    #  Django's ORM interfaces directly.
+    logger.debug("Indexing {}...".format(doc))
+    writer.update_document(**_document_fields(doc))
+
+
+def add_document(writer, doc):
+    # Faster than update_document(), but only for documents that are not in
+    # the index yet. This is used to index many documents at once, so it
+    # doesn't log every single one.
+    writer.add_document(**_document_fields(doc))
+
+
 def remove_document(writer, doc):
     # TODO: see above.
     logger.debug("Removing {} from index...".format(doc))
@@ -119,36 +169,553 @@ def remove_document_from_index(document):
         remove_document(writer, document)
 
 
-@contextmanager
-def query_page(ix, querystring, page):
-    searcher = ix.searcher()
+# Documents are usually changed one at a time by many processes. Instead of
+# committing each change to the index on its own, which creates a new segment
+# every time and competes for the index lock, changes are collected in a queue
+# shared by all processes and committed together.
+
+_UPDATE = "update"
+_DELETE = "delete"
+
+_flush_lock = threading.Lock()
+_flush_timer = None
+
+
+def _queue_file():
+    return os.path.join(settings.DATA_DIR, "index_queue.json")
+
+
+def _enqueue(document_id, operation):
+    if settings.INDEX_FLUSH_INTERVAL <= 0:
+        _apply({str(document_id): operation})
+    else:
+        # Other processes must not commit the change before the document is
+        # committed to the database, since they wouldn't find it.
+        transaction.on_commit(
+            lambda: _add_to_queue(document_id, operation))
+
+
+def _add_to_queue(document_id, operation):
+    with locked_json_file(_queue_file(), write=True) as queue:
+        pending = queue.setdefault("pending", {})
+        # Only the most recent operation on each document matters.
+        pending[str(document_id)] = operation
+        since = queue.setdefault("since", time.time())
+        size = len(pending)
+
+    if (size >= settings.INDEX_QUEUE_SIZE or
+            time.time() - since >= settings.INDEX_FLUSH_INTERVAL):
+        # Changes may have been left behind by processes that exited before
+        # they could flush them.
+        flush_queue()
+    else:
+        _schedule_flush()
+
+
+def _schedule_flush():
+    global _flush_timer
+    with _flush_lock:
+        if _flush_timer is not None and _flush_timer.is_alive():
+            return
+        _flush_timer = threading.Timer(
+            settings.INDEX_FLUSH_INTERVAL, _timed_flush)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def _timed_flush():
     try:
+        flush_queue()
+    except Exception as e:
+        logger.error(f"Error while updating the index: {e}")
+    finally:
+        db.connections.close_all()
+
+
+def _apply(pending):
+    documents = Document.objects.filter(
+        id__in=[int(document_id) for document_id, operation
+                in pending.items() if operation == _UPDATE]
+    ).select_related("correspondent", "document_type").prefetch_related(
+        "tags")
+    documents = {str(document.pk): document for document in documents}
+
+    writer = AsyncWriter(open_index())
+    with writer:
+        for document_id, operation in pending.items():
+            if document_id in documents:
+                update_document(writer, documents[document_id])
+            else:
+                # Documents that have gone in the meantime are removed.
+                logger.debug(f"Removing document {document_id} from index...")
+                writer.delete_by_term('id', int(document_id))
+
+    if writer.is_alive():
+        # The index was locked, and the changes are committed in the
+        # background.
+        writer.join()
+
+
+def queue_update(document):
+    """
+    Adds or updates the document in the index with the next batch of changes.
+    """
+    _enqueue(document.pk, _UPDATE)
+
+
+def queue_removal(document):
+    """
+    Removes the document from the index with the next batch of changes.
+    """
+    _enqueue(document.pk, _DELETE)
+
+
+def flush_queue():
+    """
+    Commits all queued changes to the index. Returns the number of documents
+    that were changed.
+    """
+    if not os.path.isfile(_queue_file()):
+        return 0
+
+    # The queue stays locked until the changes are committed, so that no
+    # other process considers them searchable before that.
+    with locked_json_file(_queue_file(), write=True) as queue:
+        pending = queue.get("pending", {})
+        if pending:
+            _apply(pending)
+        queue.clear()
+
+    return len(pending)
+
+
+def wait_until_searchable(document):
+    """
+    Returns once all queued changes to the document are committed to the
+    index.
+    """
+    if not os.path.isfile(_queue_file()):
+        return
+
+    with locked_json_file(_queue_file()) as queue:
+        queued = str(document.pk) in queue.get("pending", {})
+
+    if queued:
+        flush_queue()
+
+
+atexit.register(_timed_flush)
+
+
+# Highlights are only searched for in this many characters at the start of
+# each document.
+HIGHLIGHT_CHARS = 2 ** 15
+
+
+# Opening the index reads its table of contents and all segments, which is
+# too slow to do for every search request. Each process keeps the index open,
+# and each thread keeps a searcher, which only reopens changed segments when
+# the index changes.
+
+_shared_index_lock = threading.Lock()
+_shared_index = None
+_shared_index_dir = None
+_shared = threading.local()
+
+
+def _get_shared_index():
+    global _shared_index, _shared_index_dir
+    with _shared_index_lock:
+        if _shared_index is None or _shared_index_dir != settings.INDEX_DIR:
+            _shared_index = open_index()
+            _shared_index_dir = settings.INDEX_DIR
+        return _shared_index
+
+
+def shared_searcher():
+    """
+    Returns a searcher for the latest version of the index. The searcher is
+    reused by this thread and must not be closed.
+    """
+    ix = _get_shared_index()
+    searcher = getattr(_shared, "searcher", None)
+
+    if searcher is None or searcher._ix is not ix:
+        if searcher is not None:
+            searcher.close()
+        searcher = ix.searcher()
+    else:
+        searcher = searcher.refresh()
+
+    _shared.searcher = searcher
+    return searcher
+
+
+_query_parser = None
+
+
+def _get_query_parser():
+    global _query_parser
+    if _query_parser is None:
         qp = MultifieldParser(
             ["content", "title", "correspondent", "tag", "type"],
-            ix.schema)
+            get_schema())
         qp.add_plugin(DateParserPlugin())
+        _query_parser = qp
+    return _query_parser
+
+
+SearchHit = namedtuple(
+    "SearchHit", ["id", "title", "score", "rank", "highlights"])
+
+SearchResults = namedtuple(
+    "SearchResults",
+    ["count", "page", "page_count", "hits", "corrected_query"])
+
+
+class _SearchCache(object):
+    """
+    Remembers the most recent result pages of one version of the index. All
+    entries are dropped once the index changes.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.version = None
+        self.entries = OrderedDict()
+
+    def get(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                return None
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, version, results):
+        with self.lock:
+            if version != self.version:
+                return
+            self.entries[key] = results
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+# Number of result pages each process keeps around.
+SEARCH_CACHE_SIZE = 100
+
+_search_cache = _SearchCache(SEARCH_CACHE_SIZE)
+
+
+def _search(searcher, q, querystring, page, filter_q):
+    result_page = searcher.search_page(q, page, filter=filter_q)
+    result_page.results.fragmenter = highlight.ContextFragmenter(
+        surround=50, charlimit=HIGHLIGHT_CHARS)
+    result_page.results.formatter = JsonFormatter()
 
-        q = qp.parse(querystring)
-        result_page = searcher.search_page(q, page)
-        result_page.results.fragmenter = highlight.ContextFragmenter(
-            surround=50)
-        result_page.results.formatter = JsonFormatter()
+    hits = list(result_page)
+    contents = dict(Document.objects.filter(
+        id__in=[r['id'] for r in hits]
+    ).annotate(
+        highlight_text=Substr("content", 1, HIGHLIGHT_CHARS)
+    ).values_list("id", "highlight_text"))
 
+    max_hits = settings.SEARCH_SUGGESTION_MAX_HITS
+    if max_hits is None or len(result_page) <= max_hits:
         corrected = searcher.correct_query(q, querystring)
         if corrected.query != q:
             corrected_query = corrected.string
         else:
             corrected_query = None
+    else:
+        corrected_query = None
 
-        yield result_page, corrected_query
-    finally:
-        searcher.close()
+    return SearchResults(
+        count=len(result_page),
+        page=result_page.pagenum,
+        page_count=result_page.pagecount,
+        # The index might still contain documents that were just deleted.
+        hits=[SearchHit(id=r['id'],
+                        title=r['title'],
+                        score=r.score,
+                        rank=r.rank,
+                        highlights=r.highlights(
+                            "content", text=contents[r['id']]))
+              for r in hits if r['id'] in contents],
+        corrected_query=corrected_query
+    )
+
+
+def _index_version(reader):
+    # The generation starts from scratch when the index is recreated, but the
+    # names of segments are unique.
+    return (reader.generation(),
+            tuple(r.segment().segment_id()
+                  for r, offset in reader.leaf_readers()
+                  if hasattr(r, "segment")))
+
+
+def _start_of_day(date):
+    # Dates of filters are in the current time zone, while the index stores
+    # UTC.
+    start = timezone.make_aware(
+        datetime.datetime.combine(date, datetime.time.min))
+    return start.astimezone(timezone.utc)
+
+
+def filter_query(filters):
+    """
+    Translates filters of the document list into a query that matches the
+    documents that pass all of them. See search.parse_filters().
+    """
+    queries = []
+    for name, value in filters.items():
+        if name == "tags__id__all":
+            queries.append(query.And(
+                [query.Term("tag_id", str(pk)) for pk in value]))
+        elif name == "tags__id__none":
+            queries.append(query.Not(query.Or(
+                [query.Term("tag_id", str(pk)) for pk in value])))
+        elif name in ("tags__id", "tags__id__in"):
+            queries.append(query.Or(
+                [query.Term("tag_id", str(pk)) for pk in value]))
+        elif name in ("correspondent__id", "correspondent__id__in"):
+            queries.append(query.Or(
+                [query.Term("correspondent_id", str(pk)) for pk in value]))
+        elif name in ("document_type__id", "document_type__id__in"):
+            queries.append(query.Or(
+                [query.Term("type_id", str(pk)) for pk in value]))
+        elif name == "created__date__gt":
+            queries.append(query.DateRange(
+                "created", _start_of_day(value + datetime.timedelta(days=1)),
+                None))
+        elif name == "created__date__lt":
+            queries.append(query.DateRange(
+                "created", None, _start_of_day(value), endexcl=True))
+        elif name == "is_in_inbox":
+            inbox = query.Or([query.Term("tag_id", str(pk)) for pk in
+                              Tag.objects.filter(is_inbox_tag=True).
+                              values_list("id", flat=True)])
+            queries.append(inbox if value else query.Not(inbox))
+        else:
+            raise ValueError(f"Unknown filter {name}")
+
+    return query.And(queries) if queries else None
+
+
+def search(querystring, page, filters=None):
+    """
+    Returns a page of documents that match the query and the filters, along
+    with highlights of their content and a corrected query, if there is one.
+    """
+    searcher = shared_searcher()
+    version = _index_version(searcher.reader())
+
+    q = _get_query_parser().parse(querystring)
+    filter_q = filter_query(filters) if filters else None
+    # Differently written queries that mean the same share an entry.
+    key = (repr(q), repr(filter_q), page)
+
+    results = _search_cache.get(key, version)
+    if results is None:
+        results = _search(searcher, q, querystring, page, filter_q)
+        _search_cache.put(key, version, results)
+    return results
+
+
+class _Autocompletion(object):
+    """
+    All terms of the content field in sorted order along with their scores,
+    so that the best terms with a prefix are found without looking at every
+    term in the index. The scores are the same as those of
+    IndexReader.most_distinctive_terms().
+    """
+
+    # The best terms of prefixes of more terms than this are remembered.
+    LARGE_PREFIX = 1000
+
+    # Number of terms remembered for each such prefix.
+    LARGE_PREFIX_TERMS = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        # Thread that updates the terms after the index has changed.
+        self.thread = None
+        # Terms, weights and document frequencies of each segment.
+        self.segments = {}
+        # Sorted terms, their scores and the best terms of large prefixes.
+        self.data = ([], numpy.zeros(0), {})
+
+    def _segment_terms(self, reader):
+        segment_id = reader.segment().segment_id()
+        if segment_id not in self.segments:
+            terms = []
+            weights = []
+            frequencies = []
+            for text, terminfo in reader.iter_field("content"):
+                terms.append(text)
+                weights.append(terminfo.weight())
+                frequencies.append(terminfo.doc_frequency())
+            self.segments[segment_id] = (numpy.array(terms, dtype=object),
+                                         numpy.array(weights, dtype=float),
+                                         numpy.array(frequencies, dtype=float))
+        return self.segments[segment_id]
+
+    def _update(self, reader, version):
+        # Only segments that were added since the last update are read.
+        leaves = [r for r, offset in reader.leaf_readers()
+                  if hasattr(r, "segment")]
+        parts = [self._segment_terms(r) for r in leaves]
+        segment_ids = set(r.segment().segment_id() for r in leaves)
+        self.segments = {segment_id: part
+                         for segment_id, part in self.segments.items()
+                         if segment_id in segment_ids}
+
+        if not parts:
+            terms = numpy.array([], dtype=object)
+            weights = frequencies = numpy.zeros(0)
+        elif len(parts) == 1:
+            terms, weights, frequencies = parts[0]
+        else:
+            terms, inverse = numpy.unique(
+                numpy.concatenate([p[0] for p in parts]), return_inverse=True)
+            weights = numpy.bincount(
+                inverse, numpy.concatenate([p[1] for p in parts]))
+            frequencies = numpy.bincount(
+                inverse, numpy.concatenate([p[2] for p in parts]))
+
+        with numpy.errstate(divide="ignore"):
+            scores = weights * numpy.log(reader.doc_count() / frequencies)
+
+        self.data = (terms.tolist(), scores, {})
+        self.version = version
+
+    @staticmethod
+    def _best_terms(terms, scores, lo, hi, number):
+        candidates = range(lo, hi)
+        if hi - lo > number:
+            # Only terms that score at least as high as the number-th best
+            # term can be among the best.
+            kth = hi - lo - number
+            threshold = numpy.partition(scores[lo:hi], kth)[kth]
+            candidates = lo + numpy.flatnonzero(scores[lo:hi] >= threshold)
+        return [term for score, term in nlargest(
+            number, ((scores[i], terms[i]) for i in candidates))]
+
+    def _update_in_background(self):
+        try:
+            with _get_shared_index().searcher() as searcher:
+                reader = searcher.reader()
+                self._update(
+                    reader, (settings.INDEX_DIR, _index_version(reader)))
+        except Exception as e:
+            logger.error(f"Error while updating autocompletion terms: {e}")
+        finally:
+            self.lock.release()
+
+    def complete(self, reader, prefix, limit):
+        version = (settings.INDEX_DIR, _index_version(reader))
+        if version != self.version:
+            if self.version is None or self.version[0] != version[0]:
+                # There are no terms of this index to use in the meantime.
+                with self.lock:
+                    if version != self.version:
+                        self._update(reader, version)
+            elif self.lock.acquire(blocking=False):
+                # Reading the terms of new segments takes a while. Requests
+                # keep using the previous terms until they are updated.
+                self.thread = threading.Thread(
+                    target=self._update_in_background, daemon=True)
+                self.thread.start()
+
+        terms, scores, large_prefixes = self.data
+
+        lo = bisect_left(terms, prefix)
+        # UTF-8 never contains this byte.
+        hi = bisect_left(terms, prefix + b"\xff")
+
+        if hi - lo > self.LARGE_PREFIX and limit <= self.LARGE_PREFIX_TERMS:
+            if prefix not in large_prefixes:
+                large_prefixes[prefix] = self._best_terms(
+                    terms, scores, lo, hi, self.LARGE_PREFIX_TERMS)
+            return large_prefixes[prefix][:limit]
+
+        return self._best_terms(terms, scores, lo, hi, limit)
+
+
+_autocompletion = _Autocompletion()
+
+
+def autocomplete(term, limit=10):
+    return _autocompletion.complete(
+        shared_searcher().reader(), term.lower().encode("utf-8"), limit)
+
+
+def _indexed_terms(searcher, words):
+    """
+    Returns the terms in the content field of the index that contain each of
+    the words. Words separated by dots are a single term in the index.
+    """
+    terms = {word: {word} for word in words}
+    for term in searcher.reader().field_terms("content"):
+        if "." in term:
+            for part in term.split("."):
+                if part in terms:
+                    terms[part].add(term)
+    return terms
+
+
+def matching_query(searcher, matching_model):
+    """
+    Translates a rule with the any, all or literal matching algorithm into a
+    query that finds at least all documents the rule matches. Returns None if
+    that is not possible, since the rule uses regular expressions or only
+    words that are not indexed.
+    """
+    algorithm = matching_model.matching_algorithm
+    if algorithm not in (MatchingModel.MATCH_ANY, MatchingModel.MATCH_ALL,
+                         MatchingModel.MATCH_LITERAL):
+        return None
+
+    keywords = matching.plain_keywords(matching_model)
+
+    # Stop words and single characters are not indexed. These can be left
+    # out of phrases and of rules that require all keywords, since other
+    # words still have to be present.
+    keywords = [
+        [word for word in words if len(word) > 1 and word not in STOP_WORDS]
+        if words else None
+        for words in keywords
+    ]
+
+    if algorithm == MatchingModel.MATCH_ALL:
+        keywords = [words for words in keywords if words]
+        if not keywords:
+            return None
+    elif not all(keywords):
+        # any keyword could match, including those that we can't look up.
+        return None
+
+    terms = _indexed_terms(
+        searcher, set(word for words in keywords for word in words))
+
+    def keyword_query(words):
+        return query.And([
+            query.Or([query.Term("content", t) for t in sorted(terms[word])])
+            for word in words
+        ])
+
+    if algorithm == MatchingModel.MATCH_ALL:
+        return query.And([keyword_query(words) for words in keywords])
+    else:
+        return query.Or([keyword_query(words) for words in keywords])
 
 
-def autocomplete(ix, term, limit=10):
-    with ix.reader() as reader:
-        terms = []
-        for (score, t) in reader.most_distinctive_terms(
-                "content", number=limit, prefix=term.lower()):
-            terms.append(t)
-        return terms
+def search_document_ids(searcher, q):
+    return [searcher.stored_fields(docnum)["id"]
+            for docnum in searcher.docs_for_query(q)]
@@ -1,9 +1,7 @@
-import hashlib
 import multiprocessing
 
 import logging
 import os
-import shutil
 import uuid
 
 import tqdm
@@ -11,11 +9,12 @@ from django import db
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from whoosh.writing import AsyncWriter
 
+from documents.classifier import bump_training_data_generation
 from documents.models import Document
-from ... import index
-from ...file_handling import create_source_path_directory
+from ... import search
+from ...file_handling import create_source_path_directory, \
+    calculate_digest, place_file
 from ...mixins import Renderable
 from ...parsers import get_parser_class_for_mime_type
 
@@ -37,21 +36,22 @@ def handle_document(document_id):
 
         if parser.get_archive_path():
             with transaction.atomic():
-                with open(parser.get_archive_path(), 'rb') as f:
-                    checksum = hashlib.md5(f.read()).hexdigest()
+                archive_digest = calculate_digest(parser.get_archive_path())
                 # i'm going to save first so that in case the file move
                 # fails, the database is rolled back.
                 # we also don't use save() since that triggers the filehandling
                 # logic, and we don't want that yet (file not yet in place)
                 Document.objects.filter(pk=document.pk).update(
-                    archive_checksum=checksum,
+                    archive_checksum=archive_digest.checksum,
+                    archive_digest=archive_digest.digest,
                     content=parser.get_text()
                 )
+                bump_training_data_generation([document.pk])
                 create_source_path_directory(document.archive_path)
-                shutil.move(parser.get_archive_path(), document.archive_path)
+                place_file(parser.get_archive_path(), document.archive_path,
+                           move=True, copy_mode=True)
 
-        with AsyncWriter(index.open_index()) as writer:
-            index.update_document(writer, document)
+        search.get_backend().queue_update(document)
 
     except Exception as e:
         logger.error(f"Error while parsing document {document}: {str(e)}")
@@ -126,3 +126,7 @@ class Command(Renderable, BaseCommand):
                 ))
         except KeyboardInterrupt:
             print("Aborting...")
+        finally:
+            # The workers are terminated before their queued index changes
+            # are committed.
+            search.get_backend().flush()
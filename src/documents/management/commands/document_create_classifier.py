@@ -15,4 +15,4 @@ class Command(Renderable, BaseCommand):
         BaseCommand.__init__(self, *args, **kwargs)
 
     def handle(self, *args, **options):
-        train_classifier()
+        train_classifier(full_check=True)
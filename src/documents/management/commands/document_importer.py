@@ -1,6 +1,5 @@
 import json
 import os
-import shutil
 
 from django.conf import settings
 from django.core.management import call_command
@@ -9,7 +8,8 @@ from django.core.management.base import BaseCommand, CommandError
 from documents.models import Document
 from documents.settings import EXPORTER_FILE_NAME, EXPORTER_THUMBNAIL_NAME, \
     EXPORTER_ARCHIVE_NAME
-from ...file_handling import generate_filename, create_source_path_directory
+from ...file_handling import generate_filename, \
+    create_source_path_directory, place_file
 from ...mixins import Renderable
 
 
@@ -122,9 +122,9 @@ class Command(Renderable, BaseCommand):
             create_source_path_directory(document.source_path)
 
             print(f"Moving {document_path} to {document.source_path}")
-            shutil.copy(document_path, document.source_path)
-            shutil.copy(thumbnail_path, document.thumbnail_path)
+            place_file(document_path, document.source_path, copy_mode=True)
+            place_file(thumbnail_path, document.thumbnail_path, copy_mode=True)
             if archive_path:
-                shutil.copy(archive_path, document.archive_path)
+                place_file(archive_path, document.archive_path, copy_mode=True)
 
             document.save()
@@ -1,7 +1,9 @@
+import time
+
 from django.core.management import BaseCommand
 
 from documents.mixins import Renderable
-from documents.tasks import index_reindex, index_optimize
+from documents.tasks import index_reindex, index_optimize, index_backfill
 
 
 class Command(Renderable, BaseCommand):
@@ -13,13 +15,39 @@ class Command(Renderable, BaseCommand):
         BaseCommand.__init__(self, *args, **kwargs)
 
     def add_arguments(self, parser):
-        parser.add_argument("command", choices=['reindex', 'optimize'])
+        parser.add_argument(
+            "command", choices=['reindex', 'optimize', 'backfill'])
+        parser.add_argument(
+            "-p", "--processes",
+            default=1,
+            type=int,
+            help="Number of processes that index documents in parallel."
+        )
+        parser.add_argument(
+            "--no-progress-bar",
+            default=False,
+            action="store_true",
+            help="If set, the progress bar will not be shown."
+        )
 
     def handle(self, *args, **options):
 
         self.verbosity = options["verbosity"]
 
         if options['command'] == 'reindex':
-            index_reindex()
+            start = time.perf_counter()
+            count = index_reindex(
+                processes=options["processes"],
+                progress_bar_disable=options["no_progress_bar"])
+            duration = time.perf_counter() - start
+            if self.verbosity > 0:
+                self.stdout.write(
+                    f"Indexed {count} documents in {duration:.1f} seconds "
+                    f"({count / max(duration, 1e-6):.1f} documents/s).")
         elif options['command'] == 'optimize':
             index_optimize()
+        elif options['command'] == 'backfill':
+            count = index_backfill(
+                progress_bar_disable=options["no_progress_bar"])
+            if self.verbosity > 0:
+                self.stdout.write(f"Added {count} documents to the index.")
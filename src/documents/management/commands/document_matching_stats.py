@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from documents.matching import get_rule_costs, reset_rule_costs
+
+
+class Command(BaseCommand):
+
+    help = """
+        Shows the tags, correspondents and document types whose matching
+        rules took the most time while matching documents.
+    """.replace("    ", "")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-n", "--limit",
+            type=int,
+            default=20,
+            help="Number of matching rules to show."
+        )
+        parser.add_argument(
+            "--reset",
+            default=False,
+            action="store_true",
+            help="Forget all recorded numbers."
+        )
+
+    def handle(self, *args, **options):
+        if options["reset"]:
+            reset_rule_costs()
+            return
+
+        costs = get_rule_costs()[:options["limit"]]
+
+        if not costs:
+            self.stdout.write("No matching rules were recorded yet.")
+            return
+
+        self.stdout.write(
+            f"{'Type':<15} {'Name':<30} {'Algorithm':<20} {'Matches':>8} "
+            f"{'Total (s)':>10} {'Avg (ms)':>9} {'Max (ms)':>9} "
+            f"{'Timeouts':>8}")
+        for cost in costs:
+            matching_model = cost.matching_model
+            self.stdout.write(
+                f"{matching_model._meta.verbose_name:<15} "
+                f"{matching_model.name[:30]:<30} "
+                f"{matching_model.get_matching_algorithm_display():<20} "
+                f"{cost.calls:>8} "
+                f"{cost.total_time:>10.3f} "
+                f"{1000 * cost.total_time / cost.calls:>9.3f} "
+                f"{1000 * cost.max_time:>9.3f} "
+                f"{cost.timeouts:>8}")
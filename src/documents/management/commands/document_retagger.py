@@ -1,12 +1,178 @@
 import logging
+import math
+import multiprocessing
+import time
+from collections import namedtuple, defaultdict
+from functools import partial
 
+import tqdm
+from django import db
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import transaction
 
-from documents.classifier import DocumentClassifier, \
-    IncompatibleClassifierVersionError
-from documents.models import Document
+from documents import matching, search
+from documents.classifier import load_classifier, \
+    bump_training_data_generation
+from documents.models import Document, Correspondent, DocumentType, Tag
 from ...mixins import Renderable
-from ...signals.handlers import set_correspondent, set_document_type, set_tags
+from ...signals.handlers import update_filename_and_move_files
+
+
+logger = logging.getLogger(__name__)
+
+
+# Number of documents that are classified together. The changes to each
+# batch are written to the database in a single transaction.
+BATCH_SIZE = 1000
+
+
+# Changes to a single document. fields maps document fields to their new
+# values and only contains fields that actually change.
+Assignment = namedtuple(
+    "Assignment", ["document_id", "fields", "add_tag_ids", "remove_tag_ids"])
+
+
+def _select(document, field, potential, overwrite, use_first):
+    current = getattr(document, field)
+
+    if current and not overwrite:
+        return current
+
+    if len(potential) > 1 and not use_first:
+        logger.debug(
+            f"Detected {len(potential)} potential values for {field} of "
+            f"{document}, not assigning any")
+        return current
+
+    selected = potential[0].pk if potential else None
+
+    if selected or overwrite:
+        return selected
+    else:
+        return current
+
+
+def classify_documents(document_ids, options):
+    """
+    Determines the correspondents, document types and tags of the given
+    documents without changing them. Returns the number of documents and
+    a list of assignments for the documents that change.
+    """
+    classifier = load_classifier()
+
+    documents = list(Document.objects.filter(
+        id__in=document_ids).prefetch_related("tags").order_by("id"))
+
+    if classifier:
+        # Classify the entire batch in one go.
+        predictions = classifier.predict_many([d.content for d in documents])
+    else:
+        predictions = [None] * len(documents)
+
+    correspondents = list(Correspondent.objects.all())
+    document_types = list(DocumentType.objects.all())
+    tags = list(Tag.objects.all())
+
+    assignments = []
+    for document, prediction in zip(documents, predictions):
+        fields = {}
+        add_tag_ids = set()
+        remove_tag_ids = set()
+
+        if options['correspondent']:
+            selected = _select(
+                document,
+                "correspondent_id",
+                matching.match_correspondents(
+                    document.content, classifier, correspondents,
+                    prediction=prediction),
+                options['overwrite'],
+                options['use_first'])
+            if selected != document.correspondent_id:
+                fields["correspondent_id"] = selected
+
+        if options['document_type']:
+            selected = _select(
+                document,
+                "document_type_id",
+                matching.match_document_types(
+                    document.content, classifier, document_types,
+                    prediction=prediction),
+                options['overwrite'],
+                options['use_first'])
+            if selected != document.document_type_id:
+                fields["document_type_id"] = selected
+
+        if options['tags']:
+            current_tag_ids = {t.pk for t in document.tags.all()}
+            matched_tag_ids = {t.pk for t in matching.match_tags(
+                document.content, classifier, tags, prediction=prediction)}
+            add_tag_ids = matched_tag_ids - current_tag_ids
+            if options['overwrite']:
+                remove_tag_ids = current_tag_ids - matched_tag_ids
+
+        if fields or add_tag_ids or remove_tag_ids:
+            assignments.append(Assignment(
+                document.pk, fields, add_tag_ids, remove_tag_ids))
+
+    matching.flush_rule_costs()
+
+    return len(documents), assignments
+
+
+def apply_assignments(assignments):
+    """
+    Writes the assignments to the database with as few queries as possible.
+    This does not rename any files or update the index.
+    """
+    if not assignments:
+        return
+
+    changed_fields = defaultdict(list)
+    added_tags = defaultdict(list)
+    removed_tags = defaultdict(list)
+    for a in assignments:
+        for field, value in a.fields.items():
+            changed_fields[(field, value)].append(a.document_id)
+        for tag_id in a.add_tag_ids:
+            added_tags[tag_id].append(a.document_id)
+        for tag_id in a.remove_tag_ids:
+            removed_tags[tag_id].append(a.document_id)
+
+    Through = Document.tags.through
+
+    with transaction.atomic():
+        for (field, value), document_ids in changed_fields.items():
+            Document.objects.filter(
+                pk__in=document_ids).update(**{field: value})
+
+        for tag_id, document_ids in removed_tags.items():
+            Through.objects.filter(
+                tag_id=tag_id, document_id__in=document_ids).delete()
+
+        Through.objects.bulk_create([
+            Through(document_id=document_id, tag_id=tag_id)
+            for tag_id, document_ids in added_tags.items()
+            for document_id in document_ids
+        ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+        # Bulk updates don't send any signals.
+        bump_training_data_generation([a.document_id for a in assignments])
+
+
+def update_files_and_index(document_ids):
+    """
+    Moves the files of the given documents according to their new metadata
+    and updates their index entries, once per document.
+    """
+    backend = search.get_backend()
+
+    for documents in search.document_batches(document_ids, BATCH_SIZE):
+        if settings.PAPERLESS_FILENAME_FORMAT is not None:
+            for document in documents:
+                update_filename_and_move_files(Document, document)
+        backend.update_documents(documents)
 
 
 class Command(Renderable, BaseCommand):
@@ -59,6 +225,18 @@ class Command(Renderable, BaseCommand):
                  "set correspondent, document and remove correspondents, types"
                  "and tags that do not match anymore due to changed rules."
         )
+        parser.add_argument(
+            "-p", "--processes",
+            default=1,
+            type=int,
+            help="Number of processes that classify documents in parallel."
+        )
+        parser.add_argument(
+            "--no-progress-bar",
+            default=False,
+            action="store_true",
+            help="If set, the progress bar will not be shown."
+        )
 
     def handle(self, *args, **options):
 
@@ -68,38 +246,61 @@ class Command(Renderable, BaseCommand):
             queryset = Document.objects.filter(tags__is_inbox_tag=True)
         else:
             queryset = Document.objects.all()
-        documents = queryset.distinct()
+        # Documents are modified while we go through them, so don't keep a
+        # cursor open, but fetch them by id in batches.
+        document_ids = list(
+            queryset.distinct().order_by("id").values_list("id", flat=True))
+
+        processes = max(options["processes"], 1)
+        batch_size = max(min(
+            BATCH_SIZE, math.ceil(len(document_ids) / processes)), 1)
+        batches = [document_ids[i:i + batch_size]
+                   for i in range(0, len(document_ids), batch_size)]
+
+        classify = partial(classify_documents, options={
+            key: options[key] for key in ("correspondent",
+                                          "document_type",
+                                          "tags",
+                                          "overwrite",
+                                          "use_first")
+        })
+
+        start = time.perf_counter()
+        changed_ids = set()
 
-        classifier = DocumentClassifier()
         try:
-            classifier.reload()
-        except (FileNotFoundError, IncompatibleClassifierVersionError) as e:
-            logging.getLogger(__name__).warning(
-                f"Cannot classify documents: {e}.")
-            classifier = None
-
-        for document in documents:
-            logging.getLogger(__name__).info(
-                f"Processing document {document.title}")
-
-            if options['correspondent']:
-                set_correspondent(
-                    sender=None,
-                    document=document,
-                    classifier=classifier,
-                    replace=options['overwrite'],
-                    use_first=options['use_first'])
-
-            if options['document_type']:
-                set_document_type(sender=None,
-                                  document=document,
-                                  classifier=classifier,
-                                  replace=options['overwrite'],
-                                  use_first=options['use_first'])
-
-            if options['tags']:
-                set_tags(
-                    sender=None,
-                    document=document,
-                    classifier=classifier,
-                    replace=options['overwrite'])
+            if processes > 1:
+                # Note to future self: this prevents django from reusing
+                # database conncetions between processes, which is bad and
+                # does not work with postgres.
+                db.connections.close_all()
+
+                with multiprocessing.Pool(processes=processes) as pool:
+                    self._retag(pool.imap_unordered(classify, batches),
+                                len(document_ids), changed_ids, options)
+            else:
+                self._retag(map(classify, batches),
+                            len(document_ids), changed_ids, options)
+        except KeyboardInterrupt:
+            print("Aborting...")
+
+        # Renaming files and updating the index happens only once for each
+        # document, after everything else is done.
+        if changed_ids:
+            update_files_and_index(changed_ids)
+
+        duration = time.perf_counter() - start
+        if self.verbosity > 0:
+            self.stdout.write(
+                f"Processed {len(document_ids)} documents and changed "
+                f"{len(changed_ids)} of them in {duration:.1f} seconds "
+                f"({len(document_ids) / max(duration, 1e-6):.1f} "
+                f"documents/s).")
+
+    def _retag(self, results, total, changed_ids, options):
+        with tqdm.tqdm(total=total,
+                       disable=options["no_progress_bar"]) as progress_bar:
+            for count, assignments in results:
+                apply_assignments(assignments)
+                changed_ids.update(a.document_id for a in assignments)
+                progress_bar.update(count)
@@ -1,103 +1,597 @@
+import atexit
+import logging
+import math
+import os
 import re
+import signal
+import threading
+import time
+from collections import namedtuple, defaultdict
+from contextlib import contextmanager
 
+import Levenshtein
+import numpy
+from django.conf import settings
 from fuzzywuzzy import fuzz
 
+from documents.file_handling import locked_json_file
 from documents.models import MatchingModel, Correspondent, DocumentType, Tag
 
 
-def match_correspondents(document_content, classifier):
-    if classifier:
-        pred_id = classifier.predict_correspondent(document_content)
+logger = logging.getLogger(__name__)
+
+
+def match_correspondents(document_content, classifier, correspondents=None,
+                         prediction=None):
+    if prediction is None and classifier:
+        prediction = classifier.predict_all(document_content)
+    if prediction:
+        pred_id = prediction.correspondent
     else:
         pred_id = None
 
-    correspondents = Correspondent.objects.all()
+    if correspondents is None:
+        correspondents = Correspondent.objects.all()
+    text = prepare_text(document_content)
 
-    return list(filter(
-        lambda o: matches(o, document_content) or o.pk == pred_id,
+    matched = list(filter(
+        lambda o: matches(o, text) or o.pk == pred_id,
         correspondents))
+    _matching_stats.flush(force=False)
+    return matched
 
 
-def match_document_types(document_content, classifier):
-    if classifier:
-        pred_id = classifier.predict_document_type(document_content)
+def match_document_types(document_content, classifier, document_types=None,
+                         prediction=None):
+    if prediction is None and classifier:
+        prediction = classifier.predict_all(document_content)
+    if prediction:
+        pred_id = prediction.document_type
     else:
         pred_id = None
 
-    document_types = DocumentType.objects.all()
+    if document_types is None:
+        document_types = DocumentType.objects.all()
+    text = prepare_text(document_content)
 
-    return list(filter(
-        lambda o: matches(o, document_content) or o.pk == pred_id,
+    matched = list(filter(
+        lambda o: matches(o, text) or o.pk == pred_id,
         document_types))
+    _matching_stats.flush(force=False)
+    return matched
 
 
-def match_tags(document_content, classifier):
-    if classifier:
-        predicted_tag_ids = classifier.predict_tags(document_content)
+def match_tags(document_content, classifier, tags=None, prediction=None):
+    if prediction is None and classifier:
+        prediction = classifier.predict_all(document_content)
+    if prediction:
+        predicted_tag_ids = prediction.tags
     else:
         predicted_tag_ids = []
 
-    tags = Tag.objects.all()
+    if tags is None:
+        tags = Tag.objects.all()
+    text = prepare_text(document_content)
 
-    return list(filter(
-        lambda o: matches(o, document_content) or o.pk in predicted_tag_ids,
+    matched = list(filter(
+        lambda o: matches(o, text) or o.pk in predicted_tag_ids,
         tags))
+    _matching_stats.flush(force=False)
+    return matched
+
+
+# Keywords consisting of these characters only can be looked up in the set of
+# words of a document instead of searching the document for them.
+_PLAIN_WORD = re.compile(r"[A-Za-z0-9_]+")
+
+_WORDS = re.compile(r"\w+")
+
+# Characters that case insensitive regular expressions consider equal to
+# ASCII letters, even though they are not lowercase versions of them.
+_CASE_INSENSITIVE_EQUIVALENTS = str.maketrans({"ı": "i", "ſ": "s"})
+
+
+class MatchText(object):
+    """
+    The content of a document, prepared once for matching it against any
+    number of matching models.
+    """
+
+    def __init__(self, document_content):
+        self.original = document_content
+        self.content = document_content.lower()
+        self._words = None
+        self._words_insensitive = None
+        self._fuzzy_content = None
+        self._qgrams = None
+
+    def words(self, insensitive):
+        """
+        Returns the set of all words of the content. A keyword made of ASCII
+        word characters matches the content if and only if it is part of
+        this set.
+        """
+        if self._words is None:
+            self._words = set(_WORDS.findall(self.content))
+            self._words_insensitive = set(_WORDS.findall(
+                self.content.translate(_CASE_INSENSITIVE_EQUIVALENTS)))
+        return self._words_insensitive if insensitive else self._words
+
+    def fuzzy_content(self):
+        """
+        The content without punctuation, which fuzzy matching ignores.
+        """
+        if self._fuzzy_content is None:
+            self._fuzzy_content = _strip_punctuation(self.content)
+        return self._fuzzy_content
+
+    def qgrams(self):
+        """
+        Returns an index of all q-grams of the fuzzy content: their sorted
+        keys and the positions at which they occur.
+        """
+        if self._qgrams is None:
+            keys = _qgram_keys(self.fuzzy_content())
+            positions = numpy.argsort(keys, kind="stable")
+            self._qgrams = keys[positions], positions
+        return self._qgrams
+
+
+_last_text = None
+
+
+def prepare_text(document_content):
+    global _last_text
+    if isinstance(document_content, MatchText):
+        return document_content
+    # The same document is usually matched against correspondents, document
+    # types and tags right after each other.
+    text = _last_text
+    if text is None or text.original != document_content:
+        text = MatchText(document_content)
+        _last_text = text
+    return text
+
+
+# Separators of words in phrases, as produced by _split_match().
+_PHRASE_SEPARATOR = re.compile(r" |\\s\+")
+
+
+class _Keyword(object):
+
+    def __init__(self, word, flags):
+        self.flags = flags
+        if _PLAIN_WORD.fullmatch(word):
+            self.word = word.lower() if flags else word
+            self.pattern = None
+        else:
+            self.word = None
+            self.pattern = rf"\b{word}\b"
+            # A phrase can only match if the content contains all its words,
+            # which is a lot cheaper to check than searching for the phrase.
+            parts = _PHRASE_SEPARATOR.split(word)
+            if all(_PLAIN_WORD.fullmatch(part) for part in parts):
+                self.required_words = [
+                    part.lower() if flags else part for part in parts]
+            else:
+                self.required_words = []
+        self._compiled = None
+
+    def search(self, text):
+        words = text.words(bool(self.flags))
+        if self.word is not None:
+            return self.word in words
+        if not all(word in words for word in self.required_words):
+            return False
+        if self._compiled is None:
+            self._compiled = re.compile(self.pattern, self.flags)
+        # Keywords are regular expressions as well.
+        with _time_limit(settings.MATCH_REGEX_TIMEOUT):
+            return bool(self._compiled.search(text.content))
+
+
+class CompiledRule(object):
+    """
+    The match of a matching model, compiled for matching it against many
+    documents.
+    """
+
+    def __init__(self, matching_algorithm, match, is_insensitive):
+        self.matching_algorithm = matching_algorithm
+        self.match = match
+        self.is_insensitive = is_insensitive
+        self.flags = re.IGNORECASE if is_insensitive else 0
+        self._keywords = None
+        self._regex = None
+
+    def keywords(self):
+        if self._keywords is None:
+            if self.matching_algorithm == MatchingModel.MATCH_LITERAL:
+                words = [self.match]
+            else:
+                words = _split_match(self)
+            self._keywords = [_Keyword(word, self.flags) for word in words]
+        return self._keywords
+
+    def matches(self, text):
+        # Check that match is not empty
+        if self.match.strip() == "":
+            return False
+
+        if self.matching_algorithm == MatchingModel.MATCH_ALL:
+            return all(k.search(text) for k in self.keywords())
+
+        elif self.matching_algorithm == MatchingModel.MATCH_ANY:
+            return any(k.search(text) for k in self.keywords())
+
+        elif self.matching_algorithm == MatchingModel.MATCH_LITERAL:
+            return self.keywords()[0].search(text)
+
+        elif self.matching_algorithm == MatchingModel.MATCH_REGEX:
+            if self._regex is None:
+                self._regex = re.compile(self.match, self.flags)
+            with _time_limit(settings.MATCH_REGEX_TIMEOUT):
+                return bool(self._regex.search(text.content))
+
+        elif self.matching_algorithm == MatchingModel.MATCH_FUZZY:
+            match = _strip_punctuation(self.match)
+            if self.is_insensitive:
+                match = match.lower()
+
+            return fuzzy_matches(
+                match, text, settings.MATCH_FUZZY_THRESHOLD)
+
+        elif self.matching_algorithm == MatchingModel.MATCH_AUTO:
+            # this is done elsewhere.
+            return False
+
+        else:
+            raise NotImplementedError("Unsupported matching algorithm")
+
+
+class _RuleCache(object):
+    """
+    Compiled rules of this process, keyed by everything that affects
+    matching. Changed matching models therefore never use outdated rules,
+    even if they were changed by another process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules = {}
+
+    def get(self, matching_model):
+        key = (matching_model.matching_algorithm,
+               matching_model.match,
+               matching_model.is_insensitive)
+        rule = self.rules.get(key)
+        if rule is None:
+            rule = CompiledRule(*key)
+            with self.lock:
+                self.rules[key] = rule
+        return rule
+
+    def clear(self):
+        with self.lock:
+            self.rules = {}
+
+
+_rule_cache = _RuleCache()
+
+
+def compile_rule(matching_model):
+    return _rule_cache.get(matching_model)
+
+
+def clear_rule_cache():
+    """
+    Removes all compiled rules of this process. Called whenever matching
+    models change, so that rules that are no longer in use don't pile up.
+    """
+    _rule_cache.clear()
+
+
+class MatchingTimeout(Exception):
+    pass
+
+
+@contextmanager
+def _time_limit(seconds):
+    """
+    Raises MatchingTimeout in the enclosed block after the given number of
+    seconds. Regular expression searches check for signals regularly, so that
+    this interrupts even searches that backtrack forever. Signals are only
+    received by the main thread, elsewhere this does nothing.
+    """
+    in_main_thread = threading.current_thread() is threading.main_thread()
+    if not seconds or not in_main_thread:
+        yield
+        return
+
+    active = True
+
+    def timeout(signum, frame):
+        if active:
+            raise MatchingTimeout()
+
+    start = time.monotonic()
+    previous_handler = signal.signal(signal.SIGALRM, timeout)
+    previous_timer, interval = signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        active = False
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+        if previous_timer:
+            # Someone else was waiting for the alarm as well.
+            remaining = previous_timer - (time.monotonic() - start)
+            signal.setitimer(
+                signal.ITIMER_REAL, max(remaining, 0.001), interval)
+
+
+class _MatchingStats(object):
+    """
+    Records how much time each matching rule takes. The numbers of all
+    processes are added up in a file in the data directory.
+    """
+
+    # Write the numbers to disk at most this often, in seconds.
+    FLUSH_INTERVAL = 10
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.costs = {}
+        self.last_flush = 0
+
+    @staticmethod
+    def _stats_file():
+        return os.path.join(settings.DATA_DIR, "matching_stats.json")
+
+    def record(self, matching_model, duration, timed_out=False):
+        if matching_model.pk is None:
+            return
+        key = f"{matching_model._meta.model_name}:{matching_model.pk}"
+        with self.lock:
+            cost = self.costs.setdefault(key, [0, 0.0, 0.0, 0])
+            cost[0] += 1
+            cost[1] += duration
+            cost[2] = max(cost[2], duration)
+            cost[3] += int(timed_out)
+
+    def flush(self, force=True):
+        with self.lock:
+            if not force and (
+                    time.monotonic() - self.last_flush < self.FLUSH_INTERVAL):
+                return
+            costs, self.costs = self.costs, {}
+            self.last_flush = time.monotonic()
+
+        if not costs or not os.path.isdir(settings.DATA_DIR):
+            return
+
+        try:
+            with locked_json_file(self._stats_file(), write=True) as stats:
+                for key, (calls, total, maximum, timeouts) in costs.items():
+                    cost = stats.setdefault(key, [0, 0.0, 0.0, 0])
+                    cost[0] += calls
+                    cost[1] += total
+                    cost[2] = max(cost[2], maximum)
+                    cost[3] += timeouts
+        except OSError as e:
+            logger.warning(f"Cannot update matching statistics: {e}")
+
+    def read(self):
+        self.flush()
+        try:
+            with locked_json_file(self._stats_file()) as stats:
+                return stats
+        except FileNotFoundError:
+            return {}
+
+    def reset(self):
+        with self.lock:
+            self.costs = {}
+        try:
+            os.remove(self._stats_file())
+        except FileNotFoundError:
+            pass
+
+
+_matching_stats = _MatchingStats()
+
+atexit.register(_matching_stats.flush)
+
+
+RuleCost = namedtuple(
+    "RuleCost",
+    ["matching_model", "calls", "total_time", "max_time", "timeouts"])
+
+
+def get_rule_costs():
+    """
+    Returns the recorded costs of all existing matching rules, most expensive
+    first.
+    """
+    models = {model._meta.model_name: model
+              for model in (Correspondent, DocumentType, Tag)}
+
+    costs = defaultdict(dict)
+    for key, cost in _matching_stats.read().items():
+        model_name, pk = key.split(":")
+        if model_name in models:
+            costs[model_name][int(pk)] = cost
+
+    result = []
+    for model_name, model_costs in costs.items():
+        for matching_model in models[model_name].objects.filter(
+                pk__in=model_costs.keys()):
+            result.append(RuleCost(
+                matching_model, *model_costs[matching_model.pk]))
+
+    return sorted(result, key=lambda c: c.total_time, reverse=True)
+
+
+def reset_rule_costs():
+    _matching_stats.reset()
+
+
+def flush_rule_costs():
+    # Processes that don't exit normally, such as pool workers, need to do
+    # this themselves.
+    _matching_stats.flush()
 
 
 def matches(matching_model, document_content):
-    search_kwargs = {}
+    """
+    Returns whether the matching model matches the content, which is either
+    a string or a MatchText prepared with prepare_text().
+    """
+    rule = compile_rule(matching_model)
+    start = time.perf_counter()
+    timed_out = False
+    try:
+        result = rule.matches(prepare_text(document_content))
+    except MatchingTimeout:
+        logger.warning(
+            f"Matching {matching_model} took longer than "
+            f"{settings.MATCH_REGEX_TIMEOUT} seconds and was aborted. "
+            f"Consider simplifying its regular expression."
+        )
+        timed_out = True
+        result = False
+    _matching_stats.record(
+        matching_model, time.perf_counter() - start, timed_out)
+    return result
 
-    document_content = document_content.lower()
 
-    # Check that match is not empty
-    if matching_model.match.strip() == "":
-        return False
+def _strip_punctuation(text):
+    return re.sub(r'[^\w\s]', '', text)
 
-    if matching_model.is_insensitive:
-        search_kwargs = {"flags": re.IGNORECASE}
-
-    if matching_model.matching_algorithm == MatchingModel.MATCH_ALL:
-        for word in _split_match(matching_model):
-            search_result = re.search(
-                rf"\b{word}\b", document_content, **search_kwargs)
-            if not search_result:
-                return False
-        return True
-
-    elif matching_model.matching_algorithm == MatchingModel.MATCH_ANY:
-        for word in _split_match(matching_model):
-            if re.search(rf"\b{word}\b", document_content, **search_kwargs):
-                return True
-        return False
 
-    elif matching_model.matching_algorithm == MatchingModel.MATCH_LITERAL:
-        return bool(re.search(
-            rf"\b{matching_model.match}\b",
-            document_content,
-            **search_kwargs
-        ))
-
-    elif matching_model.matching_algorithm == MatchingModel.MATCH_REGEX:
-        return bool(re.search(
-            re.compile(matching_model.match, **search_kwargs),
-            document_content
-        ))
-
-    elif matching_model.matching_algorithm == MatchingModel.MATCH_FUZZY:
-        match = re.sub(r'[^\w\s]', '', matching_model.match)
-        text = re.sub(r'[^\w\s]', '', document_content)
-        if matching_model.is_insensitive:
-            match = match.lower()
-            text = text.lower()
-
-        return fuzz.partial_ratio(match, text) >= 90
-
-    elif matching_model.matching_algorithm == MatchingModel.MATCH_AUTO:
-        # this is done elsewhere.
+# Length of the substrings that are used to find candidates for fuzzy
+# matches in the content of documents.
+FUZZY_Q = 2
+
+
+def _longest_common_subsequence(a, b):
+    # The ratio of Levenshtein is based on the number of insertions and
+    # deletions, which is len(a) + len(b) - 2 * lcs.
+    return round(Levenshtein.ratio(a, b) * (len(a) + len(b)) / 2)
+
+
+def _qgram_keys(text):
+    # Every character fits into 21 bits, so that each q-gram can be
+    # represented by a single number.
+    codes = numpy.frombuffer(
+        text.encode("utf-32-le"), dtype=numpy.uint32).astype(numpy.uint64)
+    count = max(len(codes) - FUZZY_Q + 1, 0)
+    keys = numpy.zeros(count, dtype=numpy.uint64)
+    for i in range(FUZZY_Q):
+        keys = (keys << numpy.uint64(21)) | codes[i:i + count]
+    return keys
+
+
+def _fuzzy_candidates(match, text, common):
+    """
+    Returns ranges of start positions of all substrings of the fuzzy content
+    of the text that are at most as long as the match and might have the
+    given number of characters in common with it.
+
+    Common characters are arranged in a limited number of blocks, so the
+    match and such a substring share a minimum number of q-grams, which
+    occur at nearly the same offsets in both. Returns None if that number is
+    too small to narrow anything down.
+    """
+    different = len(match) - common
+    blocks = 2 * different + 1
+    required_qgrams = common - blocks * (FUZZY_Q - 1)
+
+    if required_qgrams <= 0:
+        return None
+
+    keys, positions = text.qgrams()
+    match_keys = _qgram_keys(match)
+    lower = numpy.searchsorted(keys, match_keys, side="left")
+    upper = numpy.searchsorted(keys, match_keys, side="right")
+
+    # Where the match would start if the q-grams were common characters.
+    starts = numpy.concatenate([positions[lo:hi] - offset for offset, (lo, hi)
+                                in enumerate(zip(lower, upper))])
+    starts.sort()
+
+    # Offsets of common characters differ by at most the number of
+    # different characters.
+    hits = (numpy.searchsorted(starts, starts + 2 * different, side="right") -
+            numpy.arange(len(starts)))
+    starts = starts[hits >= required_qgrams]
+
+    # Each of these allows substrings starting up to the number of different
+    # characters before or after it. Join ranges that overlap.
+    if not len(starts):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(starts) > blocks)
+    firsts = starts[numpy.concatenate(([0], breaks + 1))] - different
+    lasts = starts[numpy.concatenate((breaks, [-1]))] + different
+    return list(zip(numpy.maximum(firsts, 0).tolist(), lasts.tolist()))
+
+
+def fuzzy_matches(match, text, threshold):
+    """
+    Returns whether fuzz.partial_ratio() of the match and the content without
+    punctuation is at least the threshold.
+
+    Most documents don't contain anything similar to the match. Instead of
+    aligning the match with the entire content of these, the parts of the
+    content that share enough q-grams with the match are looked up in the
+    q-gram index of the text, which is built once per document. If there
+    are none, no part of the content is similar enough. Otherwise,
+    partial_ratio() decides.
+    """
+    content = text.fuzzy_content()
+    length = len(match)
+
+    if len(content) < length + FUZZY_Q:
+        return fuzz.partial_ratio(match, content) >= threshold
+
+    # The least number of common characters for a ratio of at least the
+    # threshold, for any substring at most as long as the match.
+    ratio = (threshold - 0.5) / 100
+    common = min(length, math.ceil(ratio * length / (2 - ratio)))
+
+    candidates = _fuzzy_candidates(match, text, common)
+    if candidates is None:
+        return fuzz.partial_ratio(match, content) >= threshold
+
+    # No substring of a part of the content has more characters in common
+    # with the match than the entire part.
+    if not any(_longest_common_subsequence(
+            match, content[first:min(last, len(content) - 1) + length]) >=
+            common for first, last in candidates):
         return False
 
+    return fuzz.partial_ratio(match, content) >= threshold
+
+
+def plain_keywords(matching_model):
+    """
+    Returns the words of each keyword of a rule with the any, all or literal
+    matching algorithm. Keywords that are regular expressions other than
+    words and phrases are returned as None.
+    """
+    if matching_model.matching_algorithm == MatchingModel.MATCH_LITERAL:
+        keywords = [matching_model.match]
     else:
-        raise NotImplementedError("Unsupported matching algorithm")
+        keywords = _split_match(matching_model)
+
+    result = []
+    for keyword in keywords:
+        words = _PHRASE_SEPARATOR.split(keyword)
+        if all(_PLAIN_WORD.fullmatch(word) for word in words):
+            result.append([word.lower() for word in words])
+        else:
+            result.append(None)
+    return result
 
 
 def _split_match(matching_model):
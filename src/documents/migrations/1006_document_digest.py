@@ -0,0 +1,23 @@
+# Generated by Django 3.1.3 on 2020-12-02 21:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '1005_checksums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='archive_digest',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Additional digest of the archived document, prefixed with the name of the hash algorithm.', max_length=160, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='digest',
+            field=models.CharField(blank=True, db_index=True, editable=False, help_text='Additional digest of the original document, prefixed with the name of the hash algorithm.', max_length=160, null=True),
+        ),
+    ]
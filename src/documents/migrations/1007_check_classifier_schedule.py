@@ -0,0 +1,26 @@
+# Generated by Django 3.1.3 on 2020-12-03 12:10
+
+from django.db import migrations
+from django.db.migrations import RunPython
+from django_q.models import Schedule
+from django_q.tasks import schedule
+
+
+def add_schedules(apps, schema_editor):
+    schedule('documents.tasks.check_classifier', name="Verify the classifier training data", schedule_type=Schedule.DAILY)
+
+
+def remove_schedules(apps, schema_editor):
+    Schedule.objects.filter(func='documents.tasks.check_classifier').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '1006_document_digest'),
+        ('django_q', '0013_task_attempt_count'),
+    ]
+
+    operations = [
+        RunPython(add_schedules, remove_schedules)
+    ]
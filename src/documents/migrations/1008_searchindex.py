@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.db import migrations
+from django.db.migrations import RunPython
+
+
+# The tables of the database search backend. They are only created here if
+# that backend is configured, and otherwise when documents are indexed with
+# it for the first time. They are empty until the documents are indexed with
+# "document_index backfill".
+
+def create_search_index(apps, schema_editor):
+    if settings.SEARCH_BACKEND != "database":
+        return
+
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            if not cursor.fetchone()[0]:
+                # Reported by the checks of the documents app.
+                return
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS documents_searchindex "
+            "USING fts5(title, content, correspondent, tag, type)")
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS documents_searchindex_terms "
+            "USING fts5vocab(documents_searchindex, col)")
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE TABLE IF NOT EXISTS documents_searchindex ("
+            "document_id integer PRIMARY KEY "
+            "REFERENCES documents_document (id) "
+            "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "vector tsvector NOT NULL)")
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS documents_searchindex_vector "
+            "ON documents_searchindex USING GIN (vector)")
+
+
+def remove_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            "DROP TABLE IF EXISTS documents_searchindex_terms")
+        schema_editor.execute("DROP TABLE IF EXISTS documents_searchindex")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP TABLE IF EXISTS documents_searchindex")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '1007_check_classifier_schedule'),
+    ]
+
+    operations = [
+        RunPython(create_search_index, remove_search_index)
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations
+from django.db.migrations import RunPython
+from django_q.models import Schedule
+from django_q.tasks import schedule
+
+
+# The index has new fields for the filters of searches. Existing documents
+# are reindexed once in the background.
+
+def add_schedules(apps, schema_editor):
+    schedule('documents.tasks.index_reindex', name="Reindex documents for search filters", schedule_type=Schedule.ONCE)
+
+
+def remove_schedules(apps, schema_editor):
+    Schedule.objects.filter(func='documents.tasks.index_reindex').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '1008_searchindex'),
+        ('django_q', '0013_task_attempt_count'),
+    ]
+
+    operations = [
+        RunPython(add_schedules, remove_schedules)
+    ]
@@ -170,6 +170,26 @@ class Document(models.Model):
         help_text="The checksum of the archived document."
     )
 
+    digest = models.CharField(
+        max_length=160,
+        editable=False,
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="Additional digest of the original document, prefixed "
+                  "with the name of the hash algorithm."
+    )
+
+    archive_digest = models.CharField(
+        max_length=160,
+        editable=False,
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="Additional digest of the archived document, prefixed "
+                  "with the name of the hash algorithm."
+    )
+
     created = models.DateTimeField(
         default=timezone.now, db_index=True)
     modified = models.DateTimeField(
@@ -1,8 +1,8 @@
-import hashlib
 import os
 
 from django.conf import settings
 
+from documents.file_handling import calculate_digest
 from documents.models import Document
 
 
@@ -69,8 +69,7 @@ def check_sanity():
         else:
             present_files.remove(os.path.normpath(doc.source_path))
             try:
-                with doc.source_file as f:
-                    checksum = hashlib.md5(f.read()).hexdigest()
+                checksum = calculate_digest(doc.source_path).checksum
             except OSError as e:
                 messages.append(SanityError(
                     f"Cannot read original file of document {doc.pk}: {e}"))
@@ -90,8 +89,7 @@ def check_sanity():
             else:
                 present_files.remove(os.path.normpath(doc.archive_path))
                 try:
-                    with doc.archive_file as f:
-                        checksum = hashlib.md5(f.read()).hexdigest()
+                    checksum = calculate_digest(doc.archive_path).checksum
                 except OSError as e:
                     messages.append(SanityError(
                         f"Cannot read archive file of document {doc.pk}: {e}"
@@ -0,0 +1,673 @@
+import datetime
+import math
+import re
+from heapq import nlargest
+
+import tqdm
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from whoosh import highlight
+from whoosh.analysis import StandardAnalyzer
+from whoosh.writing import AsyncWriter
+
+from documents import index, matching
+from documents.models import Document, MatchingModel
+
+
+# Number of documents that are fetched from the database at once while
+# indexing many documents.
+BATCH_SIZE = 1000
+
+
+def document_batches(document_ids, batch_size=BATCH_SIZE):
+    """
+    Yields the given documents in batches, along with everything that is
+    needed to index them.
+    """
+    document_ids = sorted(document_ids)
+    for i in range(0, len(document_ids), batch_size):
+        yield list(Document.objects.filter(
+            id__in=document_ids[i:i + batch_size]
+        ).select_related(
+            "correspondent", "document_type"
+        ).prefetch_related("tags").order_by("id"))
+
+
+def _ids(value):
+    return [int(x) for x in value.split(",")]
+
+
+def _date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _boolean(value):
+    if value not in ("true", "false"):
+        raise ValueError(f"{value} is not a boolean")
+    return value == "true"
+
+
+# Filters of the document list that searches support, and how their values
+# are parsed.
+SEARCH_FILTERS = {
+    "tags__id__all": _ids,
+    "tags__id__none": _ids,
+    "tags__id": _ids,
+    "tags__id__in": _ids,
+    "correspondent__id": _ids,
+    "correspondent__id__in": _ids,
+    "document_type__id": _ids,
+    "document_type__id__in": _ids,
+    "created__date__gt": _date,
+    "created__date__lt": _date,
+    "is_in_inbox": _boolean,
+}
+
+
+def parse_filters(params):
+    """
+    Returns the filters in the query parameters that searches support, with
+    their parsed values. Raises ValueError for invalid values.
+    """
+    return {name: parse(params[name])
+            for name, parse in SEARCH_FILTERS.items()
+            if params.get(name)}
+
+
+def filter_documents(filters, queryset=None):
+    """
+    Applies the parsed filters to the documents, the same way the document
+    list does.
+    """
+    from documents.filters import filter_all_tags, exclude_tags
+
+    if queryset is None:
+        queryset = Document.objects.all()
+    for name, value in filters.items():
+        if name == "tags__id__all":
+            queryset = filter_all_tags(queryset, value)
+        elif name == "tags__id__none":
+            queryset = exclude_tags(queryset, value)
+        elif name == "is_in_inbox":
+            if value:
+                queryset = queryset.filter(tags__is_inbox_tag=True)
+            else:
+                queryset = queryset.exclude(tags__is_inbox_tag=True)
+        elif name.endswith("__id"):
+            queryset = queryset.filter(**{f"{name}__in": value})
+        else:
+            queryset = queryset.filter(**{name: value})
+    return queryset
+
+
+class SearchBackend(object):
+    """
+    Keeps documents searchable. Changes to single documents, which happen
+    all the time, go through queue_update() and queue_removal(), while
+    update_documents() and remove_documents() change many documents at once.
+    """
+
+    def queue_update(self, document):
+        self.update_documents([document])
+
+    def queue_removal(self, document):
+        self.remove_documents([document.pk])
+
+    def update_documents(self, documents):
+        """
+        Adds or updates the documents, which should come with their
+        correspondent, document type and tags.
+        """
+        raise NotImplementedError()
+
+    def remove_documents(self, document_ids):
+        raise NotImplementedError()
+
+    def flush(self):
+        """
+        Commits the changes queued with queue_update() and queue_removal().
+        Processes that exit right after queueing changes, such as pool
+        workers, can't do that themselves.
+        """
+        pass
+
+    def indexed_document_ids(self):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def optimize(self):
+        pass
+
+    def search(self, querystring, page, filters=None):
+        """
+        Returns index.SearchResults with the given page of documents that
+        match the query and the filters, see parse_filters().
+        """
+        raise NotImplementedError()
+
+    def autocomplete(self, term, limit=10):
+        raise NotImplementedError()
+
+    def matching_document_ids(self, matching_model):
+        """
+        Returns the ids of at least all documents that the rule of the
+        matching model matches, or None if they cannot be looked up.
+        """
+        raise NotImplementedError()
+
+    def _index(self, document_ids, progress_bar_disable):
+        with tqdm.tqdm(total=len(document_ids),
+                       disable=progress_bar_disable) as progress_bar:
+            for documents in document_batches(document_ids):
+                self.update_documents(documents)
+                progress_bar.update(len(documents))
+
+    def reindex(self, processes=1, progress_bar_disable=True):
+        """
+        Recreates the index from scratch and returns the number of indexed
+        documents.
+        """
+        document_ids = list(
+            Document.objects.order_by("id").values_list("id", flat=True))
+        self.clear()
+        self._index(document_ids, progress_bar_disable)
+        return len(document_ids)
+
+    def backfill(self, progress_bar_disable=True):
+        """
+        Indexes all documents that are missing from the index and removes
+        those that don't exist anymore. Returns the number of added
+        documents.
+        """
+        document_ids = set(Document.objects.values_list("id", flat=True))
+        indexed = set(self.indexed_document_ids())
+
+        if indexed - document_ids:
+            self.remove_documents(sorted(indexed - document_ids))
+
+        missing = sorted(document_ids - indexed)
+        self._index(missing, progress_bar_disable)
+        return len(missing)
+
+
+class WhooshBackend(SearchBackend):
+    """
+    The Whoosh index in INDEX_DIR. Changes to single documents are queued
+    and committed in batches.
+    """
+
+    def queue_update(self, document):
+        index.queue_update(document)
+
+    def queue_removal(self, document):
+        index.queue_removal(document)
+
+    def update_documents(self, documents):
+        with AsyncWriter(index.open_index()) as writer:
+            for document in documents:
+                index.update_document(writer, document)
+
+    def remove_documents(self, document_ids):
+        with AsyncWriter(index.open_index()) as writer:
+            for document_id in document_ids:
+                writer.delete_by_term("id", document_id)
+
+    def indexed_document_ids(self):
+        with index.open_index().searcher() as searcher:
+            return [fields["id"]
+                    for fields in searcher.reader().all_stored_fields()]
+
+    def clear(self):
+        index.open_index(recreate=True)
+
+    def flush(self):
+        index.flush_queue()
+
+    def optimize(self):
+        self.flush()
+        writer = AsyncWriter(index.open_index())
+        writer.commit(optimize=True)
+
+    def reindex(self, processes=1, progress_bar_disable=True):
+        # With more than one process, documents are indexed into separate
+        # segments in parallel, which are not merged afterwards.
+        document_ids = list(
+            Document.objects.order_by("id").values_list("id", flat=True))
+
+        ix = index.open_index(recreate=True)
+
+        # Other processes may be committing queued changes.
+        if processes > 1:
+            writer = ix.writer(procs=processes, multisegment=True,
+                               timeout=index.INDEX_LOCK_TIMEOUT)
+        else:
+            writer = ix.writer(timeout=index.INDEX_LOCK_TIMEOUT)
+
+        with writer, tqdm.tqdm(total=len(document_ids),
+                               disable=progress_bar_disable) as progress_bar:
+            for documents in document_batches(document_ids):
+                for document in documents:
+                    index.add_document(writer, document)
+                progress_bar.update(len(documents))
+
+        return len(document_ids)
+
+    def search(self, querystring, page, filters=None):
+        return index.search(querystring, page, filters)
+
+    def autocomplete(self, term, limit=10):
+        return index.autocomplete(term, limit)
+
+    def matching_document_ids(self, matching_model):
+        with index.open_index().searcher() as searcher:
+            q = index.matching_query(searcher, matching_model)
+            if q is None:
+                return None
+            return index.search_document_ids(searcher, q)
+
+
+# The database backends split text into words at everything that is not a
+# letter or a digit, and compare them in lower case.
+_WORDS = re.compile(r"[^\W_]+")
+
+_QUERY_TERMS = re.compile(r'"([^"]*)"|(\S+)')
+
+_FIELD_PREFIX = re.compile(r"^(content|title|correspondent|tag|type):")
+
+
+def _words(text):
+    return _WORDS.findall(text.lower())
+
+
+def _parse_query(querystring):
+    """
+    Returns the phrases of a query, each a list of words. Quoted phrases and
+    words that contain other characters, such as dates, are kept together.
+    """
+    phrases = []
+    for quoted, term in _QUERY_TERMS.findall(querystring):
+        if quoted:
+            words = _words(quoted)
+        elif term == "AND":
+            continue
+        else:
+            words = _words(_FIELD_PREFIX.sub("", term))
+        if words:
+            phrases.append(words)
+    return phrases
+
+
+_highlight_analyzer = StandardAnalyzer()
+
+
+def _highlights(text, words, formatter):
+    fragmenter = highlight.ContextFragmenter(
+        surround=50, charlimit=index.HIGHLIGHT_CHARS)
+    return highlight.highlight(
+        text, words, _highlight_analyzer, fragmenter, formatter)
+
+
+class DatabaseBackend(SearchBackend):
+    """
+    Full text search in a table of the database, which is changed in the
+    same transaction as the documents, so that changes are searchable as
+    soon as they are committed. Queries consist of words and quoted phrases,
+    all of which have to be found. Subclasses provide the SQL of each
+    database.
+    """
+
+    # Number of hits on each page of results, the same as with Whoosh.
+    PAGE_LENGTH = 10
+
+    # Statements that create the tables unless they exist.
+    CREATE_SQL = ()
+    IDS_SQL = None
+    CLEAR_SQL = None
+    DELETE_SQL = None
+    # Both take the query and a condition on the ids of the documents.
+    COUNT_SQL = None
+    # Selects the id, title, score and the first characters of the content
+    # of the hits, given the number of characters, the query, the parameters
+    # of the condition, the number of hits and the offset.
+    SEARCH_SQL = None
+    MATCHING_SQL = None
+
+    def _write(self, cursor, documents):
+        raise NotImplementedError()
+
+    def _query(self, phrases):
+        raise NotImplementedError()
+
+    def _matching_query(self, phrases, match_all):
+        raise NotImplementedError()
+
+    def _execute(self, sql, params=None):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall() if cursor.description else None
+
+    def is_available(self):
+        """
+        Returns whether the database supports the full text search.
+        """
+        return True
+
+    def create_tables(self):
+        for sql in self.CREATE_SQL:
+            self._execute(sql)
+
+    def update_documents(self, documents):
+        if not documents:
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            self._write(cursor, documents)
+
+    def remove_documents(self, document_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                self.DELETE_SQL, [(document_id,)
+                                  for document_id in document_ids])
+
+    def indexed_document_ids(self):
+        return [row[0] for row in self._execute(self.IDS_SQL)]
+
+    def clear(self):
+        self._execute(self.CLEAR_SQL)
+
+    # The tables are only created when documents are indexed with this
+    # backend for the first time, see migration 1008.
+
+    def reindex(self, processes=1, progress_bar_disable=True):
+        self.create_tables()
+        return super(DatabaseBackend, self).reindex(
+            processes, progress_bar_disable)
+
+    def backfill(self, progress_bar_disable=True):
+        self.create_tables()
+        return super(DatabaseBackend, self).backfill(progress_bar_disable)
+
+    def search(self, querystring, page, filters=None):
+        phrases = _parse_query(querystring)
+        if not phrases:
+            return index.SearchResults(
+                count=0, page=0, page_count=0, hits=[], corrected_query=None)
+
+        if filters:
+            # The filters become a subquery of the ids of documents.
+            sql, params = filter_documents(filters).values(
+                "id").query.sql_with_params()
+            condition = f"IN ({sql})"
+        else:
+            condition, params = "IS NOT NULL", ()
+
+        q = self._query(phrases)
+        count = self._execute(
+            self.COUNT_SQL.format(condition=condition), [q, *params])[0][0]
+        page_count = math.ceil(count / self.PAGE_LENGTH)
+        page = min(page, page_count)
+        offset = max(page - 1, 0) * self.PAGE_LENGTH
+
+        rows = self._execute(self.SEARCH_SQL.format(condition=condition), [
+            index.HIGHLIGHT_CHARS, q, *params, self.PAGE_LENGTH, offset])
+
+        words = frozenset(word for phrase in phrases for word in phrase)
+        formatter = index.JsonFormatter()
+        return index.SearchResults(
+            count=count,
+            page=page,
+            page_count=page_count,
+            hits=[index.SearchHit(id=document_id,
+                                  title=title,
+                                  score=score,
+                                  rank=offset + i,
+                                  highlights=_highlights(
+                                      text, words, formatter))
+                  for i, (document_id, title, score, text)
+                  in enumerate(rows)],
+            corrected_query=None
+        )
+
+    def matching_document_ids(self, matching_model):
+        algorithm = matching_model.matching_algorithm
+        if algorithm not in (MatchingModel.MATCH_ANY, MatchingModel.MATCH_ALL,
+                             MatchingModel.MATCH_LITERAL):
+            return None
+
+        # Words of keywords are split the same way as the indexed text.
+        phrases = [_words(" ".join(words)) if words else None
+                   for words in matching.plain_keywords(matching_model)]
+
+        if algorithm == MatchingModel.MATCH_ALL:
+            # Other keywords still have to be present.
+            phrases = [phrase for phrase in phrases if phrase]
+            if not phrases:
+                return None
+        elif not all(phrases):
+            return None
+
+        q = self._matching_query(
+            phrases, algorithm == MatchingModel.MATCH_ALL)
+        return [row[0] for row in self._execute(self.MATCHING_SQL, [q])]
+
+
+class SqliteBackend(DatabaseBackend):
+    """
+    An FTS5 table, which stores a copy of the text of each document.
+    """
+
+    CREATE_SQL = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS documents_searchindex USING fts5("
+        "title, content, correspondent, tag, type)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS documents_searchindex_terms "
+        "USING fts5vocab(documents_searchindex, col)")
+
+    IDS_SQL = "SELECT rowid FROM documents_searchindex"
+
+    CLEAR_SQL = "DELETE FROM documents_searchindex"
+
+    DELETE_SQL = "DELETE FROM documents_searchindex WHERE rowid = %s"
+
+    INSERT_SQL = (
+        "INSERT INTO documents_searchindex "
+        "(rowid, title, content, correspondent, tag, type) "
+        "VALUES (%s, %s, %s, %s, %s, %s)")
+
+    # Documents deleted without removing them from the index are left out.
+    COUNT_SQL = (
+        "SELECT count(*) FROM documents_searchindex "
+        "JOIN documents_document "
+        "ON documents_document.id = documents_searchindex.rowid "
+        "WHERE documents_searchindex MATCH %s "
+        "AND documents_document.id {condition}")
+
+    SEARCH_SQL = (
+        "SELECT documents_searchindex.rowid, documents_document.title, "
+        "-bm25(documents_searchindex) AS score, "
+        "substr(documents_document.content, 1, %s) "
+        "FROM documents_searchindex "
+        "JOIN documents_document "
+        "ON documents_document.id = documents_searchindex.rowid "
+        "WHERE documents_searchindex MATCH %s "
+        "AND documents_document.id {condition} "
+        "ORDER BY score DESC, documents_searchindex.rowid "
+        "LIMIT %s OFFSET %s")
+
+    MATCHING_SQL = (
+        "SELECT rowid FROM documents_searchindex "
+        "WHERE documents_searchindex MATCH %s")
+
+    COUNT_DOCUMENTS_SQL = "SELECT count(*) FROM documents_searchindex"
+
+    # Terms of the content column within a range, with the number of
+    # documents that contain them and how often they occur.
+    TERMS_SQL = (
+        "SELECT term, doc, cnt FROM documents_searchindex_terms "
+        "WHERE col = 'content' AND term >= %s AND term < %s")
+
+    def is_available(self):
+        return bool(self._execute(
+            "SELECT sqlite_compileoption_used('ENABLE_FTS5')")[0][0])
+
+    def _write(self, cursor, documents):
+        cursor.executemany(self.DELETE_SQL, [(document.pk,)
+                                             for document in documents])
+        rows = []
+        for document in documents:
+            fields = index._document_fields(document)
+            rows.append((fields["id"], fields["title"], fields["content"],
+                         fields["correspondent"], fields["tag"],
+                         fields["type"]))
+        cursor.executemany(self.INSERT_SQL, rows)
+
+    @staticmethod
+    def _phrase(words):
+        # Words only consist of letters and digits and need no escaping.
+        return '"{}"'.format(" ".join(words))
+
+    def _query(self, phrases):
+        return " AND ".join(self._phrase(words) for words in phrases)
+
+    def _matching_query(self, phrases, match_all):
+        operator = " AND " if match_all else " OR "
+        return "{{content}} : ({})".format(
+            operator.join(self._phrase(words) for words in phrases))
+
+    def optimize(self):
+        self._execute(
+            "INSERT INTO documents_searchindex (documents_searchindex) "
+            "VALUES ('optimize')")
+
+    def autocomplete(self, term, limit=10):
+        words = _words(term)
+        if not words:
+            return []
+        prefix = words[-1]
+
+        documents = self._execute(self.COUNT_DOCUMENTS_SQL)[0][0]
+        # No term is larger than the largest code point.
+        rows = self._execute(self.TERMS_SQL, [prefix, prefix + "\U0010ffff"])
+
+        # The same scores as those of the Whoosh index.
+        return [term for term, doc, cnt in nlargest(
+            limit, rows, key=lambda r: r[2] * math.log(documents / r[1]))]
+
+
+class PostgresBackend(DatabaseBackend):
+    """
+    A table with a tsvector of each document and a GIN index. The title,
+    correspondent, tags and type have a higher weight than the content.
+    """
+
+    CREATE_SQL = (
+        "CREATE TABLE IF NOT EXISTS documents_searchindex ("
+        "document_id integer PRIMARY KEY "
+        "REFERENCES documents_document (id) "
+        "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+        "vector tsvector NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS documents_searchindex_vector "
+        "ON documents_searchindex USING GIN (vector)")
+
+    IDS_SQL = "SELECT document_id FROM documents_searchindex"
+
+    CLEAR_SQL = "DELETE FROM documents_searchindex"
+
+    DELETE_SQL = "DELETE FROM documents_searchindex WHERE document_id = %s"
+
+    UPSERT_SQL = (
+        "INSERT INTO documents_searchindex (document_id, vector) "
+        "VALUES (%s, "
+        "setweight(to_tsvector('simple', "
+        "regexp_replace(%s, '[^[:alnum:]]+', ' ', 'g')), 'A') || "
+        "to_tsvector('simple', "
+        "regexp_replace(%s, '[^[:alnum:]]+', ' ', 'g'))) "
+        "ON CONFLICT (document_id) DO UPDATE SET vector = EXCLUDED.vector")
+
+    COUNT_SQL = (
+        "SELECT count(*) FROM documents_searchindex "
+        "WHERE vector @@ to_tsquery('simple', %s) "
+        "AND document_id {condition}")
+
+    SEARCH_SQL = (
+        "SELECT s.document_id, d.title, ts_rank(s.vector, q.query) AS score, "
+        "substr(d.content, 1, %s) "
+        "FROM documents_searchindex s "
+        "JOIN documents_document d ON d.id = s.document_id "
+        "CROSS JOIN to_tsquery('simple', %s) AS q(query) "
+        "WHERE s.vector @@ q.query AND d.id {condition} "
+        "ORDER BY score DESC, s.document_id "
+        "LIMIT %s OFFSET %s")
+
+    MATCHING_SQL = (
+        "SELECT document_id FROM documents_searchindex "
+        "WHERE vector @@ to_tsquery('simple', %s)")
+
+    # Lexemes of the content of all documents that contain a word with the
+    # prefix, scored the same as the terms of the Whoosh index. Only these
+    # documents are read, with the help of the GIN index.
+    TERMS_SQL = (
+        "SELECT word FROM ts_stat(format("
+        "'SELECT vector FROM documents_searchindex "
+        "WHERE vector @@ to_tsquery(''simple'', %%L)', %s), 'd') "
+        "WHERE word LIKE %s "
+        "ORDER BY nentry * ln("
+        "(SELECT count(*) FROM documents_searchindex)::float / ndoc) DESC, "
+        "word "
+        "LIMIT %s")
+
+    def _write(self, cursor, documents):
+        rows = []
+        for document in documents:
+            fields = index._document_fields(document)
+            metadata = " ".join(fields[name] for name in (
+                "title", "correspondent", "tag", "type") if fields[name])
+            rows.append((fields["id"], metadata, fields["content"]))
+        cursor.executemany(self.UPSERT_SQL, rows)
+
+    @staticmethod
+    def _phrase(words, weight=""):
+        # Words only consist of letters and digits and need no escaping.
+        return "({})".format(
+            " <-> ".join(f"'{word}'{weight}" for word in words))
+
+    def _query(self, phrases):
+        return " & ".join(self._phrase(words) for words in phrases)
+
+    def _matching_query(self, phrases, match_all):
+        # The content has the default weight D.
+        operator = " & " if match_all else " | "
+        return operator.join(self._phrase(words, ":D") for words in phrases)
+
+    def autocomplete(self, term, limit=10):
+        words = _words(term)
+        if not words:
+            return []
+        prefix = words[-1]
+
+        return [row[0] for row in self._execute(
+            self.TERMS_SQL, [f"'{prefix}':*", prefix + "%", limit])]
+
+
+DATABASE_BACKENDS = {
+    "sqlite": SqliteBackend,
+    "postgresql": PostgresBackend,
+}
+
+
+def get_backend():
+    """
+    Returns the search backend selected by PAPERLESS_SEARCH_BACKEND.
+    """
+    if settings.SEARCH_BACKEND == "whoosh":
+        return WhooshBackend()
+    elif settings.SEARCH_BACKEND == "database":
+        if connection.vendor not in DATABASE_BACKENDS:
+            raise ImproperlyConfigured(
+                f"The database search backend does not support "
+                f"{connection.vendor}.")
+        return DATABASE_BACKENDS[connection.vendor]()
+    else:
+        raise ImproperlyConfigured(
+            f"Unknown search backend {settings.SEARCH_BACKEND}.")
@@ -99,6 +99,29 @@ class DocumentSerializer(serializers.ModelSerializer):
             "archive_serial_number"
         )
 
+    def __init__(self, *args, fields=None, truncate_content=None, **kwargs):
+        """
+        Only the given fields are serialized, if specified. With
+        truncate_content, only that many characters of the content are.
+        """
+        super(DocumentSerializer, self).__init__(*args, **kwargs)
+
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+        self.truncate_content = truncate_content
+        if truncate_content is not None and "content" in self.fields:
+            self.fields["content"] = serializers.SerializerMethodField(
+                method_name="get_truncated_content")
+
+    def get_truncated_content(self, obj):
+        # The view may have fetched the start of the content only.
+        content = getattr(obj, "truncated_content", None)
+        if content is None:
+            content = obj.content
+        return content[:self.truncate_content]
+
 
 class LogSerializer(serializers.ModelSerializer):
 
@@ -6,15 +6,18 @@ from django.conf import settings
 from django.contrib.admin.models import ADDITION, LogEntry
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.db import models, DatabaseError
+from django.db import models, DatabaseError, transaction
 from django.dispatch import receiver
 from django.utils import timezone
+from django_q.tasks import async_task
 from rest_framework.reverse import reverse
 
-from .. import index, matching
+from .. import matching, search
+from ..classifier import bump_training_data_generation
 from ..file_handling import delete_empty_directories, generate_filename, \
     create_source_path_directory, archive_name_from_filename
-from ..models import Document, Tag
+from ..models import Document, Tag, Correspondent, DocumentType, \
+    MatchingModel
 
 
 def logger(message, group):
@@ -32,12 +35,13 @@ def set_correspondent(sender,
                       classifier=None,
                       replace=False,
                       use_first=True,
+                      prediction=None,
                       **kwargs):
     if document.correspondent and not replace:
         return
 
-    potential_correspondents = matching.match_correspondents(document.content,
-                                                             classifier)
+    potential_correspondents = matching.match_correspondents(
+        document.content, classifier, prediction=prediction)
 
     potential_count = len(potential_correspondents)
     if potential_correspondents:
@@ -75,12 +79,13 @@ def set_document_type(sender,
                       classifier=None,
                       replace=False,
                       use_first=True,
+                      prediction=None,
                       **kwargs):
     if document.document_type and not replace:
         return
 
-    potential_document_type = matching.match_document_types(document.content,
-                                                            classifier)
+    potential_document_type = matching.match_document_types(
+        document.content, classifier, prediction=prediction)
 
     potential_count = len(potential_document_type)
     if potential_document_type:
@@ -118,6 +123,7 @@ def set_tags(sender,
              logging_group=None,
              classifier=None,
              replace=False,
+             prediction=None,
              **kwargs):
     if replace:
         document.tags.clear()
@@ -125,7 +131,8 @@ def set_tags(sender,
     else:
         current_tags = set(document.tags.all())
 
-    matched_tags = matching.match_tags(document.content, classifier)
+    matched_tags = matching.match_tags(
+        document.content, classifier, prediction=prediction)
 
     relevant_tags = set(matched_tags) - current_tags
 
@@ -194,6 +201,128 @@ def cleanup_document_deletion(sender, instance, using, **kwargs):
     )
 
 
+# Fields of documents that the classifier is trained on.
+TRAINING_DATA_FIELDS = {"content", "correspondent", "document_type"}
+
+
+@receiver(models.signals.post_delete, sender=Document)
+def invalidate_training_data_document_deletion(sender, instance, **kwargs):
+    # The classifier cannot forget documents incrementally.
+    bump_training_data_generation()
+
+
+@receiver(models.signals.post_save, sender=Document)
+def invalidate_training_data_document(sender, instance, update_fields=None,
+                                      **kwargs):
+    if update_fields and not TRAINING_DATA_FIELDS.intersection(update_fields):
+        return
+
+    bump_training_data_generation([instance.pk])
+
+
+@receiver(models.signals.m2m_changed, sender=Document.tags.through)
+def invalidate_training_data_tags(sender, instance, action=None,
+                                  reverse=False, pk_set=None, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        bump_training_data_generation([instance.pk])
+    elif pk_set is not None:
+        # Tags were added to or removed from the given documents.
+        bump_training_data_generation(pk_set)
+    else:
+        bump_training_data_generation()
+
+
+# Fields of tags, correspondents and document types that are compared with
+# the stored row after saving.
+MATCHING_RULE_FIELDS = ("match", "matching_algorithm", "is_insensitive")
+MATCHING_TRAINING_DATA_FIELDS = ("matching_algorithm", "is_inbox_tag")
+
+
+@receiver(models.signals.pre_save, sender=DocumentType)
+@receiver(models.signals.pre_save, sender=Correspondent)
+@receiver(models.signals.pre_save, sender=Tag)
+def remember_matching_rule(sender, instance, raw=False, **kwargs):
+    stored = None
+    if not raw and instance.pk is not None:
+        fields = [f.name for f in sender._meta.concrete_fields
+                  if f.name in
+                  MATCHING_RULE_FIELDS + MATCHING_TRAINING_DATA_FIELDS]
+        stored = sender.objects.filter(pk=instance.pk).values(*fields).first()
+    instance._stored_matching_rule = stored
+
+
+def _changed(instance, fields):
+    """
+    Returns whether any of the fields differs from the stored row before the
+    instance was saved.
+    """
+    stored = getattr(instance, "_stored_matching_rule", None)
+    if stored is None:
+        return True
+    return any(stored[field] != getattr(instance, field)
+               for field in fields if field in stored)
+
+
+@receiver(models.signals.post_delete, sender=DocumentType)
+@receiver(models.signals.post_delete, sender=Correspondent)
+@receiver(models.signals.post_delete, sender=Tag)
+def invalidate_training_data_deleted_matching_model(sender, **kwargs):
+    bump_training_data_generation()
+
+
+@receiver(models.signals.post_save, sender=DocumentType)
+@receiver(models.signals.post_save, sender=Correspondent)
+@receiver(models.signals.post_save, sender=Tag)
+def invalidate_training_data_matching_model(sender, instance, created=False,
+                                            **kwargs):
+    # Matching algorithms decide which labels the classifier learns, and
+    # inbox tags decide which documents it learns from. Other changes, such
+    # as renaming a tag, don't matter.
+    if created or _changed(instance, MATCHING_TRAINING_DATA_FIELDS):
+        bump_training_data_generation()
+
+
+@receiver(models.signals.post_delete, sender=DocumentType)
+@receiver(models.signals.post_save, sender=DocumentType)
+@receiver(models.signals.post_delete, sender=Correspondent)
+@receiver(models.signals.post_save, sender=Correspondent)
+@receiver(models.signals.post_delete, sender=Tag)
+@receiver(models.signals.post_save, sender=Tag)
+def invalidate_matching_rules(sender, **kwargs):
+    matching.clear_rule_cache()
+
+
+@receiver(models.signals.post_save, sender=DocumentType)
+@receiver(models.signals.post_save, sender=Correspondent)
+@receiver(models.signals.post_save, sender=Tag)
+def apply_matching_model(sender, instance, created=False, raw=False,
+                         **kwargs):
+    if raw or not settings.MATCHING_APPLY_ON_SAVE:
+        # Imported matching models don't change anything.
+        return
+
+    # Only a new or changed rule may apply to documents it didn't apply to
+    # before. Renaming a tag shouldn't add it to documents again.
+    if not created and not _changed(instance, MATCHING_RULE_FIELDS):
+        return
+
+    if instance.matching_algorithm not in (MatchingModel.MATCH_ANY,
+                                           MatchingModel.MATCH_ALL,
+                                           MatchingModel.MATCH_LITERAL):
+        return
+
+    if instance.match.strip() == "":
+        return
+
+    model_name = instance._meta.model_name
+    pk = instance.pk
+    transaction.on_commit(lambda: async_task(
+        "documents.tasks.apply_matching_model", model_name, pk))
+
+
 def validate_move(instance, old_path, new_path):
     if not os.path.isfile(old_path):
         # Can't do anything if the old file does not exist anymore.
@@ -319,4 +448,4 @@ def set_log_entry(sender, document=None, logging_group=None, **kwargs):
 
 
 def add_to_index(sender, document, **kwargs):
-    index.add_or_update_document(document)
+    search.get_backend().queue_update(document)
@@ -1,60 +1,163 @@
 import logging
 
 from django.conf import settings
-from whoosh.writing import AsyncWriter
 
-from documents import index, sanity_checker
+from documents import search, sanity_checker, classifier, matching
 from documents.classifier import DocumentClassifier, \
     IncompatibleClassifierVersionError
 from documents.consumer import Consumer, ConsumerError
-from documents.models import Document
+from documents.models import Document, Correspondent, DocumentType, Tag
 from documents.sanity_checker import SanityFailedError
 
 
 def index_optimize():
-    ix = index.open_index()
-    writer = AsyncWriter(ix)
-    writer.commit(optimize=True)
+    search.get_backend().optimize()
 
 
-def index_reindex():
-    documents = Document.objects.all()
+def index_reindex(processes=1, progress_bar_disable=True):
+    """
+    Recreates the index of the search backend from scratch and returns the
+    number of indexed documents.
+    """
+    return search.get_backend().reindex(
+        processes=processes, progress_bar_disable=progress_bar_disable)
 
-    ix = index.open_index(recreate=True)
 
-    with AsyncWriter(ix) as writer:
-        for document in documents:
-            index.update_document(writer, document)
+def index_backfill(progress_bar_disable=True):
+    """
+    Brings the index of the search backend up to date with the documents and
+    returns the number of added documents.
+    """
+    return search.get_backend().backfill(
+        progress_bar_disable=progress_bar_disable)
 
 
-def train_classifier():
-    classifier = DocumentClassifier()
+def train_classifier(full_check=False):
+    if not full_check and not classifier.training_data_changed():
+        logging.getLogger(__name__).debug(
+            "Training data unchanged."
+        )
+        return
+
+    # Changes made while we're training will be picked up on the next run.
+    generation, document_ids = classifier.get_training_data_changes()
+
+    document_classifier = DocumentClassifier()
 
     try:
         # load the classifier, since we might not have to train it again.
-        classifier.reload()
+        document_classifier.reload()
     except (FileNotFoundError, IncompatibleClassifierVersionError):
         # This is what we're going to fix here.
         pass
 
     try:
-        if classifier.train():
+        if (settings.CLASSIFIER_INCREMENTAL and
+                not full_check and
+                document_ids is not None and
+                document_classifier.updates_since_refit <
+                settings.CLASSIFIER_FULL_REFIT_AFTER and
+                document_classifier.train_incremental(document_ids)):
+            logging.getLogger(__name__).info(
+                "Updated classifier with {} document(s).".format(
+                    len(document_ids))
+            )
+            updated = True
+        else:
+            updated = document_classifier.train()
+
+        if updated:
             logging.getLogger(__name__).info(
                 "Saving updated classifier model to {}...".format(
                     settings.MODEL_FILE)
             )
-            classifier.save_classifier()
+            document_classifier.save_classifier()
         else:
             logging.getLogger(__name__).debug(
                 "Training data unchanged."
             )
 
+        classifier.set_trained_generation(generation)
+
     except Exception as e:
         logging.getLogger(__name__).error(
             "Classifier error: " + str(e)
         )
 
 
+def check_classifier():
+    # Not every change to the training data causes the training data
+    # generation to increase, such as direct database modifications. This
+    # runs on a slower schedule and compares the hash of all training data
+    # instead.
+    train_classifier(full_check=True)
+
+
+# Number of documents that are fetched from the database at once while
+# applying a matching rule.
+APPLY_MATCHING_BATCH_SIZE = 1000
+
+
+def apply_matching_model(model_name, pk):
+    """
+    Applies the rule of a tag, correspondent or document type to existing
+    documents. Instead of matching every document, the index is used to find
+    candidates, and only these are matched.
+    """
+    model = {m._meta.model_name: m
+             for m in (Correspondent, DocumentType, Tag)}[model_name]
+    try:
+        matching_model = model.objects.get(pk=pk)
+    except model.DoesNotExist:
+        return
+
+    if matching_model.match.strip() == "":
+        return
+
+    backend = search.get_backend()
+    document_ids = backend.matching_document_ids(matching_model)
+    if document_ids is None:
+        logging.getLogger(__name__).info(
+            f"Cannot look up documents matching {matching_model} in the "
+            f"index. Use the document retagger to apply it to existing "
+            f"documents."
+        )
+        return
+
+    documents = Document.objects.filter(id__in=document_ids)
+    if model == Tag:
+        documents = documents.exclude(tags=matching_model)
+    elif model == Correspondent:
+        documents = documents.filter(correspondent__isnull=True)
+    else:
+        documents = documents.filter(document_type__isnull=True)
+    document_ids = list(documents.order_by("id").values_list("id", flat=True))
+
+    applied = []
+    for i in range(0, len(document_ids), APPLY_MATCHING_BATCH_SIZE):
+        batch = Document.objects.filter(
+            id__in=document_ids[i:i + APPLY_MATCHING_BATCH_SIZE]
+        ).select_related("correspondent", "document_type").order_by("id")
+        for document in batch:
+            if not matching.matches(matching_model, document.content):
+                continue
+            if model == Tag:
+                document.tags.add(matching_model)
+            elif model == Correspondent:
+                document.correspondent = matching_model
+                document.save(update_fields=("correspondent",))
+            else:
+                document.document_type = matching_model
+                document.save(update_fields=("document_type",))
+            applied.append(document)
+
+    if applied:
+        backend.update_documents(applied)
+
+    return "Applied {} to {} of {} candidate document(s).".format(
+        matching_model, len(applied), len(document_ids))
+
+
 def consume_file(path,
                  override_filename=None,
                  override_title=None,
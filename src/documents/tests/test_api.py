@@ -1,15 +1,21 @@
+import datetime
 import os
+import re
 import tempfile
 from unittest import mock
 
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from pathvalidate import ValidationError
 from rest_framework.test import APITestCase
 from whoosh.writing import AsyncWriter
 
 from documents import index
-from documents.models import Document, Correspondent, DocumentType, Tag
-from documents.tests.utils import DirectoriesMixin
+from documents.models import Document, Correspondent, DocumentType, Tag, Log
+from documents.tests.utils import DirectoriesMixin, QueryBudgetMixin
 
 
 class TestDocumentApi(DirectoriesMixin, APITestCase):
@@ -63,6 +69,123 @@ class TestDocumentApi(DirectoriesMixin, APITestCase):
 
         self.assertEqual(len(Document.objects.all()), 0)
 
+    def test_document_fields(self):
+        c = Correspondent.objects.create(name="c")
+        doc = Document.objects.create(title="WOW", content="the content", correspondent=c, checksum="123", mime_type="application/pdf")
+
+        response = self.client.get("/api/documents/?fields=id,title,nonexistent")
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.data['results'][0], {"id": doc.id, "title": "WOW"})
+
+        response = self.client.get(f"/api/documents/{doc.id}/?exclude=content,tags")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("content", response.data)
+        self.assertNotIn("tags", response.data)
+        self.assertEqual(response.data['correspondent'], c.id)
+
+        response = self.client.get("/api/documents/?fields=id,content&exclude=id&truncate_content=3")
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.data['results'][0], {"content": "the"})
+
+        response = self.client.get(f"/api/documents/{doc.id}/?truncate_content=0")
+        self.assertEqual(response.data['content'], "")
+
+        response = self.client.get(f"/api/documents/{doc.id}/?truncate_content=x")
+        self.assertEqual(response.data['content'], "the content")
+
+        # the full document is returned after changing it.
+        response = self.client.patch(f"/api/documents/{doc.id}/?fields=id", {"title": "new"}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['content'], "the content")
+        self.assertEqual(response.data['title'], "new")
+
+    def test_document_fields_payload(self):
+        for i in range(25):
+            Document.objects.create(title=f"doc {i}", content="lorem ipsum " * 10000, checksum=str(i), mime_type="application/pdf")
+
+        with CaptureQueriesContext(connection) as full_queries:
+            full = self.client.get("/api/documents/?page_size=25")
+        with CaptureQueriesContext(connection) as sparse_queries:
+            sparse = self.client.get("/api/documents/?page_size=25&exclude=content")
+        with CaptureQueriesContext(connection) as truncated_queries:
+            truncated = self.client.get("/api/documents/?page_size=25&truncate_content=100")
+
+        self.assertEqual(len(sparse.data['results']), 25)
+        self.assertEqual(len(truncated.data['results']), 25)
+        self.assertLess(len(sparse.content), len(full.content) / 100)
+        self.assertLess(len(truncated.content), len(full.content) / 100)
+
+        # the entire content isn't read from the database, nor are there
+        # additional queries for it.
+        def selects_content(queries):
+            return any(re.search(r'(?<!SUBSTR\()"documents_document"\."content"', q['sql'].split(" FROM ")[0], re.IGNORECASE) for q in queries)
+        self.assertTrue(selects_content(full_queries.captured_queries))
+        self.assertFalse(selects_content(sparse_queries.captured_queries))
+        self.assertFalse(selects_content(truncated_queries.captured_queries))
+        self.assertEqual(len(sparse_queries), len(full_queries))
+        self.assertEqual(len(truncated_queries), len(full_queries))
+
+    def test_cursor_pagination(self):
+        created = timezone.make_aware(datetime.datetime(2020, 1, 1))
+        for i in range(30):
+            # several documents were created at the same time.
+            Document.objects.create(title=f"doc {i}", checksum=str(i), mime_type="application/pdf",
+                                    created=created + datetime.timedelta(days=i // 4))
+
+        def pages(url):
+            ids = []
+            while url:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(response.data['results']), 7)
+                ids.extend(doc['id'] for doc in response.data['results'])
+                url = response.data['next']
+            return ids
+
+        self.assertListEqual(
+            pages("/api/documents/?cursor=&page_size=7"),
+            list(Document.objects.order_by("-created", "-id").values_list("id", flat=True)))
+        self.assertListEqual(
+            pages("/api/documents/?cursor=&page_size=7&ordering=created&title__istartswith=doc 1"),
+            list(Document.objects.filter(title__istartswith="doc 1").order_by("created", "id").values_list("id", flat=True)))
+        self.assertListEqual(
+            pages("/api/documents/?cursor=&page_size=7&ordering=-added"),
+            list(Document.objects.order_by("-added", "-id").values_list("id", flat=True)))
+
+        response = self.client.get("/api/documents/?cursor=&page_size=7")
+        self.assertEqual(response.data['count'], 30)
+        next_page = self.client.get(response.data['next'])
+        self.assertEqual(self.client.get(next_page.data['previous']).data['results'], response.data['results'])
+
+        response = self.client.get("/api/documents/?cursor=&count=none")
+        self.assertIsNone(response.data['count'])
+        self.assertEqual(len(response.data['results']), 25)
+
+        response = self.client.get("/api/documents/?cursor=&count=estimate")
+        self.assertEqual(response.data['count'], 30)
+
+        response = self.client.get("/api/documents/?cursor=&ordering=title")
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get("/api/documents/?cursor=invalid")
+        self.assertEqual(response.status_code, 404)
+
+        # pages are numbered without a cursor.
+        response = self.client.get("/api/documents/?page=2&page_size=7")
+        self.assertEqual(response.data['count'], 30)
+        self.assertEqual(len(response.data['results']), 7)
+
+    def test_logs_cursor_pagination(self):
+        for i in range(10):
+            Log.objects.create(message=f"message {i}")
+
+        response = self.client.get("/api/logs/?cursor=&page_size=6&count=none")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['count'])
+        messages = [log['message'] for log in response.data['results']]
+        messages += [log['message'] for log in self.client.get(response.data['next']).data['results']]
+        self.assertListEqual(messages, list(Log.objects.order_by("-created", "-id").values_list("message", flat=True)))
+
     def test_document_actions(self):
 
         _, filename = tempfile.mkstemp(dir=self.dirs.originals_dir)
@@ -195,6 +318,24 @@ class TestDocumentApi(DirectoriesMixin, APITestCase):
         results = response.data['results']
         self.assertEqual(len(results), 3)
 
+        response = self.client.get("/api/documents/?tags__id__all={},{},{}".format(tag_2.id, tag_3.id, tag_3.id))
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['id'], doc3.id)
+
+        response = self.client.get("/api/documents/?tags__id__none={},{}".format(tag_inbox.id, tag_3.id))
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['id'], doc2.id)
+
+        response = self.client.get("/api/documents/?tags__id__none={}".format(tag_2.id))
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['id'], doc1.id)
+
     def test_search_no_query(self):
         response = self.client.get("/api/search/")
         results = response.data['results']
@@ -240,6 +381,75 @@ class TestDocumentApi(DirectoriesMixin, APITestCase):
         self.assertEqual(response.data['page_count'], 0)
         self.assertEqual(len(results), 0)
 
+    def test_search_filters(self):
+        t = Tag.objects.create(name="t")
+        d1 = Document.objects.create(title="bank statement 1", content="things i paid for in august", checksum="A")
+        d2 = Document.objects.create(title="bank statement 2", content="things i paid for in september", checksum="B")
+        d1.tags.add(t)
+        index.add_or_update_document(d1)
+        index.add_or_update_document(d2)
+
+        response = self.client.get(f"/api/search/?query=bank&tags__id__all={t.id}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['id'], d1.id)
+
+        response = self.client.get("/api/search/?query=bank&is_in_inbox=false")
+        self.assertEqual(response.data['count'], 2)
+
+        response = self.client.get("/api/search/?query=bank&tags__id__all=a")
+        self.assertEqual(response.status_code, 400)
+
+    def test_document_text_filters(self):
+        d1 = Document.objects.create(title="bank statement", content="Invoice for the shop.", checksum="A")
+        d2 = Document.objects.create(title="receipt", content="A receipt from the shop", checksum="B")
+
+        def ids(query):
+            response = self.client.get(f"/api/documents/?{query}")
+            self.assertEqual(response.status_code, 200)
+            return sorted(r['id'] for r in response.data['results'])
+
+        self.assertListEqual(ids("content__icontains=shop"), [d1.id, d2.id])
+        self.assertListEqual(ids("content__icontains=invoice%20for"), [d1.id])
+        self.assertListEqual(ids("content__icontains=the%20shop"), [d1.id, d2.id])
+        self.assertListEqual(ids("content__icontains=from%20shop"), [])
+        self.assertListEqual(ids("title__icontains=STATE"), [d1.id])
+        # parts of words and punctuation are found, regardless of the index.
+        self.assertListEqual(ids("content__icontains=oice"), [d1.id])
+        self.assertListEqual(ids("content__icontains=shop."), [d1.id])
+        self.assertListEqual(ids("content__icontains=o"), [d1.id, d2.id])
+
+    @override_settings(INDEX_FLUSH_INTERVAL=60)
+    @mock.patch("documents.index.transaction.on_commit", lambda f: f())
+    @mock.patch("documents.index._schedule_flush")
+    def test_search_queued_changes(self, m):
+        doc = Document.objects.create(title="none", checksum="A", content="a bank statement")
+        index.add_or_update_document(doc)
+
+        response = self.client.patch(f"/api/documents/{doc.pk}/", {"title": "quarterly"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        m.assert_called()
+
+        # the change is only queued, the index still has the old title.
+        response = self.client.get("/api/search/?query=quarterly")
+        self.assertEqual(response.data['count'], 0)
+
+        index.wait_until_searchable(doc)
+
+        response = self.client.get("/api/search/?query=quarterly")
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(response.data['results'][0]['id'], doc.pk)
+
+        response = self.client.delete(f"/api/documents/{doc.pk}/")
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get("/api/search/?query=bank")
+        self.assertEqual(response.data['count'], 1)
+
+        index.wait_until_searchable(doc)
+
+        response = self.client.get("/api/search/?query=bank")
+        self.assertEqual(response.data['count'], 0)
+
     def test_search_multi_page(self):
         with AsyncWriter(index.open_index()) as writer:
             for i in range(55):
@@ -279,6 +489,28 @@ class TestDocumentApi(DirectoriesMixin, APITestCase):
         self.assertEqual(response.data['page_count'], 6)
         self.assertEqual(len(results), 5)
 
+    def test_search_queries(self):
+        tags = [Tag.objects.create(name=f"tag{i}") for i in range(3)]
+        with AsyncWriter(index.open_index()) as writer:
+            for i in range(10):
+                doc = Document.objects.create(checksum=str(i), title=f"Document {i}", content="content")
+                doc.tags.add(*tags)
+                index.update_document(writer, doc)
+            deleted = Document.objects.create(checksum="deleted", title="Deleted", content="content")
+            index.update_document(writer, deleted)
+        deleted.delete()
+
+        with self.assertLogs("documents.views", "DEBUG") as cm:
+            response = self.client.get("/api/search/?query=content")
+            self.client.get("/api/search/?query=content")
+
+        # one query for the text to highlight, one for the documents, one for
+        # their tags. Repeated searches are cached.
+        self.assertIn("10 results, 3 queries", cm.output[-2])
+        self.assertIn("10 results, 2 queries", cm.output[-1])
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertCountEqual(response.data['results'][0]['document']['tags'], [t.pk for t in tags])
+
     def test_search_invalid_page(self):
         with AsyncWriter(index.open_index()) as writer:
             for i in range(15):
@@ -300,7 +532,7 @@ class TestDocumentApi(DirectoriesMixin, APITestCase):
 
     @mock.patch("documents.index.autocomplete")
     def test_search_autocomplete(self, m):
-        m.side_effect = lambda ix, term, limit: [term for _ in range(limit)]
+        m.side_effect = lambda term, limit: [term for _ in range(limit)]
 
         response = self.client.get("/api/search/autocomplete/?term=test")
         self.assertEqual(response.status_code, 200)
@@ -475,3 +707,44 @@ class TestDocumentApi(DirectoriesMixin, APITestCase):
         self.assertEqual(response.status_code, 400)
 
         async_task.assert_not_called()
+
+
+class TestQueryBudget(DirectoriesMixin, QueryBudgetMixin, APITestCase):
+
+    def setUp(self):
+        super(TestQueryBudget, self).setUp()
+
+        user = User.objects.create_superuser(username="temp_admin")
+        self.client.force_login(user=user)
+
+        correspondents = [Correspondent.objects.create(name=f"c{i}") for i in range(3)]
+        document_types = [DocumentType.objects.create(name=f"dt{i}") for i in range(3)]
+        tags = [Tag.objects.create(name=f"t{i}") for i in range(5)]
+        documents = []
+        for i in range(30):
+            doc = Document.objects.create(
+                title=f"invoice {i}", content=f"invoice number {i}", checksum=str(i),
+                mime_type="application/pdf", correspondent=correspondents[i % 3],
+                document_type=document_types[i % 3])
+            doc.tags.add(*tags[i % 3:])
+            documents.append(doc)
+        self.doc = doc
+
+        with AsyncWriter(index.open_index()) as writer:
+            for doc in documents:
+                index.update_document(writer, doc)
+
+    def test_documents(self):
+        self.assertQueryBudget("/api/documents/", 5)
+        self.assertQueryBudget("/api/documents/?exclude=tags", 4)
+        self.assertQueryBudget("/api/documents/?cursor=", 5)
+        self.assertQueryBudget("/api/documents/?cursor=&count=none", 4)
+        self.assertQueryBudget(f"/api/documents/{self.doc.pk}/", 4)
+        self.assertQueryBudget("/api/search/?query=invoice", 5)
+        self.assertQueryBudget("/api/search/?query=invoice&page=3", 5)
+
+    def test_other_lists(self):
+        self.assertQueryBudget("/api/tags/", 4)
+        self.assertQueryBudget("/api/correspondents/", 4)
+        self.assertQueryBudget("/api/document_types/", 4)
+        self.assertQueryBudget("/api/logs/", 3)
@@ -0,0 +1,465 @@
+import os
+import pickle
+import random
+import re
+import time
+import unittest
+from base64 import b64encode
+from urllib.parse import quote, urlencode
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+
+from fuzzywuzzy import fuzz
+
+from .utils import DirectoriesMixin
+from .. import matching, search
+from ..classifier import DocumentClassifier
+from ..filters import DocumentFilterSet
+from ..models import Document, Tag, Correspondent, DocumentType, \
+    MatchingModel
+
+# Benchmarks create large amounts of synthetic data and take a while, so they
+# only run when explicitly requested:
+#
+#   PAPERLESS_BENCHMARK=1 pytest -s -n0 documents/tests/test_benchmarks.py
+#
+BENCHMARK = os.getenv("PAPERLESS_BENCHMARK")
+
+SIZES = [int(s) for s in os.getenv(
+    "PAPERLESS_BENCHMARK_SIZES", "10000,100000").split(",")]
+
+WORDS = [
+    "invoice", "contract", "insurance", "tax", "bank", "statement", "salary",
+    "rent", "electricity", "water", "phone", "internet", "car", "health",
+    "doctor", "receipt", "order", "delivery", "warranty", "pension"
+]
+
+
+def measure(func):
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        start = time.perf_counter()
+        result = func()
+        duration = time.perf_counter() - start
+    return result, duration, queries
+
+
+def report(name, size, duration, queries):
+    print(f"{name:<40} {size:>8} documents "
+          f"{duration:>9.3f} s {queries:>8} queries")
+
+
+# A vocabulary that results in models of realistic size.
+LARGE_VOCABULARY = [f"{word}{i}" for word in WORDS for i in range(250)]
+
+
+def synthetic_content(rnd, words=200, vocabulary=WORDS):
+    return " ".join(rnd.choice(vocabulary) for _ in range(words))
+
+
+def create_documents(count, tags=(), correspondents=(), document_types=(),
+                     seed=0, vocabulary=WORDS):
+    """
+    Creates count documents with random content and randomly assigned
+    correspondents, document types and tags in bulk.
+    """
+    rnd = random.Random(seed)
+    first = Document.objects.count()
+
+    documents = Document.objects.bulk_create([
+        Document(
+            title=f"document {first + i}",
+            content=synthetic_content(rnd, vocabulary=vocabulary),
+            checksum=f"{seed}-{first + i}",
+            mime_type="application/pdf",
+            correspondent=rnd.choice(correspondents) if correspondents else None,
+            document_type=rnd.choice(document_types) if document_types else None
+        ) for i in range(count)
+    ], batch_size=1000)
+
+    if tags:
+        if documents[0].pk is None:
+            documents = Document.objects.order_by("-pk")[:count]
+        Through = Document.tags.through
+        Through.objects.bulk_create([
+            Through(document_id=d.pk, tag_id=t.pk)
+            for d in documents for t in rnd.sample(tags, 2)
+        ], batch_size=1000)
+
+
+def create_matching_models(model, count, algorithm=MatchingModel.MATCH_AUTO):
+    return [model.objects.create(name=f"{model.__name__} {i}",
+                                 matching_algorithm=algorithm)
+            for i in range(count)]
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkClassifierTrainingData(DirectoriesMixin, TestCase):
+
+    def legacy_training_data(self):
+        # How DocumentClassifier.train() used to gather its data.
+        data = []
+        for doc in Document.objects.order_by('pk').exclude(tags__is_inbox_tag=True):
+            dt = doc.document_type
+            cor = doc.correspondent
+            tags = [tag.pk for tag in doc.tags.filter(
+                matching_algorithm=MatchingModel.MATCH_AUTO)]
+            data.append((doc.content, dt, cor, tags))
+        return data
+
+    def test_training_data(self):
+        tags = create_matching_models(Tag, 10)
+        correspondents = create_matching_models(Correspondent, 10)
+        document_types = create_matching_models(DocumentType, 10)
+
+        classifier = DocumentClassifier()
+
+        for size in SIZES:
+            create_documents(size - Document.objects.count(), tags,
+                             correspondents, document_types)
+
+            _, duration, queries = measure(self.legacy_training_data)
+            report("training data (per document queries)",
+                   size, duration, queries)
+
+            _, duration, queries = measure(
+                lambda: list(classifier._training_data()))
+            report("training data (bulk queries)", size, duration, queries)
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkClassifierLoading(DirectoriesMixin, TestCase):
+
+    def legacy_reload(self, filename):
+        # How DocumentClassifier.reload() used to read the model.
+        with open(filename, "rb") as f:
+            return [pickle.load(f) for _ in range(7)]
+
+    def test_reload(self):
+        tags = create_matching_models(Tag, 10)
+        correspondents = create_matching_models(Correspondent, 10)
+        document_types = create_matching_models(DocumentType, 10)
+
+        for size in SIZES:
+            create_documents(size - Document.objects.count(), tags,
+                             correspondents, document_types,
+                             vocabulary=LARGE_VOCABULARY)
+
+            classifier = DocumentClassifier()
+            classifier.train()
+            classifier.save_classifier()
+
+            legacy_file = settings.MODEL_FILE + ".legacy"
+            with open(legacy_file, "wb") as f:
+                for obj in [classifier.FORMAT_VERSION,
+                            classifier.data_hash,
+                            classifier.data_vectorizer,
+                            classifier.tags_binarizer,
+                            classifier.tags_classifier,
+                            classifier.correspondent_classifier,
+                            classifier.document_type_classifier]:
+                    pickle.dump(obj, f)
+
+            _, duration, queries = measure(
+                lambda: self.legacy_reload(legacy_file))
+            report("reload (pickle)", size, duration, queries)
+
+            _, duration, queries = measure(DocumentClassifier().reload)
+            report("reload (memory mapped)", size, duration, queries)
+
+
+def legacy_matches(matching_model, document_content):
+    # How matching.matches() used to work.
+    search_kwargs = {}
+
+    document_content = document_content.lower()
+
+    if matching_model.match.strip() == "":
+        return False
+
+    if matching_model.is_insensitive:
+        search_kwargs = {"flags": re.IGNORECASE}
+
+    if matching_model.matching_algorithm == MatchingModel.MATCH_ALL:
+        for word in matching._split_match(matching_model):
+            search_result = re.search(
+                rf"\b{word}\b", document_content, **search_kwargs)
+            if not search_result:
+                return False
+        return True
+
+    elif matching_model.matching_algorithm == MatchingModel.MATCH_ANY:
+        for word in matching._split_match(matching_model):
+            if re.search(rf"\b{word}\b", document_content, **search_kwargs):
+                return True
+        return False
+
+    elif matching_model.matching_algorithm == MatchingModel.MATCH_LITERAL:
+        return bool(re.search(
+            rf"\b{matching_model.match}\b",
+            document_content,
+            **search_kwargs
+        ))
+
+    elif matching_model.matching_algorithm == MatchingModel.MATCH_REGEX:
+        return bool(re.search(
+            re.compile(matching_model.match, **search_kwargs),
+            document_content
+        ))
+
+    elif matching_model.matching_algorithm == MatchingModel.MATCH_FUZZY:
+        match = re.sub(r'[^\w\s]', '', matching_model.match)
+        text = re.sub(r'[^\w\s]', '', document_content)
+        if matching_model.is_insensitive:
+            match = match.lower()
+            text = text.lower()
+
+        return fuzz.partial_ratio(match, text) >= 90
+
+    return False
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkMatching(TestCase):
+
+    # Number of tags and correspondents with matching rules.
+    RULES = 1000
+
+    def create_rules(self, rnd):
+        for model in (Tag, Correspondent):
+            for i in range(self.RULES):
+                algorithm = rnd.choice([MatchingModel.MATCH_ANY,
+                                        MatchingModel.MATCH_ALL,
+                                        MatchingModel.MATCH_LITERAL])
+                if algorithm == MatchingModel.MATCH_LITERAL:
+                    match = " ".join(rnd.sample(LARGE_VOCABULARY, 2))
+                else:
+                    match = " ".join(rnd.sample(LARGE_VOCABULARY, 3))
+                model.objects.create(name=f"{model.__name__} {i}",
+                                     match=match,
+                                     matching_algorithm=algorithm)
+
+    def legacy_match(self, contents):
+        return [
+            [o for o in model.objects.all() if legacy_matches(o, content)]
+            for content in contents for model in (Tag, Correspondent)
+        ]
+
+    def match(self, contents):
+        return [
+            function(content, None)
+            for content in contents
+            for function in (matching.match_tags,
+                             matching.match_correspondents)
+        ]
+
+    def test_matching(self):
+        rnd = random.Random(0)
+        self.create_rules(rnd)
+
+        for size in SIZES:
+            # Each document is matched against all rules, so this is slow
+            # enough with far fewer documents.
+            size = max(size // 1000, 1)
+            contents = [synthetic_content(rnd, 2000, LARGE_VOCABULARY)
+                        for _ in range(size)]
+
+            expected, duration, queries = measure(
+                lambda: self.legacy_match(contents))
+            report("matching (matches() per rule)", size, duration, queries)
+
+            matching.clear_rule_cache()
+            result, duration, queries = measure(lambda: self.match(contents))
+            report("matching (compiled rules)", size, duration, queries)
+
+            self.assertEqual(result, expected)
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkFuzzyMatching(TestCase):
+
+    # Number of correspondents with fuzzy matching rules.
+    RULES = 300
+
+    # Number of words of each document.
+    WORDS = 10000
+
+    def name(self, rnd):
+        return "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(rnd.randint(5, 12))).capitalize()
+
+    def content(self, rnd, matches):
+        words = synthetic_content(rnd, self.WORDS, LARGE_VOCABULARY).split()
+        # Some correspondents occur in each document, with OCR errors.
+        for match in rnd.sample(matches, 3):
+            match = list(match)
+            match[rnd.randrange(len(match))] = rnd.choice("il1 ")
+            words.insert(rnd.randrange(len(words)), "".join(match))
+        return " ".join(words)
+
+    def test_fuzzy_matching(self):
+        rnd = random.Random(0)
+        correspondents = [
+            Correspondent.objects.create(
+                name=f"Correspondent {i}",
+                match=f"{self.name(rnd)} {self.name(rnd)}, {self.name(rnd)}",
+                matching_algorithm=MatchingModel.MATCH_FUZZY)
+            for i in range(self.RULES)
+        ]
+        matches = [c.match for c in correspondents]
+
+        for size in SIZES:
+            size = max(size // 10000, 1)
+            contents = [self.content(rnd, matches) for _ in range(size)]
+
+            expected, duration, queries = measure(lambda: [
+                [c.pk for c in correspondents if legacy_matches(c, content)]
+                for content in contents])
+            report("fuzzy matching (partial_ratio)", size, duration, queries)
+
+            result, duration, queries = measure(lambda: [
+                [c.pk for c in correspondents if matching.matches(c, content)]
+                for content in contents])
+            report("fuzzy matching (q-grams)", size, duration, queries)
+
+            self.assertEqual(result, expected)
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkSearchBackends(DirectoriesMixin, TestCase):
+
+    # Number of queries whose average latency is reported.
+    QUERIES = 100
+
+    def queries(self, rnd):
+        return [" ".join(rnd.sample(LARGE_VOCABULARY, rnd.randint(1, 2)))
+                for _ in range(self.QUERIES)]
+
+    def test_search_backends(self):
+        rnd = random.Random(0)
+        backends = [("whoosh", search.WhooshBackend()),
+                    (connection.vendor,
+                     search.DATABASE_BACKENDS[connection.vendor]())]
+
+        for size in SIZES:
+            create_documents(size - Document.objects.count(),
+                             vocabulary=LARGE_VOCABULARY)
+            # The same queries for each backend, but none of them cached.
+            queries = self.queries(rnd)
+
+            for name, backend in backends:
+                _, duration, count = measure(backend.reindex)
+                report(f"{name} write ({size / duration:.0f} docs/s)",
+                       size, duration, count)
+
+                _, duration, count = measure(
+                    lambda: [backend.search(q, 1) for q in queries])
+                report(f"{name} query ({duration / len(queries) * 1000:.1f} "
+                       f"ms avg)", size, duration, count)
+
+                _, duration, count = measure(
+                    lambda: [backend.autocomplete(q[:3]) for q in queries])
+                report(f"{name} autocomplete", size, duration, count)
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkTagsFilter(TestCase):
+
+    TAGS = 10
+
+    def first_page(self, queryset):
+        queryset = queryset.order_by("-created")
+        return queryset.count(), list(queryset.values_list("id", flat=True)[:25])
+
+    def create_documents(self, size, tags, rnd):
+        # Every document has most of the tags, so that documents with all of
+        # them exist.
+        first = Document.objects.count()
+        Document.objects.bulk_create([
+            Document(title=f"document {i}", content="", checksum=f"tags-{i}",
+                     mime_type="application/pdf")
+            for i in range(first, size)
+        ], batch_size=1000)
+        Through = Document.tags.through
+        Through.objects.bulk_create([
+            Through(document_id=pk, tag_id=t.pk)
+            for pk in Document.objects.order_by("pk").values_list("pk", flat=True)[first:]
+            for t in tags if rnd.random() < 0.7
+        ], batch_size=1000)
+
+    def test_tags_filter(self):
+        rnd = random.Random(0)
+        tags = [Tag.objects.create(name=f"tag {i}") for i in range(self.TAGS)]
+
+        for size in SIZES:
+            self.create_documents(size, tags, rnd)
+
+            for count in range(1, self.TAGS + 1):
+                tag_ids = [t.pk for t in tags[:count]]
+
+                joined = Document.objects.all()
+                for tag_id in tag_ids:
+                    joined = joined.filter(tags__id=tag_id)
+                expected, duration, queries = measure(lambda: self.first_page(joined))
+                report(f"all of {count} tags (joins)", size, duration, queries)
+
+                grouped = DocumentFilterSet({"tags__id__all": ",".join(map(str, tag_ids))},
+                                            queryset=Document.objects.all()).qs
+                result, duration, queries = measure(lambda: self.first_page(grouped))
+                report(f"all of {count} tags (exists)", size, duration, queries)
+                self.assertEqual(result, expected)
+
+                excluded = DocumentFilterSet({"tags__id__none": ",".join(map(str, tag_ids))},
+                                             queryset=Document.objects.all()).qs
+                _, duration, queries = measure(lambda: self.first_page(excluded))
+                report(f"none of {count} tags (exists)", size, duration, queries)
+
+                if count in (2, self.TAGS) and size == SIZES[-1]:
+                    print(f"Query plan for all of {count} tags with joins:")
+                    print(joined.order_by("-created").explain())
+                    print(f"Query plan for all of {count} tags with exists:")
+                    print(grouped.order_by("-created").explain())
+
+
+@unittest.skipUnless(BENCHMARK, "Set PAPERLESS_BENCHMARK to run benchmarks.")
+class BenchmarkPagination(TestCase):
+
+    def setUp(self):
+        super(BenchmarkPagination, self).setUp()
+        self.client.force_login(User.objects.create_superuser(username="temp_admin"))
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_deep_pages(self):
+        for size in SIZES:
+            create_documents(size - Document.objects.count(), seed=size)
+            ordered = Document.objects.order_by("-created", "-id")
+
+            for depth in (0.0, 0.5, 0.99):
+                page = int(size * depth) // 25 + 1
+                expected, duration, queries = measure(lambda: self.get(
+                    f"/api/documents/?page={page}&ordering=-created"))
+                report(f"page {page} by number", size, duration, queries)
+
+                # The cursor of the same page, as in the next link of the
+                # page before it.
+                position = ordered[(page - 1) * 25 - 1].created if page > 1 else None
+                cursor = "" if position is None else b64encode(
+                    urlencode({"p": str(position)}).encode()).decode()
+                for count in ("exact", "estimate", "none"):
+                    result, duration, queries = measure(lambda: self.get(
+                        f"/api/documents/?cursor={quote(cursor)}&count={count}"))
+                    report(f"page {page} by cursor, count {count}", size, duration, queries)
+                    self.assertEqual(result.data["results"], expected.data["results"])
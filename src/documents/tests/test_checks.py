@@ -1,9 +1,11 @@
 import unittest
+from unittest import mock
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from .factories import DocumentFactory
-from ..checks import changed_password_check
+from .. import search
+from ..checks import changed_password_check, digest_algorithm_check, search_backend_check
 from ..models import Document
 
 
@@ -15,3 +17,34 @@ class ChecksTestCase(TestCase):
     def test_changed_password_check_no_encryption(self):
         DocumentFactory.create(storage_type=Document.STORAGE_TYPE_UNENCRYPTED)
         self.assertEqual(changed_password_check(None), [])
+
+    def test_digest_algorithm_check(self):
+        self.assertEqual(digest_algorithm_check(None), [])
+
+        with override_settings(DIGEST_ALGORITHM="blake2b"):
+            self.assertEqual(digest_algorithm_check(None), [])
+
+        with override_settings(DIGEST_ALGORITHM="whatever"):
+            self.assertEqual(len(digest_algorithm_check(None)), 1)
+
+        for algorithm in ("shake_128", "shake_256"):
+            with override_settings(DIGEST_ALGORITHM=algorithm):
+                self.assertEqual(len(digest_algorithm_check(None)), 1)
+
+    def test_search_backend_check(self):
+        self.assertEqual(search_backend_check(None), [])
+
+        with override_settings(SEARCH_BACKEND="elasticsearch"):
+            self.assertEqual(len(search_backend_check(None)), 1)
+
+    @override_settings(SEARCH_BACKEND="database")
+    def test_search_backend_check_database(self):
+        # the tables are created once documents are indexed.
+        self.assertEqual(len(search_backend_check(None)), 1)
+
+        search.get_backend().backfill()
+        self.assertEqual(search_backend_check(None), [])
+
+        with mock.patch("documents.search.SqliteBackend.is_available", return_value=False), \
+                mock.patch("documents.search.PostgresBackend.is_available", return_value=False):
+            self.assertEqual(len(search_backend_check(None)), 1)
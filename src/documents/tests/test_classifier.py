@@ -1,10 +1,16 @@
+import os
+import pickle
 import tempfile
 from time import sleep
 from unittest import mock
 
+import numpy
+from django.conf import settings
 from django.test import TestCase, override_settings
 
-from documents.classifier import DocumentClassifier, IncompatibleClassifierVersionError
+from documents import matching
+from documents.classifier import DocumentClassifier, IncompatibleClassifierVersionError, load_classifier, \
+    classifier_cache_info
 from documents.models import Correspondent, Document, Tag, DocumentType
 from documents.tests.utils import DirectoriesMixin
 
@@ -69,6 +75,74 @@ class TestClassifier(DirectoriesMixin, TestCase):
         self.assertEqual(self.classifier.predict_document_type(self.doc1.content), self.dt.pk)
         self.assertEqual(self.classifier.predict_document_type(self.doc2.content), None)
 
+    def testPredictAll(self):
+        self.generate_test_data()
+        self.classifier.train()
+
+        prediction = self.classifier.predict_all(self.doc2.content)
+        self.assertIsNone(prediction.correspondent)
+        self.assertIsNone(prediction.document_type)
+        self.assertListEqual(prediction.tags, [self.t1.pk, self.t3.pk])
+
+        prediction = self.classifier.predict_all(self.doc1.content)
+        self.assertEqual(prediction.correspondent, self.c1.pk)
+        self.assertEqual(prediction.document_type, self.dt.pk)
+        self.assertListEqual(prediction.tags, [self.t1.pk])
+
+    def testPredictMany(self):
+        self.generate_test_data()
+        self.classifier.train()
+
+        contents = [self.doc1.content, self.doc2.content, "something else entirely"]
+
+        predictions = self.classifier.predict_many(contents)
+        self.assertEqual(len(predictions), 3)
+        for content, prediction in zip(contents, predictions):
+            self.assertEqual(prediction.correspondent, self.classifier.predict_correspondent(content))
+            self.assertEqual(prediction.document_type, self.classifier.predict_document_type(content))
+            self.assertListEqual(prediction.tags, self.classifier.predict_tags(content))
+
+        self.assertListEqual(self.classifier.predict_many([]), [])
+
+    def testVectorizeOnce(self):
+        self.generate_test_data()
+        self.classifier.train()
+
+        with mock.patch.object(self.classifier.data_vectorizer, "transform",
+                               wraps=self.classifier.data_vectorizer.transform) as m:
+            prediction = self.classifier.predict_all(self.doc1.content)
+            m.assert_called_once()
+
+            # the matching functions use the given prediction.
+            matching.match_correspondents(self.doc1.content, self.classifier, prediction=prediction)
+            matching.match_document_types(self.doc1.content, self.classifier, prediction=prediction)
+            self.assertIn(self.t1, matching.match_tags(self.doc1.content, self.classifier, prediction=prediction))
+            m.assert_called_once()
+
+            self.classifier.predict_many([self.doc1.content, self.doc2.content])
+            self.assertEqual(m.call_count, 2)
+
+            # predictions are not remembered.
+            self.classifier.predict_tags(self.doc2.content)
+            self.assertEqual(m.call_count, 3)
+
+    def testTrainingDataQueries(self):
+        self.generate_test_data()
+        for i in range(20):
+            doc = Document.objects.create(title=f"doc{i}", content=f"content {i}", checksum=f"D{i}",
+                                          correspondent=self.c1 if i % 2 else self.c2)
+            doc.tags.add(self.t1, self.t3)
+
+        with self.assertNumQueries(5):
+            data = list(self.classifier._training_data())
+
+        self.assertEqual(len(data), 22)
+        self.assertIn(("this is a document from c1", self.dt.pk, self.c1.pk, [self.t1.pk]), data)
+        self.assertIn(("this is another document, but from c2", -1, -1, [self.t1.pk, self.t3.pk]), data)
+
+        with self.assertNumQueries(6):
+            self.assertListEqual(list(self.classifier._training_data(chunk_size=11)), data)
+
     def testDatasetHashing(self):
 
         self.generate_test_data()
@@ -76,6 +150,50 @@ class TestClassifier(DirectoriesMixin, TestCase):
         self.assertTrue(self.classifier.train())
         self.assertFalse(self.classifier.train())
 
+    @override_settings(CLASSIFIER_INCREMENTAL=True)
+    def testTrainIncremental(self):
+        self.generate_test_data()
+        self.assertTrue(self.classifier.train())
+        self.assertTrue(self.classifier.is_incremental())
+
+        doc = Document.objects.create(title="doc3", content="another document from c1", correspondent=self.c1, checksum="D")
+        doc.tags.add(self.t3)
+        self.assertTrue(self.classifier.train_incremental([doc.pk]))
+        self.assertEqual(self.classifier.updates_since_refit, 1)
+        self.assertIsNone(self.classifier.data_hash)
+
+        # memory mapped models can be updated as well.
+        self.classifier.save_classifier()
+        classifier2 = DocumentClassifier()
+        classifier2.reload()
+        self.assertTrue(classifier2.train_incremental([doc.pk]))
+        self.assertEqual(classifier2.updates_since_refit, 2)
+
+        # the next full training does not skip anything.
+        self.assertTrue(self.classifier.train())
+        self.assertEqual(self.classifier.updates_since_refit, 0)
+
+    @override_settings(CLASSIFIER_INCREMENTAL=True)
+    def testTrainIncrementalNewLabel(self):
+        self.generate_test_data()
+        self.classifier.train()
+
+        c4 = Correspondent.objects.create(name="c4", matching_algorithm=Correspondent.MATCH_AUTO)
+        doc = Document.objects.create(title="doc3", content="a document from c4", correspondent=c4, checksum="D")
+        self.assertFalse(self.classifier.train_incremental([doc.pk]))
+
+    def testTrainIncrementalNotIncremental(self):
+        self.generate_test_data()
+        self.classifier.train()
+
+        self.assertFalse(self.classifier.is_incremental())
+        self.assertFalse(self.classifier.train_incremental([self.doc1.pk]))
+
+        with override_settings(CLASSIFIER_INCREMENTAL=True):
+            # switching to incremental training requires training again.
+            self.assertTrue(self.classifier.train())
+            self.assertTrue(self.classifier.is_incremental())
+
     def testVersionIncreased(self):
 
         self.generate_test_data()
@@ -114,6 +232,61 @@ class TestClassifier(DirectoriesMixin, TestCase):
         v2 = classifier2.classifier_version
         self.assertNotEqual(v1, v2)
 
+    def testLoadClassifierCached(self):
+        self.assertIsNone(load_classifier())
+
+        self.generate_test_data()
+        self.classifier.train()
+        self.classifier.save_classifier()
+
+        info = classifier_cache_info()
+
+        classifier = load_classifier()
+        self.assertIsNotNone(classifier)
+        self.assertIs(load_classifier(), classifier)
+        self.assertEqual(classifier.predict_correspondent(self.doc1.content), self.c1.pk)
+
+        info2 = classifier_cache_info()
+        self.assertEqual(info2.misses, info.misses + 1)
+        self.assertEqual(info2.hits, info.hits + 1)
+        self.assertIsNotNone(info2.load_time)
+
+        # change the model on disk.
+        self.classifier.save_classifier()
+        os.utime(settings.MODEL_FILE, ns=(0, 0))
+
+        classifier2 = load_classifier()
+        self.assertIsNot(classifier2, classifier)
+        self.assertEqual(classifier_cache_info().misses, info.misses + 2)
+
+    def testLoadClassifierIncompatible(self):
+        self.generate_test_data()
+        self.classifier.train()
+        self.classifier.save_classifier()
+
+        with mock.patch("documents.classifier.DocumentClassifier.FORMAT_VERSION", -1):
+            self.assertIsNone(load_classifier())
+
+    def testReloadMemoryMapped(self):
+        self.generate_test_data()
+        self.classifier.train()
+        self.classifier.save_classifier()
+
+        classifier2 = DocumentClassifier()
+        classifier2.reload()
+
+        for coefs in classifier2.correspondent_classifier.coefs_:
+            self.assertIsInstance(coefs, numpy.memmap)
+        self.assertEqual(classifier2.predict_correspondent(self.doc1.content), self.c1.pk)
+
+    def testReloadPickledModel(self):
+        # models of earlier versions were a sequence of pickled objects.
+        with open(settings.MODEL_FILE, "wb") as f:
+            pickle.dump(6, f)
+            pickle.dump(None, f)
+
+        self.assertRaises(IncompatibleClassifierVersionError, self.classifier.reload)
+
     @override_settings(DATA_DIR=tempfile.mkdtemp())
     def testSaveClassifier(self):
 
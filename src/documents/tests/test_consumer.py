@@ -8,7 +8,9 @@ from unittest.mock import MagicMock
 from django.test import TestCase, override_settings
 
 from .utils import DirectoriesMixin
+from ..classifier import Prediction
 from ..consumer import Consumer, ConsumerError
+from ..file_handling import calculate_digest
 from ..models import FileInfo, Tag, Correspondent, DocumentType, Document
 from ..parsers import DocumentParser, ParseError
 
@@ -474,6 +476,34 @@ class TestConsumer(DirectoriesMixin, TestCase):
 
         self.assertFalse(os.path.isfile(filename))
 
+    @override_settings(DIGEST_ALGORITHM="blake2b")
+    def testDigest(self):
+        document = self.consumer.try_consume_file(self.get_test_file())
+
+        self.assertEqual(document.checksum, "42995833e01aea9b3edee44bbfdd7ce1")
+        self.assertEqual(document.archive_checksum, "62acb0bcbfbcaa62ca6ad3668e4e404b")
+        self.assertEqual(document.digest, "blake2b:d59097cb87cff1a521cdb3946e31219774230760667baf954ddf1595e91486ef36430a75a1f56e4fd25e1d4954753a2ee90c3500f5bcbe397a420b4f0b3d1496")
+        self.assertEqual(document.archive_digest, "blake2b:c30547181608c3a9e98662a425641da1051ea5ad123b469069fa44d949a57cefa24149e6d14251156e31f38d3d32679734bfc76e5da711b224faf17c5f21b882")
+
+    @override_settings(DIGEST_ALGORITHM="blake2b")
+    def testDuplicateDigest(self):
+        document = self.consumer.try_consume_file(self.get_test_file())
+
+        # only the digest identifies this as a duplicate.
+        Document.objects.filter(pk=document.pk).update(checksum="abc", archive_checksum="def")
+
+        self.assertRaisesRegex(ConsumerError, "It is a duplicate", self.consumer.try_consume_file, self.get_test_file())
+
+    @mock.patch("documents.consumer.calculate_digest")
+    def testFileHashedOnce(self, m):
+        m.side_effect = calculate_digest
+
+        filename = self.get_test_file()
+        document = self.consumer.try_consume_file(filename)
+
+        self.assertEqual([c[0][0] for c in m.call_args_list].count(filename), 1)
+        self.assertEqual(document.checksum, "42995833e01aea9b3edee44bbfdd7ce1")
+
     def testOverrideFilename(self):
         filename = self.get_test_file()
         override_filename = "My Bank - Statement for November.pdf"
@@ -624,7 +654,7 @@ class TestConsumer(DirectoriesMixin, TestCase):
         self.assertIsNotNone(os.path.isfile(document.title))
         self.assertTrue(os.path.isfile(document.source_path))
 
-    @mock.patch("documents.consumer.DocumentClassifier")
+    @mock.patch("documents.consumer.load_classifier")
     def testClassifyDocument(self, m):
         correspondent = Correspondent.objects.create(name="test")
         dtype = DocumentType.objects.create(name="test")
@@ -632,12 +662,13 @@ class TestConsumer(DirectoriesMixin, TestCase):
         t2 = Tag.objects.create(name="t2")
 
         m.return_value = MagicMock()
-        m.return_value.predict_correspondent.return_value = correspondent.pk
-        m.return_value.predict_document_type.return_value = dtype.pk
-        m.return_value.predict_tags.return_value = [t1.pk]
+        m.return_value.predict_all.return_value = Prediction(correspondent.pk, dtype.pk, [t1.pk])
 
         document = self.consumer.try_consume_file(self.get_test_file())
 
+        # the document is classified once for all post-consume hooks.
+        m.return_value.predict_all.assert_called_once()
+
         self.assertEqual(document.correspondent, correspondent)
         self.assertEqual(document.document_type, dtype)
         self.assertIn(t1, document.tags.all())
@@ -8,7 +8,9 @@ from django.db import DatabaseError
 from django.test import TestCase, override_settings
 
 from .utils import DirectoriesMixin
-from ..file_handling import generate_filename, create_source_path_directory, delete_empty_directories
+from ..file_handling import generate_filename, create_source_path_directory, delete_empty_directories, \
+    place_file, calculate_digest, PLACEMENT_RENAME, PLACEMENT_REFLINK, PLACEMENT_CHUNKED, PLACEMENT_SENDFILE, _copy_sendfile, \
+    PLACEMENT_COPY_FILE_RANGE, _copy_file_range
 from ..models import Document, Correspondent
 
 
@@ -485,3 +487,85 @@ class TestFileHandlingWithArchive(DirectoriesMixin, TestCase):
         self.assertTrue(os.path.isfile(archive))
         self.assertTrue(os.path.isfile(doc.source_path))
         self.assertTrue(os.path.isfile(doc.archive_path))
+
+
+class TestPlaceFile(DirectoriesMixin, TestCase):
+
+    def setUp(self) -> None:
+        super(TestPlaceFile, self).setUp()
+        self.source = os.path.join(self.dirs.scratch_dir, "source.pdf")
+        self.target = os.path.join(self.dirs.originals_dir, "target.pdf")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "samples", "simple.pdf"), self.source)
+        self.checksum = calculate_digest(self.source).checksum
+
+    def assertPlaced(self):
+        self.assertTrue(os.path.isfile(self.target))
+        self.assertEqual(calculate_digest(self.target).checksum, self.checksum)
+
+    def test_move_same_file_system(self):
+        source = os.path.join(self.dirs.originals_dir, "source.pdf")
+        os.rename(self.source, source)
+
+        self.assertEqual(place_file(source, self.target, move=True), PLACEMENT_RENAME)
+        self.assertPlaced()
+        self.assertFalse(os.path.isfile(source))
+
+    @mock.patch("documents.file_handling.os.rename")
+    def test_move_other_file_system(self, m):
+        m.side_effect = OSError(18, "Invalid cross-device link")
+
+        self.assertNotEqual(place_file(self.source, self.target, move=True), PLACEMENT_RENAME)
+        self.assertPlaced()
+        self.assertFalse(os.path.isfile(self.source))
+
+    def test_copy(self):
+        self.assertNotEqual(place_file(self.source, self.target), PLACEMENT_RENAME)
+        self.assertPlaced()
+        self.assertTrue(os.path.isfile(self.source))
+
+    def test_copy_mode(self):
+        os.chmod(self.source, 0o640)
+        place_file(self.source, self.target, copy_mode=True)
+        self.assertEqual(os.stat(self.target).st_mode & 0o777, 0o640)
+
+    @mock.patch("documents.file_handling.os.rename")
+    def test_move_other_file_system_copy_mode(self, m):
+        m.side_effect = OSError(18, "Invalid cross-device link")
+        os.chmod(self.source, 0o640)
+        place_file(self.source, self.target, move=True, copy_mode=True)
+        self.assertEqual(os.stat(self.target).st_mode & 0o777, 0o640)
+
+    def test_copy_fallback_sendfile(self):
+        def unsupported(src_fd, dst_fd, size):
+            # write something to make sure that the target is reset.
+            os.write(dst_fd, b"garbage")
+            raise OSError(95, "Operation not supported")
+
+        strategies = [(PLACEMENT_REFLINK, unsupported), (PLACEMENT_SENDFILE, _copy_sendfile)]
+        with mock.patch("documents.file_handling._COPY_STRATEGIES", strategies):
+            self.assertEqual(place_file(self.source, self.target), PLACEMENT_SENDFILE)
+        self.assertPlaced()
+
+    @mock.patch("documents.file_handling.os.copy_file_range", create=True)
+    def test_copy_fallback_nothing_copied(self, m):
+        # some file systems copy a part or nothing at all.
+        m.side_effect = [100, 0]
+
+        strategies = [(PLACEMENT_COPY_FILE_RANGE, _copy_file_range), (PLACEMENT_SENDFILE, _copy_sendfile)]
+        with mock.patch("documents.file_handling._COPY_STRATEGIES", strategies):
+            self.assertEqual(place_file(self.source, self.target), PLACEMENT_SENDFILE)
+        self.assertPlaced()
+
+    @mock.patch("documents.file_handling.os.sendfile")
+    def test_copy_fallback_nothing_sent(self, m):
+        m.return_value = 0
+
+        strategies = [(PLACEMENT_SENDFILE, _copy_sendfile)]
+        with mock.patch("documents.file_handling._COPY_STRATEGIES", strategies):
+            self.assertEqual(place_file(self.source, self.target), PLACEMENT_CHUNKED)
+        self.assertPlaced()
+
+    @mock.patch("documents.file_handling._COPY_STRATEGIES", [])
+    def test_copy_fallback_chunked(self):
+        self.assertEqual(place_file(self.source, self.target), PLACEMENT_CHUNKED)
+        self.assertPlaced()
@@ -1,6 +1,16 @@
-from django.test import TestCase
+import random
+import threading
+import time
+from unittest import mock
 
+from django.test import TestCase, override_settings
+from whoosh.reading import SegmentReader
+from whoosh.writing import AsyncWriter
+
+from documents import index
 from documents.index import JsonFormatter
+from documents.models import Document, Tag
+from documents.tests.utils import DirectoriesMixin
 
 
 class JsonFormatterTest(TestCase):
@@ -12,3 +22,250 @@ class JsonFormatterTest(TestCase):
         self.assertListEqual(self.formatter.format([]), [])
 
 
+
+
+class TestMatchingQuery(DirectoriesMixin, TestCase):
+
+    def setUp(self):
+        super(TestMatchingQuery, self).setUp()
+        self.doc1 = Document.objects.create(title="doc1", checksum="A", content="An invoice from the bank")
+        self.doc2 = Document.objects.create(title="doc2", checksum="B", content="See invoice.pdf for the brown fox")
+        self.doc3 = Document.objects.create(title="doc3", checksum="C", content="A letter about a lazy dog")
+        for doc in (self.doc1, self.doc2, self.doc3):
+            index.add_or_update_document(doc)
+
+    def candidates(self, match, algorithm):
+        tag = Tag(match=match, matching_algorithm=algorithm)
+        with index.open_index().searcher() as searcher:
+            q = index.matching_query(searcher, tag)
+            if q is None:
+                return None
+            return sorted(index.search_document_ids(searcher, q))
+
+    def test_any(self):
+        self.assertListEqual(self.candidates("invoice letter", Tag.MATCH_ANY), [self.doc1.pk, self.doc2.pk, self.doc3.pk])
+        self.assertListEqual(self.candidates("bank", Tag.MATCH_ANY), [self.doc1.pk])
+        # terms containing dots are indexed as one term.
+        self.assertListEqual(self.candidates("pdf", Tag.MATCH_ANY), [self.doc2.pk])
+
+    def test_all(self):
+        self.assertListEqual(self.candidates("invoice bank", Tag.MATCH_ALL), [self.doc1.pk])
+        # stop words are not indexed, but other words are required anyway.
+        self.assertListEqual(self.candidates("the invoice", Tag.MATCH_ALL), [self.doc1.pk, self.doc2.pk])
+        self.assertListEqual(self.candidates('"brown fox"', Tag.MATCH_ALL), [self.doc2.pk])
+
+    def test_literal(self):
+        # candidates only, the order of words is verified with matches().
+        self.assertListEqual(self.candidates("fox brown", Tag.MATCH_LITERAL), [self.doc2.pk])
+
+    def test_not_possible(self):
+        self.assertIsNone(self.candidates("the invoice", Tag.MATCH_ANY))
+        self.assertIsNone(self.candidates("inv.ice", Tag.MATCH_ANY))
+        self.assertIsNone(self.candidates("invoice", Tag.MATCH_REGEX))
+        self.assertIsNone(self.candidates("invoice", Tag.MATCH_FUZZY))
+
+
+@mock.patch("documents.index.transaction.on_commit", lambda f: f())
+@mock.patch("documents.index._schedule_flush")
+class TestIndexQueue(DirectoriesMixin, TestCase):
+
+    def setUp(self):
+        super(TestIndexQueue, self).setUp()
+        settings_override = override_settings(INDEX_FLUSH_INTERVAL=60, INDEX_QUEUE_SIZE=10)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.docs = [Document.objects.create(title=f"doc{i}", checksum=str(i), content=f"document number{i}")
+                     for i in range(15)]
+
+    def search(self, term):
+        with index.open_index().searcher() as searcher:
+            return sorted(index.search_document_ids(searcher, index.query.Term("content", term)))
+
+    def test_batched_commits(self, m):
+        for doc in self.docs[:9]:
+            index.queue_update(doc)
+
+        self.assertEqual(self.search("document"), [])
+        m.assert_called()
+
+        index.queue_update(self.docs[9])
+
+        # the tenth change commits all of them in a single segment.
+        self.assertEqual(self.search("document"), [d.pk for d in self.docs[:10]])
+        self.assertEqual(len(index.open_index()._segments()), 1)
+
+        for doc in self.docs[10:]:
+            index.queue_update(doc)
+        self.assertEqual(len(self.search("document")), 10)
+
+        self.assertEqual(index.flush_queue(), 5)
+        self.assertEqual(len(self.search("document")), 15)
+        self.assertEqual(index.flush_queue(), 0)
+
+    def test_coalesce(self, m):
+        doc = self.docs[0]
+        index.queue_update(doc)
+        doc.content = "changed"
+        doc.save()
+        index.queue_update(doc)
+        index.queue_removal(self.docs[1])
+
+        self.assertEqual(index.flush_queue(), 2)
+        self.assertEqual(self.search("changed"), [doc.pk])
+
+        index.queue_update(self.docs[1])
+        index.queue_removal(self.docs[1])
+        index.flush_queue()
+        self.assertEqual(self.search("document"), [])
+
+    def test_removed_documents(self, m):
+        index.add_or_update_document(self.docs[0])
+        index.queue_update(self.docs[0])
+        self.docs[0].delete()
+        index.flush_queue()
+
+        self.assertEqual(self.search("document"), [])
+
+    def test_wait_until_searchable(self, m):
+        index.queue_update(self.docs[0])
+        index.queue_update(self.docs[1])
+
+        index.wait_until_searchable(self.docs[0])
+
+        self.assertEqual(self.search("document"), [self.docs[0].pk, self.docs[1].pk])
+
+    def test_flush_left_behind(self, m):
+        index.queue_update(self.docs[0])
+
+        with override_settings(INDEX_FLUSH_INTERVAL=0.01):
+            time.sleep(0.02)
+            index.queue_update(self.docs[1])
+
+        self.assertEqual(self.search("document"), [self.docs[0].pk, self.docs[1].pk])
+
+
+class TestSharedSearcher(DirectoriesMixin, TestCase):
+
+    def test_reuse_and_refresh(self):
+        doc = Document.objects.create(title="doc1", checksum="A", content="An invoice from the bank")
+        index.add_or_update_document(doc)
+
+        searcher = index.shared_searcher()
+        self.assertIs(index.shared_searcher(), searcher)
+
+        self.assertEqual(index.search("invoice", 1).count, 1)
+
+        doc2 = Document.objects.create(title="doc2", checksum="B", content="Another invoice")
+        index.add_or_update_document(doc2)
+
+        self.assertEqual(index.search("invoice", 1).count, 2)
+        self.assertIsNot(index.shared_searcher(), searcher)
+
+    @mock.patch("documents.index.open_dir", wraps=index.open_dir)
+    def test_open_once(self, open_dir):
+        index.add_or_update_document(Document.objects.create(title="doc1", checksum="A", content="An invoice"))
+        open_dir.reset_mock()
+
+        for i in range(3):
+            self.assertEqual(index.autocomplete("inv"), [b"invoice"])
+            self.assertEqual(index.search("invoice", 1).count, 1)
+
+        self.assertLessEqual(open_dir.call_count, 1)
+
+
+class TestSearchCache(DirectoriesMixin, TestCase):
+
+    def setUp(self):
+        super(TestSearchCache, self).setUp()
+        self.doc = Document.objects.create(title="doc1", checksum="A", content="An invoice from the bank")
+        index.add_or_update_document(self.doc)
+
+    @mock.patch("documents.index._search", wraps=index._search)
+    def test_cache(self, m):
+        results = index.search("invoice", 1)
+        self.assertEqual(results.count, 1)
+        self.assertEqual(results.hits[0].id, self.doc.pk)
+        self.assertEqual(m.call_count, 1)
+
+        # same query, written differently
+        self.assertEqual(index.search("  Invoice ", 1), results)
+        self.assertEqual(m.call_count, 1)
+
+        index.search("invoice", 2)
+        self.assertEqual(m.call_count, 2)
+
+        index.add_or_update_document(Document.objects.create(title="doc2", checksum="B", content="Another invoice"))
+
+        self.assertEqual(index.search("invoice", 1).count, 2)
+        self.assertEqual(m.call_count, 3)
+
+    def test_recreated_index(self):
+        self.assertEqual(index.search("invoice", 1).count, 1)
+
+        # results of the previous index must not be served anymore.
+        self.doc.delete()
+        index.open_index(recreate=True)
+        index.add_or_update_document(Document.objects.create(title="doc2", checksum="B", content="Something else"))
+
+        self.assertEqual(index.search("invoice", 1).count, 0)
+
+    def test_suggestion_max_hits(self):
+        self.assertEqual(index.search("invoic", 1).corrected_query, "invoice")
+
+        with override_settings(SEARCH_SUGGESTION_MAX_HITS=0):
+            self.assertEqual(index.search("invoic", 1).corrected_query, "invoice")
+            self.assertIsNone(index.search("invoice bank", 1).corrected_query)
+            self.assertIsNone(index.search("invoice OR bnk", 1).corrected_query)
+
+
+class TestAutocomplete(DirectoriesMixin, TestCase):
+
+    def setUp(self):
+        super(TestAutocomplete, self).setUp()
+        rnd = random.Random(0)
+        words = ["".join(rnd.choice("abc") for _ in range(rnd.randint(1, 6))) for _ in range(300)]
+        # several segments
+        for i in range(3):
+            with AsyncWriter(index.open_index()) as writer:
+                for j in range(20):
+                    doc = Document.objects.create(title=f"doc{i}-{j}", checksum=f"{i}-{j}",
+                                                  content=" ".join(rnd.choice(words) for _ in range(30)))
+                    index.update_document(writer, doc)
+
+    def expected(self, term, limit):
+        with index.open_index().reader() as reader:
+            return [t for score, t in reader.most_distinctive_terms("content", number=limit, prefix=term)]
+
+    @mock.patch("documents.index._Autocompletion.LARGE_PREFIX", 20)
+    @mock.patch("documents.index._Autocompletion.LARGE_PREFIX_TERMS", 5)
+    def test_same_terms(self):
+        for term in ["", "a", "ab", "abc", "B", "cab", "bbbbbb", "x"]:
+            for limit in [1, 3, 5, 10, 100]:
+                self.assertListEqual(index.autocomplete(term, limit), self.expected(term.lower(), limit))
+
+    def test_update(self):
+        self.assertListEqual(index.autocomplete("a"), self.expected("a", 10))
+
+        writer = index.open_index().writer()
+        index.update_document(writer, Document.objects.create(title="new", checksum="new", content="aaaaaaa " * 100))
+        writer.commit(merge=False)
+
+        read = threading.Event()
+        update = index._Autocompletion._update
+
+        def wait_and_update(*args):
+            read.wait()
+            update(*args)
+
+        with mock.patch.object(SegmentReader, "iter_field", autospec=True, side_effect=SegmentReader.iter_field) as m, \
+                mock.patch.object(index._Autocompletion, "_update", autospec=True, side_effect=wait_and_update):
+            # the previous terms are used until the new segment is read.
+            self.assertNotEqual(index.autocomplete("a", 1), [b"aaaaaaa"])
+            read.set()
+            index._autocompletion.thread.join()
+
+            self.assertEqual(index.autocomplete("a", 1), [b"aaaaaaa"])
+            self.assertListEqual(index.autocomplete("a"), self.expected("a", 10))
+
+        # only the new segment is read.
+        self.assertEqual(m.call_count, 1)
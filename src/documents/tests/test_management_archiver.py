@@ -1,6 +1,7 @@
 import filecmp
 import os
 import shutil
+from unittest import mock
 
 from django.core.management import call_command
 from django.test import TestCase
@@ -27,6 +28,16 @@ class TestArchiver(DirectoriesMixin, TestCase):
 
         call_command('document_archiver')
 
+    @mock.patch("documents.search.WhooshBackend.flush")
+    def test_archiver_flushes_index_queue(self, flush):
+        Document.objects.create(checksum="A", title="A", content="first document", archive_checksum="B",
+                                mime_type="application/pdf")
+
+        call_command('document_archiver')
+
+        # the workers of the pool can't do that themselves.
+        flush.assert_called_once()
+
     def test_handle_document(self):
 
         shutil.copy(sample_file, os.path.join(self.dirs.originals_dir, "0000001.pdf"))
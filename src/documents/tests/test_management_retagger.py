@@ -1,6 +1,9 @@
+from unittest import mock
+
 from django.core.management import call_command
 from django.test import TestCase
 
+from documents.classifier import Prediction
 from documents.models import Document, Tag, Correspondent, DocumentType
 from documents.tests.utils import DirectoriesMixin
 
@@ -56,3 +59,65 @@ class TestRetagger(DirectoriesMixin, TestCase):
 
         self.assertEqual(d_first.correspondent, self.correspondent_first)
         self.assertEqual(d_second.correspondent, self.correspondent_second)
+
+    @mock.patch("documents.management.commands.document_retagger.load_classifier")
+    def test_classify_batch(self, m):
+        m.return_value.predict_many.side_effect = lambda contents: [Prediction(None, None, []) for _ in contents]
+
+        call_command('document_retagger', '--tags')
+
+        m.return_value.predict_many.assert_called_once()
+        self.assertCountEqual(m.return_value.predict_many.call_args[0][0],
+                              ["first document", "second document", "unrelated document"])
+
+    def test_overwrite(self):
+        self.d1.tags.add(self.tag_second)
+        self.d1.correspondent = self.correspondent_second
+        self.d1.save()
+
+        call_command('document_retagger', '--tags', '--correspondent', '--overwrite')
+        d_first, d_second, d_unrelated = self.get_updated_docs()
+
+        self.assertCountEqual(d_first.tags.all(), [self.tag_first])
+        self.assertEqual(d_first.correspondent, self.correspondent_first)
+
+    def test_keep_existing(self):
+        self.d1.correspondent = self.correspondent_second
+        self.d1.save()
+
+        call_command('document_retagger', '--correspondent')
+        d_first, d_second, d_unrelated = self.get_updated_docs()
+
+        self.assertEqual(d_first.correspondent, self.correspondent_second)
+
+    def test_multiple_matches(self):
+        Correspondent.objects.create(name="c3", match="document", matching_algorithm=Correspondent.MATCH_ANY)
+
+        call_command('document_retagger', '--correspondent')
+        d_first, d_second, d_unrelated = self.get_updated_docs()
+        self.assertIsNone(d_first.correspondent)
+        self.assertEqual(d_unrelated.correspondent.name, "c3")
+
+        call_command('document_retagger', '--correspondent', '--use-first')
+        d_first, d_second, d_unrelated = self.get_updated_docs()
+        self.assertIsNotNone(d_first.correspondent)
+
+    @mock.patch("documents.management.commands.document_retagger.multiprocessing.Pool")
+    def test_processes(self, m):
+        m.return_value.__enter__.return_value.imap_unordered = map
+
+        call_command('document_retagger', '--tags', '--document_type', '--processes', '2')
+        d_first, d_second, d_unrelated = self.get_updated_docs()
+
+        m.assert_called_once_with(processes=2)
+        self.assertEqual(d_first.tags.first(), self.tag_first)
+        self.assertEqual(d_second.document_type, self.doctype_second)
+
+    @mock.patch("documents.management.commands.document_retagger.update_filename_and_move_files")
+    @mock.patch("documents.index.update_document")
+    def test_update_files_and_index_once(self, update_document, update_filename):
+        with self.settings(PAPERLESS_FILENAME_FORMAT="{correspondent}/{title}"):
+            call_command('document_retagger', '--tags', '--correspondent', '--document_type')
+
+        self.assertCountEqual([c[0][1].pk for c in update_document.call_args_list], [self.d1.pk, self.d2.pk])
+        self.assertCountEqual([c[0][1].pk for c in update_filename.call_args_list], [self.d1.pk, self.d2.pk])
@@ -1,11 +1,18 @@
+import random
+import re
 import shutil
 import tempfile
+import time
+from io import StringIO
 from random import randint
 
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth.models import User
+from django.core.management import call_command
 from django.test import TestCase, override_settings
+from fuzzywuzzy import fuzz
 
+from .utils import DirectoriesMixin
 from .. import matching
 from ..models import Correspondent, Document, Tag, DocumentType
 from ..signals import document_consumption_finished
@@ -203,6 +210,208 @@ class TestMatching(TestCase):
             )
         )
 
+    def test_match_fuzzy_long_document(self):
+        filler = "lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 200
+        self._test_matching(
+            "Springfield, Miss.",
+            "MATCH_FUZZY",
+            (
+                filler + "1220 Main Street, Springf eld, Miss. " + filler,
+                filler + "1220 Main Street, Springfeld, Miss.",
+            ),
+            (
+                filler,
+                filler + "1220 Main Street, Springfield, Mich. " + filler,
+            )
+        )
+
+    def test_match_fuzzy_threshold(self):
+        tag = Tag.objects.create(name="t", match="Springfield, Miss.", matching_algorithm=Tag.MATCH_FUZZY)
+        content = "1220 Main Street, Springfield, Mich."
+        self.assertFalse(matching.matches(tag, content))
+        with override_settings(MATCH_FUZZY_THRESHOLD=80):
+            self.assertTrue(matching.matches(tag, content))
+
+    def test_fuzzy_matches(self):
+        # parts of the content that are as similar as the threshold are
+        # always found.
+        text = matching.MatchText("abc main invoice abc main abc springfield abc")
+        self.assertTrue(matching.fuzzy_matches("main invoice", text, 95))
+        self.assertTrue(matching.fuzzy_matches("abc springfieyd", text, 90))
+        self.assertFalse(matching.fuzzy_matches("main receipt", text, 90))
+
+    def test_fuzzy_matches_partial_ratio(self):
+        # Results are those of partial_ratio() on the entire content, as
+        # they have always been.
+        def partial_ratio_matches(match, content, insensitive, threshold):
+            # the content is always in lower case.
+            match = re.sub(r'[^\w\s]', '', match)
+            content = re.sub(r'[^\w\s]', '', content.lower())
+            if insensitive:
+                match = match.lower()
+            return fuzz.partial_ratio(match, content) >= threshold
+
+        rnd = random.Random(0)
+        alphabet = "abcdeABC .,-"
+        for _ in range(3000):
+            content = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(20, 300)))
+            if rnd.random() < 0.7:
+                # a part of the content with a few edits.
+                start = rnd.randint(0, len(content) - 5)
+                match = list(content[start:start + rnd.randint(5, 25)])
+                for _ in range(rnd.randint(0, 4)):
+                    match.insert(rnd.randrange(len(match) + 1), rnd.choice(alphabet))
+                    del match[rnd.randrange(len(match))]
+                match = "".join(match)
+            else:
+                match = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(5, 25)))
+            insensitive = rnd.random() < 0.5
+            threshold = rnd.choice([80, 90, 95])
+
+            stripped = re.sub(r'[^\w\s]', '', match)
+            if insensitive:
+                stripped = stripped.lower()
+            self.assertEqual(
+                matching.fuzzy_matches(stripped, matching.MatchText(content), threshold),
+                partial_ratio_matches(match, content, insensitive, threshold),
+                f"{match!r} in {content!r}")
+
+    def test_match_fuzzy_case_sensitive(self):
+        # the content is compared in lower case, and so is the match once
+        # the rule is saved.
+        tag = Tag.objects.create(name="t", match="Springfield", matching_algorithm=Tag.MATCH_FUZZY, is_insensitive=False)
+        self.assertTrue(matching.matches(tag, "1220 Main Street, Springfield"))
+        self.assertTrue(matching.matches(tag, "1220 MAIN STREET, SPRINGFIELD"))
+
+        tag = Tag.objects.create(name="t2", match="acme corporation", matching_algorithm=Tag.MATCH_FUZZY, is_insensitive=False)
+        self.assertTrue(matching.matches(tag, "INVOICE FROM ACME CORPORATION LTD"))
+
+        # not saved, an upper case match never matches.
+        tag = Tag(match="SPRINGFIELD", matching_algorithm=Tag.MATCH_FUZZY, is_insensitive=False)
+        self.assertFalse(matching.matches(tag, "1220 MAIN STREET, SPRINGFIELD"))
+
+    def test_match_keywords_as_patterns(self):
+        # keywords were always used as regular expressions.
+        self._test_matching(
+            "inv.ice",
+            "MATCH_ANY",
+            ("I have an invoice in me", "I have an inv-ice in me"),
+            ("I have an invoices in me",)
+        )
+
+    def test_match_case_insensitive_equivalents(self):
+        self._test_matching(
+            "strasse",
+            "MATCH_ANY",
+            ("I have STRAſSE in me",),
+            ("I have straße in me",)
+        )
+
+    def test_match_case_sensitive(self):
+        for match, content, result in [
+            ("alpha", "I have ALPHA in me", True),
+            ("Alpha", "I have Alpha in me", False),
+            ("alpha gamma", "I have alpha in me", True),
+        ]:
+            # not saved, since saving converts the match to lower case.
+            tag = Tag(match=match, is_insensitive=False,
+                      matching_algorithm=Tag.MATCH_ANY)
+            self.assertEqual(matching.matches(tag, content), result)
+
+    def test_compiled_rules_cached(self):
+        tag = Tag.objects.create(name="t", match="alpha", matching_algorithm=Tag.MATCH_ANY)
+        rule = matching.compile_rule(tag)
+        self.assertIs(matching.compile_rule(tag), rule)
+
+        tag.match = "gamma"
+        self.assertIsNot(matching.compile_rule(tag), rule)
+        self.assertTrue(matching.matches(tag, "I have gamma in me"))
+
+        rule = matching.compile_rule(tag)
+        tag.save()
+        self.assertIsNot(matching.compile_rule(tag), rule)
+
+    def test_prepare_text(self):
+        text = matching.prepare_text("Some Content")
+        self.assertEqual(text.content, "some content")
+        self.assertIs(matching.prepare_text("Some Content"), text)
+        self.assertIs(matching.prepare_text(text), text)
+        self.assertIsNot(matching.prepare_text("Other content"), text)
+
+    @override_settings(MATCH_REGEX_TIMEOUT=0.1)
+    def test_match_regex_timeout(self):
+        tag = Tag.objects.create(name="t", match="(a+)+$", matching_algorithm=Tag.MATCH_REGEX)
+        start = time.monotonic()
+        with self.assertLogs("documents.matching", "WARNING"):
+            self.assertFalse(matching.matches(tag, "a" * 40 + "b"))
+        self.assertLess(time.monotonic() - start, 5)
+
+        # other rules are not affected.
+        self.assertTrue(matching.matches(tag, "aaa"))
+
+    @override_settings(MATCH_REGEX_TIMEOUT=0.1)
+    def test_match_keyword_timeout(self):
+        for algorithm in (Tag.MATCH_ANY, Tag.MATCH_ALL, Tag.MATCH_LITERAL):
+            tag = Tag(name="t", match="(a+)+$", matching_algorithm=algorithm)
+            start = time.monotonic()
+            with self.assertLogs("documents.matching", "WARNING"):
+                self.assertFalse(matching.matches(tag, "a" * 40 + "b"))
+            self.assertLess(time.monotonic() - start, 5)
+
+
+class TestMatchingStats(DirectoriesMixin, TestCase):
+
+    def setUp(self):
+        super(TestMatchingStats, self).setUp()
+        matching.reset_rule_costs()
+
+    def test_rule_costs(self):
+        t1 = Tag.objects.create(name="t1", match="alpha", matching_algorithm=Tag.MATCH_ANY)
+        t2 = Tag.objects.create(name="t2", match=r"alpha\w+gamma", matching_algorithm=Tag.MATCH_REGEX)
+        c1 = Correspondent.objects.create(name="c1", match="gamma", matching_algorithm=Correspondent.MATCH_ALL)
+
+        matching.match_tags("I have alpha in me", None)
+        matching.match_tags("I have alphas_and_gamma in me", None)
+        matching.match_correspondents("I have alpha in me", None)
+
+        costs = matching.get_rule_costs()
+        self.assertCountEqual([c.matching_model for c in costs], [t1, t2, c1])
+        for cost in costs:
+            self.assertEqual(cost.calls, 1 if cost.matching_model == c1 else 2)
+            self.assertEqual(cost.timeouts, 0)
+        self.assertEqual(costs, sorted(costs, key=lambda c: c.total_time, reverse=True))
+
+        t1.delete()
+        self.assertCountEqual([c.matching_model for c in matching.get_rule_costs()], [t2, c1])
+
+        matching.reset_rule_costs()
+        self.assertListEqual(matching.get_rule_costs(), [])
+
+    @override_settings(MATCH_REGEX_TIMEOUT=0.1)
+    def test_rule_costs_timeout(self):
+        tag = Tag.objects.create(name="t", match="(a+)+$", matching_algorithm=Tag.MATCH_REGEX)
+        with self.assertLogs("documents.matching", "WARNING"):
+            matching.match_tags("a" * 40 + "b", None)
+
+        cost, = matching.get_rule_costs()
+        self.assertEqual(cost.matching_model, tag)
+        self.assertEqual(cost.timeouts, 1)
+
+    def test_command(self):
+        Tag.objects.create(name="slow tag", match="alpha", matching_algorithm=Tag.MATCH_ANY)
+
+        out = StringIO()
+        call_command("document_matching_stats", stdout=out)
+        self.assertIn("No matching rules", out.getvalue())
+
+        matching.match_tags("I have alpha in me", None)
+        out = StringIO()
+        call_command("document_matching_stats", stdout=out)
+        self.assertIn("slow tag", out.getvalue())
+
+        call_command("document_matching_stats", "--reset")
+        self.assertListEqual(matching.get_rule_costs(), [])
+
 
 @override_settings(POST_CONSUME_SCRIPT=None)
 class TestDocumentConsumptionFinishedSignal(TestCase):
@@ -0,0 +1,256 @@
+import datetime
+import threading
+import unittest
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from documents import index, search
+from documents.models import Document, Tag, Correspondent, DocumentType
+from documents.tests.utils import DirectoriesMixin
+
+
+class TestGetBackend(TestCase):
+
+    def test_whoosh(self):
+        self.assertIsInstance(search.get_backend(), search.WhooshBackend)
+
+    @override_settings(SEARCH_BACKEND="database")
+    def test_database(self):
+        self.assertIsInstance(search.get_backend(), search.DATABASE_BACKENDS[connection.vendor])
+
+    @override_settings(SEARCH_BACKEND="elasticsearch")
+    def test_unknown(self):
+        self.assertRaises(ImproperlyConfigured, search.get_backend)
+
+
+class TestParseQuery(TestCase):
+
+    def test_parse_query(self):
+        self.assertListEqual(search._parse_query('Invoice AND "brown  Fox" tag:bank 2020-01-05'),
+                             [["invoice"], ["brown", "fox"], ["bank"], ["2020", "01", "05"]])
+        self.assertListEqual(search._parse_query('"" - AND'), [])
+
+
+class TestParseFilters(TestCase):
+
+    def test_parse_filters(self):
+        self.assertDictEqual(search.parse_filters({
+            "tags__id__all": "1,2",
+            "tags__id__none": "3",
+            "correspondent__id": "3",
+            "created__date__gt": "2020-01-05",
+            "is_in_inbox": "false",
+            "document_type__id": "",
+            "title__icontains": "x"
+        }), {
+            "tags__id__all": [1, 2],
+            "tags__id__none": [3],
+            "correspondent__id": [3],
+            "created__date__gt": datetime.date(2020, 1, 5),
+            "is_in_inbox": False
+        })
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, search.parse_filters, {"tags__id__all": "1,a"})
+        self.assertRaises(ValueError, search.parse_filters, {"created__date__gt": "2020-13-01"})
+        self.assertRaises(ValueError, search.parse_filters, {"is_in_inbox": "maybe"})
+
+
+class BackendTestMixin(DirectoriesMixin):
+
+    def setUp(self):
+        super(BackendTestMixin, self).setUp()
+        bank = Correspondent.objects.create(name="Bank")
+        self.tag = Tag.objects.create(name="Taxes")
+        self.doc1 = Document.objects.create(title="doc1", checksum="A", content="An invoice from the bank", correspondent=bank)
+        self.doc2 = Document.objects.create(title="doc2", checksum="B", content="See the invoice and invoice.pdf for the brown fox")
+        self.doc3 = Document.objects.create(title="doc3", checksum="C", content="A letter about a lazy dog, and a fox")
+        self.doc3.tags.add(self.tag)
+        self.backend = self.get_backend()
+        self.backend.reindex()
+
+    def get_backend(self):
+        raise NotImplementedError()
+
+    def ids(self, results):
+        return [hit.id for hit in results.hits]
+
+    def test_search(self):
+        results = self.backend.search("invoice", 1)
+        self.assertEqual(results.count, 2)
+        self.assertEqual(results.page, 1)
+        self.assertEqual(results.page_count, 1)
+        self.assertCountEqual(self.ids(results), [self.doc1.pk, self.doc2.pk])
+        self.assertEqual([hit.rank for hit in results.hits], [0, 1])
+
+        self.assertCountEqual(self.ids(self.backend.search("fox", 1)), [self.doc2.pk, self.doc3.pk])
+        self.assertCountEqual(self.ids(self.backend.search("fox brown", 1)), [self.doc2.pk])
+        self.assertCountEqual(self.ids(self.backend.search("bank", 1)), [self.doc1.pk])
+        self.assertCountEqual(self.ids(self.backend.search("taxes", 1)), [self.doc3.pk])
+
+        results = self.backend.search("unknown", 1)
+        self.assertEqual(results.count, 0)
+        self.assertEqual(results.page, 0)
+        self.assertListEqual(results.hits, [])
+
+    def test_highlights(self):
+        hit = self.backend.search("lazy", 1).hits[0]
+        self.assertEqual(hit.title, "doc3")
+        self.assertListEqual(hit.highlights, [[
+            {'text': 'A letter about a '}, {'text': 'lazy', 'term': 0}, {'text': ' dog, and a fox'}]])
+
+    def test_update_and_remove(self):
+        self.doc1.content = "A letter from the bank"
+        self.doc1.save()
+        self.backend.update_documents([self.doc1])
+        self.backend.remove_documents([self.doc3.pk])
+
+        self.assertCountEqual(self.ids(self.backend.search("letter", 1)), [self.doc1.pk])
+        self.assertCountEqual(self.ids(self.backend.search("invoice", 1)), [self.doc2.pk])
+        self.assertCountEqual(self.backend.indexed_document_ids(), [self.doc1.pk, self.doc2.pk])
+
+    def test_backfill(self):
+        self.backend.remove_documents([self.doc1.pk])
+        doc4 = Document.objects.create(title="doc4", checksum="D", content="A fox")
+        self.doc2.delete()
+
+        self.assertEqual(self.backend.backfill(), 2)
+        self.assertCountEqual(self.backend.indexed_document_ids(), [self.doc1.pk, self.doc3.pk, doc4.pk])
+        self.assertEqual(self.backend.backfill(), 0)
+
+    def test_matching_document_ids(self):
+        def candidates(match, algorithm):
+            ids = self.backend.matching_document_ids(Tag(match=match, matching_algorithm=algorithm))
+            return sorted(ids) if ids is not None else None
+
+        self.assertListEqual(candidates("invoice letter", Tag.MATCH_ANY), [self.doc1.pk, self.doc2.pk, self.doc3.pk])
+        self.assertListEqual(candidates("invoice bank", Tag.MATCH_ALL), [self.doc1.pk])
+        self.assertListEqual(candidates("brown fox", Tag.MATCH_LITERAL), [self.doc2.pk])
+        self.assertIsNone(candidates("inv.*", Tag.MATCH_REGEX))
+
+
+    def test_search_filters(self):
+        inbox = Tag.objects.create(name="Inbox", is_inbox_tag=True)
+        invoice_type = DocumentType.objects.create(name="Invoice")
+        self.doc1.tags.add(self.tag, inbox)
+        self.doc2.document_type = invoice_type
+        self.doc2.save()
+        Document.objects.filter(pk=self.doc1.pk).update(created=timezone.make_aware(datetime.datetime(2020, 1, 10, 0, 30)))
+        Document.objects.filter(pk=self.doc2.pk).update(created=timezone.make_aware(datetime.datetime(2020, 1, 11, 23, 30)))
+        self.backend.reindex()
+
+        def ids(**params):
+            filters = search.parse_filters({k: str(v) for k, v in params.items()})
+            return sorted(self.ids(self.backend.search("invoice", 1, filters)))
+
+        self.assertListEqual(ids(), [self.doc1.pk, self.doc2.pk])
+        self.assertListEqual(ids(tags__id__all=f"{self.tag.pk},{inbox.pk}"), [self.doc1.pk])
+        self.assertListEqual(ids(tags__id__in=f"{self.tag.pk},{inbox.pk}"), [self.doc1.pk])
+        self.assertListEqual(ids(tags__id__none=inbox.pk), [self.doc2.pk])
+        self.assertListEqual(ids(correspondent__id=self.doc1.correspondent_id), [self.doc1.pk])
+        self.assertListEqual(ids(document_type__id__in=invoice_type.pk), [self.doc2.pk])
+        self.assertListEqual(ids(is_in_inbox="true"), [self.doc1.pk])
+        self.assertListEqual(ids(is_in_inbox="false"), [self.doc2.pk])
+        # dates are in the current time zone.
+        self.assertListEqual(ids(created__date__gt="2020-01-10"), [self.doc2.pk])
+        self.assertListEqual(ids(created__date__lt="2020-01-11"), [self.doc1.pk])
+        self.assertListEqual(ids(created__date__gt="2020-01-09", created__date__lt="2020-01-12"), [self.doc1.pk, self.doc2.pk])
+        self.assertListEqual(ids(created__date__gt="2020-01-11"), [])
+
+        inbox.delete()
+        self.assertListEqual(ids(is_in_inbox="true"), [])
+        self.assertListEqual(ids(is_in_inbox="false"), [self.doc1.pk, self.doc2.pk])
+
+
+class TestWhooshBackend(BackendTestMixin, TestCase):
+
+    def get_backend(self):
+        return search.WhooshBackend()
+
+    def test_reindex_waits_for_lock(self):
+        open_index = index.open_index
+
+        def open_and_lock(recreate=False):
+            ix = open_index(recreate)
+            # another process starts committing queued changes.
+            lock = ix.lock("WRITELOCK")
+            self.assertTrue(lock.acquire())
+            threading.Timer(0.5, lock.release).start()
+            return ix
+
+        with mock.patch("documents.index.open_index", open_and_lock):
+            self.assertEqual(self.backend.reindex(processes=1), 3)
+        self.assertCountEqual(self.ids(self.backend.search("invoice", 1)), [self.doc1.pk, self.doc2.pk])
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "Requires SQLite.")
+class TestSqliteBackend(BackendTestMixin, TestCase):
+
+    def get_backend(self):
+        return search.SqliteBackend()
+
+    def test_search_pages(self):
+        for i in range(25):
+            Document.objects.create(title=f"page{i}", checksum=f"page{i}", content="A page")
+        self.backend.backfill()
+
+        results = self.backend.search("page", 3)
+        self.assertEqual(results.count, 25)
+        self.assertEqual(results.page, 3)
+        self.assertEqual(results.page_count, 3)
+        self.assertEqual(len(results.hits), 5)
+        self.assertEqual(results.hits[0].rank, 20)
+
+        self.assertEqual(self.backend.search("page", 7).page, 3)
+
+    def test_search_matching_words(self):
+        # Words are split at dots, unlike with Whoosh.
+        self.assertCountEqual(self.ids(self.backend.search("pdf", 1)), [self.doc2.pk])
+        self.assertCountEqual(self.ids(self.backend.search('"brown fox"', 1)), [self.doc2.pk])
+        self.assertCountEqual(self.ids(self.backend.search('"fox brown"', 1)), [])
+
+    def test_deleted_documents(self):
+        # Documents deleted without removing them from the index.
+        self.doc1.delete()
+        results = self.backend.search("invoice", 1)
+        self.assertEqual(results.count, 1)
+        self.assertCountEqual(self.ids(results), [self.doc2.pk])
+
+    def test_autocomplete(self):
+        Document.objects.create(title="doc4", checksum="D", content="letters letters lettuce")
+        self.backend.backfill()
+
+        self.assertListEqual(self.backend.autocomplete("Let"), ["letters", "letter", "lettuce"])
+        self.assertListEqual(self.backend.autocomplete("let", limit=1), ["letters"])
+        self.assertListEqual(self.backend.autocomplete("xyz"), [])
+        self.assertListEqual(self.backend.autocomplete("-"), [])
+
+    def test_optimize(self):
+        self.backend.optimize()
+        self.assertCountEqual(self.ids(self.backend.search("invoice", 1)), [self.doc1.pk, self.doc2.pk])
+
+    @override_settings(SEARCH_BACKEND="database")
+    def test_api(self):
+        self.client.force_login(User.objects.create_superuser(username="temp_admin"))
+
+        response = self.client.get("/api/search/?query=invoice")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+        self.assertIsNone(response.data['corrected_query'])
+
+        response = self.client.patch(f"/api/documents/{self.doc3.pk}/", {'title': "invoice"}, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get("/api/search/?query=invoice")
+        self.assertEqual(response.data['count'], 3)
+
+        response = self.client.delete(f"/api/documents/{self.doc1.pk}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertCountEqual(self.backend.indexed_document_ids(), [self.doc2.pk, self.doc3.pk])
+
+        response = self.client.get("/api/search/autocomplete/?term=inv")
+        self.assertListEqual(response.data, ["invoice"])
@@ -1,10 +1,13 @@
 from datetime import datetime
+from unittest import mock
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
-from documents import tasks
-from documents.models import Document
+from documents import tasks, index, search
+from documents.classifier import get_training_data_generation, \
+    get_training_data_changes
+from documents.models import Document, Tag, Correspondent
 from documents.tests.utils import DirectoriesMixin
 
 
@@ -15,6 +18,39 @@ class TestTasks(DirectoriesMixin, TestCase):
 
         tasks.index_reindex()
 
+    def test_index_reindex_queries(self):
+        c = Correspondent.objects.create(name="bank")
+        t = Tag.objects.create(name="invoice")
+        for i in range(10):
+            doc = Document.objects.create(title=f"test{i}", content="my document", checksum=str(i), correspondent=c)
+            doc.tags.add(t)
+
+        # ids, documents with correspondents and types, tags.
+        with self.assertNumQueries(3):
+            self.assertEqual(tasks.index_reindex(), 10)
+
+        with index.open_index().searcher() as searcher:
+            self.assertEqual(len(searcher.search(index.query.Term("tag", "invoice"), limit=None)), 10)
+            self.assertEqual(len(searcher.search(index.query.Term("correspondent", "bank"), limit=None)), 10)
+
+    def test_index_reindex_processes(self):
+        for i in range(10):
+            Document.objects.create(title=f"test{i}", content="my document", checksum=str(i))
+
+        self.assertEqual(tasks.index_reindex(processes=2), 10)
+
+        with index.open_index().searcher() as searcher:
+            self.assertEqual(len(searcher.search(index.query.Term("content", "document"), limit=None)), 10)
+
+    @override_settings(SEARCH_BACKEND="database")
+    def test_index_backfill(self):
+        for i in range(10):
+            Document.objects.create(title=f"test{i}", content="my document", checksum=str(i))
+
+        self.assertEqual(tasks.index_backfill(), 10)
+        self.assertEqual(tasks.index_backfill(), 0)
+        self.assertEqual(search.get_backend().search("document", 1).count, 10)
+
     def test_index_optimize(self):
         Document.objects.create(title="test", content="my document", checksum="wow", added=timezone.now(), created=timezone.now(), modified=timezone.now())
 
@@ -22,3 +58,185 @@ class TestTasks(DirectoriesMixin, TestCase):
 
     def test_train_classifier(self):
         tasks.train_classifier()
+
+    @mock.patch("documents.tasks.DocumentClassifier.reload")
+    @mock.patch("documents.tasks.DocumentClassifier.train")
+    def test_train_classifier_unchanged(self, train, reload):
+        train.return_value = True
+        Document.objects.create(title="test", content="my document", checksum="wow")
+
+        with mock.patch("documents.tasks.DocumentClassifier.save_classifier") as save:
+            save.side_effect = lambda: open(self.dirs.data_dir + "/classification_model.pickle", "w").close()
+            tasks.train_classifier()
+        train.assert_called_once()
+
+        # nothing changed, so the documents aren't even looked at.
+        tasks.train_classifier()
+        train.assert_called_once()
+
+        # unless asked to.
+        tasks.check_classifier()
+        self.assertEqual(train.call_count, 2)
+
+        Tag.objects.create(name="t", matching_algorithm=Tag.MATCH_AUTO)
+        tasks.train_classifier()
+        self.assertEqual(train.call_count, 3)
+
+    def test_training_data_generation(self):
+        generation = get_training_data_generation()
+
+        doc = Document.objects.create(title="test", content="my document", checksum="wow")
+        self.assertGreater(get_training_data_generation(), generation)
+
+        generation = get_training_data_generation()
+        doc.save(update_fields=["title"])
+        self.assertEqual(get_training_data_generation(), generation)
+
+        doc.tags.add(Tag.objects.create(name="t"))
+        self.assertGreater(get_training_data_generation(), generation)
+
+        generation = get_training_data_generation()
+        doc.delete()
+        self.assertGreater(get_training_data_generation(), generation)
+
+    def test_training_data_generation_matching_model(self):
+        generation = get_training_data_generation()
+        tag = Tag.objects.create(name="t")
+        correspondent = Correspondent.objects.create(name="c")
+        self.assertGreater(get_training_data_generation(), generation)
+
+        # other changes don't affect what the classifier learns.
+        generation = get_training_data_generation()
+        tag = Tag.objects.get(pk=tag.pk)
+        tag.name = "renamed"
+        tag.colour = 5
+        tag.match = "invoice"
+        tag.save()
+        correspondent.name = "renamed"
+        correspondent.save()
+        self.assertEqual(get_training_data_generation(), generation)
+
+        for instance, field, value in [(tag, "matching_algorithm", Tag.MATCH_AUTO),
+                                       (tag, "is_inbox_tag", True),
+                                       (correspondent, "matching_algorithm", Tag.MATCH_AUTO)]:
+            generation = get_training_data_generation()
+            setattr(instance, field, value)
+            instance.save()
+            self.assertGreater(get_training_data_generation(), generation)
+
+        generation = get_training_data_generation()
+        tag.delete()
+        self.assertGreater(get_training_data_generation(), generation)
+
+    @override_settings(CLASSIFIER_INCREMENTAL=True)
+    def test_training_data_changes(self):
+        doc = Document.objects.create(title="test", content="my document", checksum="wow")
+        tag = Tag.objects.create(name="t")
+        # never trained.
+        self.assertIsNone(get_training_data_changes()[1])
+
+        tasks.train_classifier()
+        generation, document_ids = get_training_data_changes()
+        self.assertListEqual(document_ids, [])
+
+        doc2 = Document.objects.create(title="test2", content="my document", checksum="wow2")
+        doc.tags.add(tag)
+        self.assertListEqual(get_training_data_changes()[1], [doc.pk, doc2.pk])
+
+        doc2.delete()
+        self.assertIsNone(get_training_data_changes()[1])
+
+    @override_settings(CLASSIFIER_INCREMENTAL=True, CLASSIFIER_FULL_REFIT_AFTER=2)
+    @mock.patch("documents.tasks.DocumentClassifier.train_incremental")
+    @mock.patch("documents.tasks.DocumentClassifier.train")
+    def test_train_classifier_incremental(self, train, train_incremental):
+        train.return_value = True
+        train_incremental.return_value = True
+        Document.objects.create(title="test", content="my document", checksum="wow")
+
+        with mock.patch("documents.tasks.DocumentClassifier.save_classifier") as save:
+            save.side_effect = lambda: open(self.dirs.data_dir + "/classification_model.pickle", "w").close()
+            tasks.train_classifier()
+            self.assertEqual(train.call_count, 1)
+
+            with mock.patch("documents.tasks.DocumentClassifier.reload"):
+                doc = Document.objects.create(title="test2", content="my document", checksum="wow2")
+                tasks.train_classifier()
+                train_incremental.assert_called_once_with([doc.pk])
+                self.assertEqual(train.call_count, 1)
+
+                # the daily check trains on all documents.
+                tasks.check_classifier()
+                self.assertEqual(train.call_count, 2)
+
+    def test_apply_matching_model(self):
+        doc1 = Document.objects.create(title="doc1", checksum="A", content="An invoice from the bank")
+        doc2 = Document.objects.create(title="doc2", checksum="B", content="Bank statement with an invoicing number")
+        doc3 = Document.objects.create(title="doc3", checksum="C", content="A bank letter")
+        for doc in (doc1, doc2, doc3):
+            index.add_or_update_document(doc)
+
+        tag = Tag.objects.create(name="t", match='"invoice from"', matching_algorithm=Tag.MATCH_ANY)
+        tasks.apply_matching_model("tag", tag.pk)
+
+        self.assertListEqual(list(doc1.tags.all()), [tag])
+        self.assertListEqual(list(doc2.tags.all()), [])
+        self.assertListEqual(list(doc3.tags.all()), [])
+
+        c1 = Correspondent.objects.create(name="c1")
+        doc3.correspondent = c1
+        doc3.save()
+        c2 = Correspondent.objects.create(name="c2", match="bank", matching_algorithm=Correspondent.MATCH_ANY)
+        tasks.apply_matching_model("correspondent", c2.pk)
+
+        self.assertEqual(Document.objects.get(pk=doc1.pk).correspondent, c2)
+        self.assertEqual(Document.objects.get(pk=doc2.pk).correspondent, c2)
+        # correspondents are not replaced.
+        self.assertEqual(Document.objects.get(pk=doc3.pk).correspondent, c1)
+
+        # the index knows about the changes.
+        with index.open_index().searcher() as searcher:
+            self.assertEqual(searcher.document(id=doc1.pk)["tag"], "t")
+
+    @mock.patch("documents.signals.handlers.async_task")
+    @mock.patch("documents.signals.handlers.transaction.on_commit", lambda f: f())
+    def test_apply_matching_model_on_save(self, async_task):
+        tag = Tag.objects.create(name="t", match="invoice", matching_algorithm=Tag.MATCH_ANY)
+        async_task.assert_called_once_with("documents.tasks.apply_matching_model", "tag", tag.pk)
+
+        async_task.reset_mock()
+        Tag.objects.create(name="t2", match="invoice", matching_algorithm=Tag.MATCH_REGEX)
+        Tag.objects.create(name="t3", matching_algorithm=Tag.MATCH_ANY)
+        async_task.assert_not_called()
+
+        with override_settings(MATCHING_APPLY_ON_SAVE=False):
+            tag.match = "receipt"
+            tag.save()
+        async_task.assert_not_called()
+
+    @mock.patch("documents.signals.handlers.async_task")
+    @mock.patch("documents.signals.handlers.transaction.on_commit", lambda f: f())
+    def test_apply_matching_model_on_change(self, async_task):
+        tag = Tag.objects.create(name="t", match="invoice", matching_algorithm=Tag.MATCH_ANY)
+        correspondent = Correspondent.objects.create(name="c", match="bank", matching_algorithm=Tag.MATCH_ANY)
+        async_task.reset_mock()
+
+        # other changes don't apply the rule again.
+        tag = Tag.objects.get(pk=tag.pk)
+        tag.name = "renamed"
+        tag.colour = 5
+        tag.save()
+        correspondent.name = "renamed"
+        correspondent.save()
+        async_task.assert_not_called()
+
+        for field, value in [("match", "invoice receipt"),
+                             ("matching_algorithm", Tag.MATCH_ALL),
+                             ("is_insensitive", False)]:
+            setattr(tag, field, value)
+            tag.save()
+            async_task.assert_called_once_with("documents.tasks.apply_matching_model", "tag", tag.pk)
+            async_task.reset_mock()
+
+            tag.save()
+            async_task.assert_not_called()
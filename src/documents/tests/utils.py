@@ -4,7 +4,9 @@ import tempfile
 from collections import namedtuple
 from contextlib import contextmanager
 
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
 
 def setup_directories():
@@ -74,3 +76,26 @@ class DirectoriesMixin:
     def tearDown(self) -> None:
         super(DirectoriesMixin, self).tearDown()
         remove_dirs(self.dirs)
+
+
+class QueryBudgetMixin:
+    """
+    Catches views that run more queries the more objects they return.
+    """
+
+    def assertQueryBudget(self, path, max_queries, page_sizes=(1, 10, 100)):
+        """
+        Asserts that getting the path takes at most max_queries queries, no
+        matter how many objects are on a page.
+        """
+        separator = "&" if "?" in path else "?"
+        for page_size in page_sizes:
+            url = f"{path}{separator}page_size={page_size}"
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(
+                len(context), max_queries,
+                "{} took {} queries:\n{}".format(
+                    url, len(context),
+                    "\n".join(q["sql"] for q in context.captured_queries)))
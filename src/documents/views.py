@@ -1,10 +1,13 @@
+import logging
 import os
 import tempfile
 from datetime import datetime
 from time import mktime
 
 from django.conf import settings
+from django.db import connection
 from django.db.models import Count, Max
+from django.db.models.functions import Substr
 from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.views.decorators.cache import cache_control
 from django.views.generic import TemplateView
@@ -28,9 +31,9 @@ from rest_framework.viewsets import (
     ReadOnlyModelViewSet
 )
 
-import documents.index as index
+from documents import search
 from paperless.db import GnuPG
-from paperless.views import StandardPagination
+from paperless.views import StandardPagination, OptionalCursorPagination
 from .filters import (
     CorrespondentFilterSet,
     DocumentFilterSet,
@@ -49,6 +52,9 @@ from .serialisers import (
 )
 
 
+logger = logging.getLogger(__name__)
+
+
 class IndexView(TemplateView):
     template_name = "index.html"
 
@@ -109,7 +115,7 @@ class DocumentViewSet(RetrieveModelMixin,
     model = Document
     queryset = Document.objects.all()
     serializer_class = DocumentSerializer
-    pagination_class = StandardPagination
+    pagination_class = OptionalCursorPagination
     permission_classes = (IsAuthenticated,)
     filter_backends = (DjangoFilterBackend, SearchFilter, OrderingFilter)
     filterset_class = DocumentFilterSet
@@ -123,15 +129,68 @@ class DocumentViewSet(RetrieveModelMixin,
         "modified",
         "added",
         "archive_serial_number")
+    cursor_ordering_fields = ("created", "added", "id")
+
+    def requested_fields(self):
+        """
+        Returns the fields of the documents the client asked for with the
+        fields and exclude parameters.
+        """
+        fields = DocumentSerializer.Meta.fields
+        params = self.request.query_params
+        if params.get("fields"):
+            fields = [f for f in fields if f in params["fields"].split(",")]
+        if params.get("exclude"):
+            exclude = params["exclude"].split(",")
+            fields = [f for f in fields if f not in exclude]
+        return fields
+
+    def requested_truncation(self):
+        """
+        Returns the number of characters of the content the client asked for
+        with the truncate_content parameter, or None for the entire content.
+        """
+        try:
+            length = int(self.request.query_params["truncate_content"])
+        except (KeyError, ValueError):
+            return None
+        return length if length >= 0 else None
+
+    def get_queryset(self):
+        queryset = super(DocumentViewSet, self).get_queryset()
+        if self.action not in ("list", "retrieve"):
+            return queryset.prefetch_related("tags")
+
+        # Correspondents and document types are serialized as their ids,
+        # which the documents have anyway. Only tags need another query.
+        fields = self.requested_fields()
+        if "tags" in fields:
+            queryset = queryset.prefetch_related("tags")
+
+        # The content is by far the largest field, so it is only read from
+        # the database as far as it is needed.
+        truncate_content = self.requested_truncation()
+        if "content" not in fields:
+            queryset = queryset.defer("content")
+        elif truncate_content is not None:
+            queryset = queryset.defer("content").annotate(
+                truncated_content=Substr("content", 1, truncate_content))
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        if self.action in ("list", "retrieve"):
+            kwargs.setdefault("fields", self.requested_fields())
+            kwargs.setdefault("truncate_content", self.requested_truncation())
+        return super(DocumentViewSet, self).get_serializer(*args, **kwargs)
 
     def update(self, request, *args, **kwargs):
         response = super(DocumentViewSet, self).update(
             request, *args, **kwargs)
-        index.add_or_update_document(self.get_object())
+        search.get_backend().queue_update(self.get_object())
         return response
 
     def destroy(self, request, *args, **kwargs):
-        index.remove_document_from_index(self.get_object())
+        search.get_backend().queue_removal(self.get_object())
         return super(DocumentViewSet, self).destroy(request, *args, **kwargs)
 
     @staticmethod
@@ -206,11 +265,12 @@ class LogViewSet(ReadOnlyModelViewSet):
 
     queryset = Log.objects.all()
     serializer_class = LogSerializer
-    pagination_class = StandardPagination
+    pagination_class = OptionalCursorPagination
     permission_classes = (IsAuthenticated,)
     filter_backends = (DjangoFilterBackend, OrderingFilter)
     filterset_class = LogFilterSet
     ordering_fields = ("created",)
+    cursor_ordering_fields = ("created", "id")
 
 
 class PostDocumentView(APIView):
@@ -267,19 +327,23 @@ class SearchView(APIView):
 
     permission_classes = (IsAuthenticated,)
 
-    def __init__(self, *args, **kwargs):
-        super(SearchView, self).__init__(*args, **kwargs)
-        self.ix = index.open_index()
+    def add_infos_to_hits(self, hits):
+        documents = Document.objects.filter(
+            id__in=[hit.id for hit in hits]).prefetch_related("tags")
+        documents = {doc.pk: doc for doc in documents}
+
+        hits = [hit for hit in hits if hit.id in documents]
 
-    def add_infos_to_hit(self, r):
-        doc = Document.objects.get(id=r['id'])
-        return {'id': r['id'],
-                'highlights': r.highlights("content", text=doc.content),
-                'score': r.score,
-                'rank': r.rank,
-                'document': DocumentSerializer(doc).data,
-                'title': r['title']
-                }
+        serialized = DocumentSerializer(
+            [documents[hit.id] for hit in hits], many=True).data
+
+        return [{'id': hit.id,
+                 'highlights': hit.highlights,
+                 'score': hit.score,
+                 'rank': hit.rank,
+                 'document': data,
+                 'title': hit.title
+                 } for hit, data in zip(hits, serialized)]
 
     def get(self, request, format=None):
         if 'query' not in request.query_params:
@@ -299,26 +363,39 @@ class SearchView(APIView):
             page = 1
 
         try:
-            with index.query_page(self.ix, query, page) as (result_page,
-                                                            corrected_query):
-                return Response(
-                    {'count': len(result_page),
-                     'page': result_page.pagenum,
-                     'page_count': result_page.pagecount,
-                     'corrected_query': corrected_query,
-                     'results': list(map(self.add_infos_to_hit, result_page))})
+            filters = search.parse_filters(request.query_params)
+        except ValueError as e:
+            return HttpResponseBadRequest(f"Invalid filter: {e}")
+
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        try:
+            with connection.execute_wrapper(count_queries):
+                results = search.get_backend().search(query, page, filters)
+                response = Response(
+                    {'count': results.count,
+                     'page': results.page,
+                     'page_count': results.page_count,
+                     'corrected_query': results.corrected_query,
+                     'results': self.add_infos_to_hits(results.hits)})
         except Exception as e:
             return HttpResponseBadRequest(str(e))
 
+        logger.debug(
+            f"Search for \"{query}\", page {page}: "
+            f"{len(response.data['results'])} results, {queries} queries.")
+        return response
+
 
 class SearchAutoCompleteView(APIView):
 
     permission_classes = (IsAuthenticated,)
 
-    def __init__(self, *args, **kwargs):
-        super(SearchAutoCompleteView, self).__init__(*args, **kwargs)
-        self.ix = index.open_index()
-
     def get(self, request, format=None):
         if 'term' in request.query_params:
             term = request.query_params['term']
@@ -332,7 +409,7 @@ class SearchAutoCompleteView(APIView):
         else:
             limit = 10
 
-        return Response(index.autocomplete(self.ix, term, limit))
+        return Response(search.get_backend().autocomplete(term, limit))
 
 
 class StatisticsView(APIView):
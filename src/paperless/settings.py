@@ -355,6 +355,48 @@ CONSUMER_RECURSIVE = __get_boolean("PAPERLESS_CONSUMER_RECURSIVE")
 
 CONSUMER_SUBDIRS_AS_TAGS = __get_boolean("PAPERLESS_CONSUMER_SUBDIRS_AS_TAGS")
 
+# An additional, usually faster hash algorithm (such as blake2b) that is
+# calculated alongside the md5 checksum of every consumed file.
+DIGEST_ALGORITHM = os.getenv("PAPERLESS_DIGEST_ALGORITHM")
+
+# Update the classifier with changed documents only, instead of training it on
+# all documents every time.
+CLASSIFIER_INCREMENTAL = __get_boolean("PAPERLESS_CLASSIFIER_INCREMENTAL")
+
+# Number of incremental updates after which the classifier is trained on all
+# documents again.
+CLASSIFIER_FULL_REFIT_AFTER = int(os.getenv("PAPERLESS_CLASSIFIER_FULL_REFIT_AFTER", 10))
+
+# Minimum similarity (0 to 100) of parts of a document to the match of a
+# fuzzy matching rule.
+MATCH_FUZZY_THRESHOLD = int(os.getenv("PAPERLESS_MATCH_FUZZY_THRESHOLD", 90))
+
+# Apply tags, correspondents and document types to existing documents when
+# their matching rules change.
+MATCHING_APPLY_ON_SAVE = __get_boolean("PAPERLESS_MATCHING_APPLY_ON_SAVE", "true")
+
+# Seconds after which searching a document for the regular expression of a
+# matching rule is aborted. 0 disables the limit.
+MATCH_REGEX_TIMEOUT = float(os.getenv("PAPERLESS_MATCH_REGEX_TIMEOUT", 1))
+
+# Only suggest corrected search queries ("did you mean") if a query finds at
+# most this many documents. Unset or empty always suggests corrections.
+SEARCH_SUGGESTION_MAX_HITS = os.getenv("PAPERLESS_SEARCH_SUGGESTION_MAX_HITS")
+if SEARCH_SUGGESTION_MAX_HITS:
+    SEARCH_SUGGESTION_MAX_HITS = int(SEARCH_SUGGESTION_MAX_HITS)
+else:
+    SEARCH_SUGGESTION_MAX_HITS = None
+
+# Changes to the search index are committed in batches of this many
+# documents, or after this many seconds. An interval of 0 commits every change
+# right away.
+INDEX_QUEUE_SIZE = int(os.getenv("PAPERLESS_INDEX_QUEUE_SIZE", 100))
+INDEX_FLUSH_INTERVAL = float(os.getenv("PAPERLESS_INDEX_FLUSH_INTERVAL", 5))
+
+# Where documents are indexed and searched: "whoosh" keeps a separate index in
+# INDEX_DIR, "database" uses the full text search of SQLite or PostgreSQL.
+SEARCH_BACKEND = os.getenv("PAPERLESS_SEARCH_BACKEND", "whoosh")
+
 OPTIMIZE_THUMBNAILS = __get_boolean("PAPERLESS_OPTIMIZE_THUMBNAILS", "true")
 
 OCR_PAGES = int(os.getenv('PAPERLESS_OCR_PAGES', 0))
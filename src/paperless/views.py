@@ -1,8 +1,15 @@
+import json
 import os
+from collections import OrderedDict
 
+from django.db import connections
 from django.http import HttpResponse
 from django.views.generic import View
+from rest_framework import pagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
 
 
 class StandardPagination(PageNumberPagination):
@@ -11,6 +18,105 @@ class StandardPagination(PageNumberPagination):
     max_page_size = 100000
 
 
+def estimate_count(queryset):
+    """
+    Returns the number of objects the database expects the queryset to have.
+    Only PostgreSQL keeps statistics for that. Elsewhere, the objects are
+    counted.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return queryset.count()
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+class CursorPagination(pagination.CursorPagination):
+    """
+    Pages through the objects from where the previous page ended, instead of
+    skipping all objects before the page. Views specify the fields that this
+    works with in cursor_ordering_fields.
+
+    Counting all objects takes as long as fetching all of them. The count
+    parameter specifies whether the objects are counted ("exact"), estimated
+    ("estimate") or not counted at all ("none").
+    """
+
+    page_size = 25
+    page_size_query_param = "page_size"
+    max_page_size = 100000
+    ordering = "-created"
+    count_query_param = "count"
+
+    def get_ordering(self, request, queryset, view):
+        ordering = OrderingFilter().get_ordering(request, queryset, view)
+        ordering = list(ordering or [self.ordering])
+
+        fields = getattr(view, "cursor_ordering_fields", ("id",))
+        invalid = [o for o in ordering if o.lstrip("-") not in fields]
+        if invalid:
+            raise ValidationError(
+                "Cannot page through objects ordered by {} with a cursor, "
+                "only by {}.".format(", ".join(invalid), ", ".join(fields)))
+
+        # Objects with the same value are ordered by id, so that pages
+        # always end at the same object.
+        if "id" not in [o.lstrip("-") for o in ordering]:
+            ordering.append("-id" if ordering[0].startswith("-") else "id")
+        return tuple(ordering)
+
+    def get_count(self, queryset, request):
+        mode = request.query_params.get(self.count_query_param, "exact")
+        if mode == "none":
+            return None
+        elif mode == "estimate":
+            return estimate_count(queryset)
+        else:
+            return queryset.count()
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = self.get_count(queryset, request)
+        return super(CursorPagination, self).paginate_queryset(
+            queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("count", self.count),
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data)
+        ]))
+
+
+class OptionalCursorPagination(StandardPagination):
+    """
+    Numbers pages, unless the client asks for cursor pagination by specifying
+    a cursor, which is empty for the first page.
+    """
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if CursorPagination.cursor_query_param in request.query_params:
+            self.cursor_pagination = CursorPagination()
+            return self.cursor_pagination.paginate_queryset(
+                queryset, request, view)
+
+        self.cursor_pagination = None
+        return super(OptionalCursorPagination, self).paginate_queryset(
+            queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.get_paginated_response(data)
+        return super(OptionalCursorPagination, self).get_paginated_response(
+            data)
+
+
 class FaviconView(View):
 
     def get(self, request, *args, **kwargs):